@@ -0,0 +1,272 @@
+"""
+Benchmarks training, generation and validation against the shipped training
+data and synthetic corpora, and reports the results as JSON.
+
+Example:
+    python benchmark.py --corpora shipped 10000 --n 1 2 3 --output results.json
+"""
+import argparse
+import config
+import corpus
+import json
+import multiprocessing
+import ngrams_lm
+import numpy as np
+import os
+import pandas as pd
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import utils
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is reported as null there
+    resource = None
+
+# Benchmarks that do not depend on n are only run once per corpus
+N_INDEPENDENT = ("load_files", "load_corpus", "train_multi_order")
+ALL_BENCHMARKS = (
+    "load_files",
+    "load_corpus",
+    "generate_grams",
+    "train_multi_order",
+    "generate_headline",
+    "generate_batch",
+    "score_batch",
+    "validate_headline",
+    "generate_until_valid",
+    "backoff_until_valid"
+)
+
+def write_synthetic_corpus(directory, size, seed=0):
+    """Writes a synthetic corpus of size headlines to directory and returns its file names.
+
+    Words are drawn from a Zipf distribution over a vocabulary that grows with
+    the square root of the corpus size, roughly like real text does, and every
+    headline contains `florida man`.
+
+    Parameters
+    ----------
+    directory: string
+        Directory to write the .csv file into.
+    size: int
+        Number of headlines to write.
+    seed: int
+        Seed for the random number generator.
+    """
+    rng = np.random.default_rng(seed)
+    vocab_size = int(20 * size ** 0.5) + 1000
+    lengths = rng.integers(utils.MIN_WORDS - 2, utils.MAX_WORDS - 1, size=size)
+    words = (rng.zipf(1.3, size=int(lengths.sum())) - 1) % vocab_size
+    ends = np.cumsum(lengths)
+    titles = [
+        "florida man " + " ".join("w{}".format(word) for word in words[end - length:end])
+        for end, length in zip(ends.tolist(), lengths.tolist())
+    ]
+    filename = "synthetic_{}.csv".format(size)
+    pd.DataFrame({
+        "title": titles,
+        "link": ["https://example.com/{}".format(i) for i in range(size)]
+    }).to_csv(os.path.join(directory, filename), index=False)
+    return [filename]
+
+def percentiles(latencies):
+    """Returns the 50th, 90th, 99th percentile and maximum of latencies in seconds.
+
+    Parameters
+    ----------
+    latencies: list
+        Latency of each operation in seconds.
+    """
+    if len(latencies) == 0:
+        return None
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99, "max": max(latencies)}
+
+def time_each(fn, operations):
+    """Calls fn operations times and returns the latency of each call.
+
+    Parameters
+    ----------
+    fn: function
+        Function with no args to time.
+    operations: int
+        Number of calls.
+    """
+    latencies = []
+    for _ in range(operations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def run_benchmark(name, directory, filenames, n, operations):
+    """Runs one benchmark and returns the number of operations and their latencies.
+
+    Setup such as loading and training is not included in the latencies.
+
+    Parameters
+    ----------
+    name: string
+        Name of the benchmark, one of ALL_BENCHMARKS.
+    directory: string
+        Directory with the corpus inside.
+    filenames: list of strings
+        Names of the corpus .csv files.
+    n: int
+        Value of n for language model.
+    operations: int
+        Number of operations for per-operation benchmarks.
+    """
+    if name == "load_files":
+        return 1, time_each(lambda: utils.load_files(directory, filenames), 1), {}
+    if name == "load_corpus":
+        # Compiled once beforehand, like the shell does the first time it loads the data
+        path = tempfile.mkdtemp(prefix="florida_man_corpus_")
+        try:
+            corpus.compile_corpus(directory, path)
+            return 1, time_each(lambda: corpus.load_corpus(path).entries(filenames), 1), {}
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    entries = utils.load_files(directory, filenames)
+    if name == "generate_grams":
+        return len(entries.index), time_each(lambda: ngrams_lm.generate_grams(n, entries), 1), {}
+    if name == "train_multi_order":
+        return len(entries.index), time_each(lambda: ngrams_lm.train_multi_order(5, entries), 1), {}
+    if name == "generate_headline":
+        headline_aggregate = ngrams_lm.generate_grams(n, entries)
+        return operations, time_each(lambda: ngrams_lm.generate_headline(n, headline_aggregate), operations), {}
+    model = ngrams_lm.train_multi_order(n, entries).view(n)
+    if name == "generate_batch":
+        batch_size = 1000
+        batches = max(1, operations // batch_size)
+        return batches * batch_size, time_each(lambda: ngrams_lm.generate_batch(n, model, batch_size), batches), {"batch_size": batch_size}
+    if name == "score_batch":
+        batch_size = 1000
+        batches = max(1, operations // batch_size)
+        titles = entries["title"].sample(batches * batch_size, replace=True, random_state=0).tolist()
+        chunks = iter([titles[i:i + batch_size] for i in range(0, len(titles), batch_size)])
+        return batches * batch_size, time_each(lambda: model.score_batch(next(chunks)), batches), {"batch_size": batch_size}
+    title_index = utils.build_title_index(entries)
+    if name == "validate_headline":
+        candidates = iter(ngrams_lm.generate_batch(n, model, operations))
+        return operations, time_each(lambda: utils.validate_headline(next(candidates), title_index), operations), {}
+    if name in ("generate_until_valid", "backoff_until_valid"):
+        # The loop from print_headlines, timed per accepted headline
+        if name == "backoff_until_valid":
+            sampler = ngrams_lm.train_multi_order(n, entries).backoff(n)
+        else:
+            sampler = ngrams_lm.ConstrainedSampler(model)
+            if sampler.acceptance_probability == 0:
+                return 0, [], {"attempts": 0}
+        headlines = set()
+        candidates = []
+        attempts = 0
+        latencies = []
+        start = time.perf_counter()
+        while len(headlines) < operations and attempts < 100 * operations:
+            if not candidates:
+                candidates = sampler.generate_batch(500)
+            headline = candidates.pop()
+            attempts += 1
+            if utils.validate_headline(headline, title_index) and headline not in headlines:
+                headlines.add(headline)
+                now = time.perf_counter()
+                latencies.append(now - start)
+                start = now
+        return len(headlines), latencies, {"attempts": attempts}
+    raise ValueError("Unknown benchmark `{}`.".format(name))
+
+def _run_case(queue, name, directory, filenames, n, operations):
+    """Runs one benchmark in a child process and puts its result on queue."""
+    try:
+        count, latencies, extra = run_benchmark(name, directory, filenames, n, operations)
+        total = sum(latencies)
+        result = {
+            "operations": count,
+            "seconds": total,
+            "throughput": count / total if total > 0 else None,
+            "latency": percentiles(latencies)
+        }
+        result.update(extra)
+    except Exception as e:
+        result = {"error": repr(e)}
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    queue.put(result)
+
+def run_case(name, directory, filenames, n, operations, timeout):
+    """Runs one benchmark in a fresh process, so that each peak RSS is measured separately.
+
+    Parameters
+    ----------
+    name: string
+        Name of the benchmark, one of ALL_BENCHMARKS.
+    directory: string
+        Directory with the corpus inside.
+    filenames: list of strings
+        Names of the corpus .csv files.
+    n: int
+        Value of n for language model.
+    operations: int
+        Number of operations for per-operation benchmarks.
+    timeout: float
+        Seconds after which the benchmark is stopped.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(queue, name, directory, filenames, n, operations))
+    process.start()
+    try:
+        return queue.get(timeout=timeout)
+    except Exception:
+        process.terminate()
+        return {"error": "timed out after {} seconds".format(timeout)}
+    finally:
+        process.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the Florida man headline generator.")
+    parser.add_argument("--corpora", nargs="+", default=["shipped", "10000", "100000", "1000000"],
+        help="`shipped` for the training data in ./training_data, or a number of synthetic headlines.")
+    parser.add_argument("--n", nargs="+", type=int, default=[1, 2, 3, 4, 5], help="Values of n to benchmark.")
+    parser.add_argument("--benchmarks", nargs="+", default=list(ALL_BENCHMARKS), choices=ALL_BENCHMARKS)
+    parser.add_argument("--operations", type=int, default=1000, help="Operations for per-operation benchmarks.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds allowed for each benchmark.")
+    parser.add_argument("--output", default="-", help="File to write the JSON report to, or `-` for stdout.")
+    args = parser.parse_args(argv)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "results": []
+    }
+    synthetic_directory = tempfile.mkdtemp(prefix="florida_man_benchmark_")
+    try:
+        for corpus_name in args.corpora:
+            if corpus_name == "shipped":
+                directory, filenames = config.training_directory, list(config.used_files)
+            else:
+                directory = synthetic_directory + os.sep
+                filenames = write_synthetic_corpus(directory, int(corpus_name))
+            for name in args.benchmarks:
+                for n in ([None] if name in N_INDEPENDENT else args.n):
+                    print("Running {0} on {1} (n = {2})...".format(name, corpus_name, n), file=sys.stderr)
+                    result = {"corpus": corpus_name, "benchmark": name, "n": n}
+                    result.update(run_case(name, directory, filenames, n, args.operations, args.timeout))
+                    report["results"].append(result)
+    finally:
+        shutil.rmtree(synthetic_directory, ignore_errors=True)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
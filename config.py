@@ -0,0 +1,44 @@
+"""
+Training data and model settings shared by the shell, the server,
+generate.py and the benchmarks, and load_training_data, which loads the model
+the same way for all of them.
+"""
+import corpus
+import snapshots
+
+# Directory with the training .csv files
+training_directory = "./training_data/"
+# Files the model is trained on
+used_files = ("cbs_miami_headlines.csv", "floridaman_site_headlines.csv", "local10_headlines.csv", "user_headlines.csv")
+# Largest value of n the model is trained for
+max_n = 5
+# How near-duplicate training titles are handled, one of utils.NEAR_DUPLICATE_POLICIES
+near_duplicate_policy = "first"
+
+def load_training_data(training_directory=training_directory, filenames=used_files, max_n=max_n, near_duplicates=near_duplicate_policy):
+    """Returns the model, entries and title index of filenames.
+
+    Entries are loaded from the corpus, which is recompiled first if needed,
+    and near-duplicates are dropped from them according to near_duplicates but
+    kept in the title index. Both come precomputed from the corpus when
+    filenames are all of its files. The model is loaded from its snapshot, or trained
+    on the entries and saved if there is none.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    filenames: list of strings
+        A list of strings containing the names of .csv files for headline data.
+    max_n: int
+        Largest n to train the model for.
+    near_duplicates: string
+        Which near-duplicates to keep, see utils.drop_near_duplicates.
+    """
+    training_corpus = corpus.load_or_compile(training_directory)
+    entries = training_corpus.entries(filenames, near_duplicates)
+    title_index = training_corpus.title_index(filenames)
+    # Entries are still indexed by corpus row here, before anything renumbers them
+    rows = entries.index.to_numpy()
+    model = snapshots.load_or_train(training_directory, filenames, max_n, entries, near_duplicates=near_duplicates, corpus=training_corpus, corpus_rows=rows)
+    return model, entries, title_index
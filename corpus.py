@@ -0,0 +1,374 @@
+"""
+Compiles the .csv files in the training directory into a binary corpus of
+token ids, so loading training data doesn't parse every .csv file and
+re-tokenize every title. The corpus is stored in ./training_corpus as raw
+.npy arrays, which are memory-mapped when loaded, and is recompiled whenever
+a .csv file is added, removed or modified. Near-duplicate titles are found and
+every title is fingerprinted while compiling too, so starting up doesn't run
+dedup.near_duplicate_clusters or hash every title again.
+"""
+import dedup
+import instrumentation
+import json
+import ngrams_lm
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import snapshots
+import utils
+
+corpus_directory = "training_corpus/"
+
+# Version of the corpus layout, bumped whenever it changes
+FORMAT_VERSION = 2
+# Arrays saved for every corpus
+CORPUS_ARRAYS = ("tokens", "offsets", "sources", "fingerprints", "shared", "title_text", "title_offsets", "link_text", "link_offsets", "title_fingerprints")
+# Policies whose kept rows are saved with the corpus, as near_duplicates_<policy>.npy
+KEPT_POLICIES = tuple(policy for policy in utils.NEAR_DUPLICATE_POLICIES if policy != "keep")
+
+class Corpus:
+    """Titles of every training file as token ids, with their sources and links.
+
+    The token ids of title i are tokens[offsets[i]:offsets[i + 1]], which index
+    into vocab, and sources[i] is the index in filenames of the file it came
+    from. Titles are in file order. The cleaned titles and their links are
+    kept as UTF-8 text and only decoded when entries asks for them.
+
+    Near-duplicates and the title index are precomputed for the files that
+    weren't skipped, in the order of filenames, which is every file the
+    corpus can load; entries and title_index compute them again for any
+    other list of files.
+
+    Parameters
+    ----------
+    filenames: list of strings
+        Names of the .csv files the corpus was compiled from.
+    skipped: set
+        Names of the .csv files left out because they can't be parsed or lack columns.
+    vocab: list
+        A list of tokens, where each token's index is its id. Id 0 is PAD.
+    tokens: numpy array
+        Token ids of every title, one after the other.
+    offsets: numpy array
+        Start of each title in tokens, followed by the total number of tokens.
+    sources: numpy array
+        Index in filenames of each title's file.
+    fingerprints: numpy array
+        64-bit hash of each title's raw .csv row, used to drop exact duplicates.
+    shared: numpy array
+        Whether each title's fingerprint appears more than once in the corpus.
+    title_text: numpy array
+        UTF-8 bytes of every cleaned title, one after the other.
+    title_offsets: numpy array
+        Start of each title in the decoded title text, followed by its length.
+    link_text: numpy array
+        UTF-8 bytes of every link, one after the other.
+    link_offsets: numpy array
+        Start of each link in the decoded link text, followed by its length.
+    title_fingerprints: numpy array
+        Sorted, unique utils.title_fingerprint values of every title.
+    kept: dict
+        Rows that utils.drop_near_duplicates keeps from every file that wasn't
+        skipped, for each policy in KEPT_POLICIES.
+    """
+    def __init__(self, filenames, skipped, vocab, tokens, offsets, sources, fingerprints, shared, title_text, title_offsets, link_text, link_offsets, title_fingerprints, kept=None):
+        self.filenames = filenames
+        self.skipped = skipped
+        self.vocab = vocab
+        self.tokens = tokens
+        self.offsets = offsets
+        self.sources = sources
+        self.fingerprints = fingerprints
+        self.shared = shared
+        self.title_text = title_text
+        self.title_offsets = title_offsets
+        self.link_text = link_text
+        self.link_offsets = link_offsets
+        self.title_fingerprints = title_fingerprints
+        self.kept = {} if kept is None else kept
+
+    def __len__(self):
+        return len(self.sources)
+
+    def is_precomputed(self, filenames):
+        """Returns whether near-duplicates and the title index of filenames were computed when compiling."""
+        return list(filenames) == [filename for filename in self.filenames if filename not in self.skipped]
+
+    def rows(self, filenames):
+        """Returns the rows of the titles in filenames, like utils.load_files would load them.
+
+        Rows are in the order of filenames, then file order. Exact duplicate
+        .csv rows are only returned the first time they appear.
+
+        Raises a FileNotFoundError if a file is not part of the corpus, and a
+        ValueError if it was skipped when compiling.
+
+        Parameters
+        ----------
+        filenames: list of strings
+            A list of strings containing the names of .csv files for headline data.
+        """
+        rows = []
+        for filename in filenames:
+            if filename not in self.filenames:
+                raise FileNotFoundError("`{}` is not part of the training corpus.".format(filename))
+            if filename in self.skipped:
+                raise ValueError("`{}` must be a .csv file with columns `title` and `link`.".format(filename))
+            rows.append(np.flatnonzero(self.sources == self.filenames.index(filename)))
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        # Only rows whose fingerprint appears more than once can be duplicates
+        candidates = np.flatnonzero(self.shared[rows])
+        _, first = np.unique(self.fingerprints[rows[candidates]], return_index=True)
+        keep = np.ones(len(rows), dtype=bool)
+        keep[candidates] = False
+        keep[candidates[first]] = True
+        return rows[keep]
+
+    def token_ids(self, rows):
+        """Returns the token ids of the titles in rows and the start of each title in them.
+
+        Parameters
+        ----------
+        rows: numpy array
+            Rows of the titles, e.g. from rows or the index of entries.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows].astype(np.int64)
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return self.tokens[positions], offsets
+
+    def entries(self, filenames, near_duplicates="keep"):
+        """Returns a DataFrame of the titles and links in filenames, like utils.load_files.
+
+        The DataFrame is indexed by corpus row, so entries can still be found
+        in the corpus after near-duplicates are dropped.
+
+        Parameters
+        ----------
+        filenames: list of strings
+            A list of strings containing the names of .csv files for headline data.
+        near_duplicates: string
+            Policy for near-duplicate titles, one of utils.NEAR_DUPLICATE_POLICIES. See utils.drop_near_duplicates.
+        """
+        rows = self.rows(filenames)
+        if near_duplicates in self.kept and self.is_precomputed(filenames):
+            rows = np.asarray(self.kept[near_duplicates])
+            titles = _decode(self.title_text, self.title_offsets, rows)
+        else:
+            titles = _decode(self.title_text, self.title_offsets, rows)
+            positions = utils.near_duplicate_positions(titles, near_duplicates)
+            rows = rows[positions]
+            titles = [titles[position] for position in positions]
+        links = _decode(self.link_text, self.link_offsets, rows)
+        entries = pd.DataFrame({"title": titles, "link": links}, index=rows)
+        # Empty links were missing in the .csv file, which pandas reads as NaN
+        entries.loc[entries["link"] == "", "link"] = np.nan
+        return entries
+
+    def title_index(self, filenames):
+        """Returns a compact utils.TitleIndex of every title in filenames, near-duplicates included.
+
+        Parameters
+        ----------
+        filenames: list of strings
+            A list of strings containing the names of .csv files for headline data.
+        """
+        rows = self.rows(filenames)
+        if self.is_precomputed(filenames):
+            return utils.TitleIndex(fingerprints=self.title_fingerprints)
+        return utils.TitleIndex(_decode(self.title_text, self.title_offsets, rows), compact=True)
+
+def _decode(text, offsets, rows):
+    """Returns the strings at rows of the UTF-8 text split at offsets, which count characters."""
+    text = text.tobytes().decode("utf-8")
+    starts, ends = offsets[rows].tolist(), offsets[rows + 1].tolist()
+    return [text[start:end] for start, end in zip(starts, ends)]
+
+def _encode(strings):
+    """Returns strings joined as UTF-8 bytes, with the start of each in characters followed by the total length."""
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return np.frombuffer("".join(strings).encode("utf-8"), dtype=np.uint8), offsets
+
+def source_files(training_directory):
+    """Returns the name, size and modification time of every .csv file in training_directory.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    """
+    sources = []
+    for filename in sorted(utils.get_files(training_directory, training_directory)):
+        if filename.endswith(".csv"):
+            stat = os.stat(training_directory + filename)
+            sources.append({"filename": filename, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    return sources
+
+@instrumentation.timed("load")
+def compile_corpus(training_directory, path):
+    """Compiles every .csv file in training_directory into a corpus saved in the directory path.
+
+    Titles are read and cleaned exactly like utils.load_files does. Files
+    that can't be parsed or lack `title` and `link` columns are skipped. The corpus
+    is written to a temporary directory first and then renamed, so an
+    interrupted compile never leaves a partial corpus behind. If another
+    process compiling at the same time renames its corpus into place first,
+    that corpus is kept instead.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    path: string
+        Directory to save the corpus in.
+    """
+    clean_headline = lambda headline: headline.strip().lower()
+    sources = source_files(training_directory)
+    word_ids = {ngrams_lm.PAD: 0}
+    vocab = [ngrams_lm.PAD]
+    frames = []
+    for source in sources:
+        try:
+            df = pd.read_csv(training_directory + source["filename"])
+        except (pd.errors.EmptyDataError, pd.errors.ParserError):
+            df = pd.DataFrame()
+        source["skipped"] = "title" not in df.columns or "link" not in df.columns
+        frames.append(pd.DataFrame(columns=["title", "link"]) if source["skipped"] else df)
+    # Rows are hashed over the columns of every file, like utils.load_files compares them after concatenating
+    columns = sorted(set().union(*(df.columns for df in frames)))
+    fingerprints = [pd.util.hash_pandas_object(df.reindex(columns=columns).astype(str), index=False).to_numpy() for df in frames]
+    fingerprints = np.concatenate(fingerprints) if fingerprints else np.empty(0, dtype=np.uint64)
+    _, inverse, repeats = np.unique(fingerprints, return_inverse=True, return_counts=True)
+    tokens, lengths, tags, titles, links = [], [], [], [], []
+    for tag, (source, df) in enumerate(zip(sources, frames)):
+        for headline, link in zip(df["title"], df["link"]):
+            title = clean_headline(headline)
+            ids = ngrams_lm.word_tokenizer.token_ids(title, word_ids, vocab)
+            tokens.extend(ids)
+            lengths.append(len(ids))
+            titles.append(title)
+            links.append("" if pd.isna(link) else str(link))
+        tags.extend([tag] * len(df.index))
+        source["titles"] = len(df.index)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    title_text, title_offsets = _encode(titles)
+    link_text, link_offsets = _encode(links)
+    # Every title of a skipped file is left out, so these are the titles of all files that weren't
+    title_fingerprints = np.unique(np.array([utils.title_fingerprint(title) for title in titles], dtype=np.uint64))
+    arrays = {
+        "tokens": np.array(tokens, dtype=ngrams_lm._id_dtype(len(vocab))),
+        "offsets": offsets,
+        "sources": np.array(tags, dtype=np.uint16),
+        "fingerprints": fingerprints,
+        "shared": repeats[inverse.reshape(-1)] > 1,
+        "title_text": title_text,
+        "title_offsets": title_offsets,
+        "link_text": link_text,
+        "link_offsets": link_offsets,
+        "title_fingerprints": title_fingerprints
+    }
+    filenames = [source["filename"] for source in sources]
+    skipped = {source["filename"] for source in sources if source["skipped"]}
+    compiled = Corpus(filenames, skipped, vocab, *(arrays[name] for name in CORPUS_ARRAYS))
+    rows = compiled.rows([filename for filename in filenames if filename not in skipped])
+    kept_titles = _decode(title_text, title_offsets, rows)
+    # Clustered once and shared by every policy
+    clusters = dedup.near_duplicate_clusters(kept_titles) if len(rows) else None
+    for policy in KEPT_POLICIES:
+        arrays["near_duplicates_" + policy] = rows[utils.near_duplicate_positions(kept_titles, policy, clusters)]
+
+    temporary_path = "{0}.tmp{1}".format(path.rstrip("/"), os.getpid())
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    with open(os.path.join(temporary_path, "vocab.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab))
+    for name in CORPUS_ARRAYS + tuple("near_duplicates_" + policy for policy in KEPT_POLICIES):
+        np.save(os.path.join(temporary_path, name + ".npy"), arrays[name])
+    with open(os.path.join(temporary_path, "meta.json"), "w") as f:
+        json.dump({"version": FORMAT_VERSION, "tokenization": snapshots.tokenization_settings(), "sources": sources}, f)
+    # Moved aside rather than deleted in place, so readers never see a half-deleted corpus
+    stale_path = "{0}.old{1}".format(path.rstrip("/"), os.getpid())
+    try:
+        os.replace(path, stale_path)
+    except OSError:
+        pass
+    try:
+        os.replace(temporary_path, path)
+    except OSError:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        if not is_current(training_directory, path):
+            raise
+    finally:
+        shutil.rmtree(stale_path, ignore_errors=True)
+
+@instrumentation.timed("load")
+def load_corpus(path):
+    """Loads the corpus saved in the directory path.
+
+    Arrays are memory-mapped read-only, so only the pages that are used get read
+    and processes forked after loading share them.
+
+    Parameters
+    ----------
+    path: string
+        Directory the corpus was saved in.
+    """
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+        vocab = f.read().split("\n")
+    filenames = [source["filename"] for source in meta["sources"]]
+    skipped = {source["filename"] for source in meta["sources"] if source["skipped"]}
+    kept = {policy: load("near_duplicates_" + policy) for policy in KEPT_POLICIES}
+    return Corpus(filenames, skipped, vocab, *(load(name) for name in CORPUS_ARRAYS), kept=kept)
+
+def is_current(training_directory, path):
+    """Returns whether the corpus in path was compiled from the current .csv files with the current tokenizer.
+
+    Files are compared by size and modification time, so checking doesn't
+    read any of them.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    path: string
+        Directory the corpus was saved in.
+    """
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    sources = [{key: source[key] for key in ("filename", "size", "mtime_ns")} for source in meta["sources"]]
+    return (
+        meta["version"] == FORMAT_VERSION
+        # Compared after a round trip through JSON, which turns tuples into lists
+        and meta["tokenization"] == json.loads(json.dumps(snapshots.tokenization_settings()))
+        and sources == source_files(training_directory)
+    )
+
+def load_or_compile(training_directory, directory=corpus_directory):
+    """Returns the corpus of training_directory, compiling it first if it is missing or out of date.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    directory: string
+        Directory the corpus is stored in.
+    """
+    if is_current(training_directory, directory):
+        try:
+            return load_corpus(directory)
+        except Exception as e:
+            utils.handle_exception(e, "Failed to load training corpus `{}`; recompiling.".format(directory))
+    compile_corpus(training_directory, directory)
+    return load_corpus(directory)
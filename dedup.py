@@ -0,0 +1,233 @@
+"""
+Finds near-duplicate titles, such as the same story syndicated by several
+sources with slightly different wording, using MinHash and locality-sensitive
+hashing (LSH) over character shingles.
+
+Every step works on numpy arrays over all titles at once: shingles are hashed
+with a rolling hash over one byte buffer, MinHash signatures are computed in
+chunks, and candidates are found by sorting the hash of each band of the
+signatures. Titles are never compared pairwise, so finding clusters takes
+O(N log N) time and O(N) memory in the number of titles.
+
+Exact duplicates among generated headlines are dropped with a Bloom filter,
+whose memory is fixed when it is made no matter how long the headlines are.
+"""
+import hashlib
+import html
+import instrumentation
+import math
+import numpy as np
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+SHINGLE_SIZE = 4
+THRESHOLD = 0.7
+
+# Maps every byte of a title to itself, except ASCII punctuation and whitespace, which become spaces
+_BYTE_CLASSES = np.array([
+    byte if chr(byte).isalnum() or byte >= 128 or byte == 0 else ord(" ")
+    for byte in range(256)
+], dtype=np.uint8)
+
+def shingle_hashes(titles, shingle_size=SHINGLE_SIZE):
+    """Returns hashes of the character shingles of every title and the offset of each title's first shingle.
+
+    Titles are lowercased and HTML-unescaped, joined into one byte buffer with
+    a space before and after each, and punctuation is collapsed to single
+    spaces. A polynomial rolling hash is then computed for every window of
+    shingle_size bytes at once. Each title is padded with shingle_size - 1 zero
+    bytes, so it has at least one shingle and no window crosses into the next title.
+
+    Parameters
+    ----------
+    titles: list of strings
+        Titles to shingle.
+    shingle_size: int
+        Number of bytes in each shingle.
+    """
+    padding = "\0" * (shingle_size - 1)
+    encoded = [
+        " {0} {1}".format(html.unescape(title) if "&" in title else title, padding).lower().encode("utf-8")
+        for title in titles
+    ]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    buffer = _BYTE_CLASSES[np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+    # Collapse runs of spaces, restarting at every title
+    keep = np.ones(len(buffer), dtype=bool)
+    keep[1:] = (buffer[1:] != ord(" ")) | (buffer[:-1] != ord(" "))
+    keep[np.cumsum(lengths) - lengths] = True
+    lengths = np.add.reduceat(keep, np.cumsum(lengths) - lengths) if len(lengths) else lengths
+    buffer = buffer[keep]
+    window_count = len(buffer) - shingle_size + 1
+    hashes = np.zeros(max(window_count, 0), dtype=np.uint64)
+    for i in range(shingle_size):
+        hashes = hashes * np.uint64(0x100000001b3) + buffer[i:i + window_count]
+    ends = np.cumsum(lengths)
+    keep = np.ones(len(hashes), dtype=bool)
+    # Windows starting in the padding of a title cross into the next
+    for i in range(1, shingle_size):
+        crossing = ends - i
+        keep[crossing[crossing < len(keep)]] = False
+    offsets = np.concatenate(([0], np.cumsum(lengths - shingle_size + 1)))
+    return hashes[keep], offsets
+
+def minhash_signatures(titles, num_permutations=NUM_PERMUTATIONS, shingle_size=SHINGLE_SIZE, seed=1, chunk_size=1 << 16):
+    """Returns the MinHash signature of each title as a row of a uint32 array.
+
+    Shingle hashes are folded to 32 bits and each permutation is a random odd
+    multiply and add modulo 2 ** 32. A signature holds the minimum of each
+    permutation over the title's shingles, and the fraction of equal entries in
+    two signatures estimates the Jaccard similarity of the titles' shingle sets.
+
+    Parameters
+    ----------
+    titles: list of strings
+        Titles to sign.
+    num_permutations: int
+        Number of hash functions, the length of each signature.
+    shingle_size: int
+        Number of bytes in each shingle.
+    seed: int
+        Seed for the random hash functions.
+    chunk_size: int
+        Number of shingles hashed at once, bounding the memory used.
+    """
+    hashes, offsets = shingle_hashes(titles, shingle_size)
+    hashes = (hashes ^ (hashes >> np.uint64(32))).astype(np.uint32)
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(0, 2 ** 31, size=(num_permutations, 1), dtype=np.uint32) * np.uint32(2) + np.uint32(1)
+    increments = rng.integers(0, 2 ** 32, size=(num_permutations, 1), dtype=np.uint32)
+    signatures = np.empty((len(titles), num_permutations), dtype=np.uint32)
+    # Chunks hold whole titles, so each title's minimum is taken within one chunk
+    title = 0
+    while title < len(titles):
+        last = int(np.searchsorted(offsets, offsets[title] + chunk_size, side="right")) - 1
+        last = min(max(last, title + 1), len(titles))
+        permuted = multipliers * hashes[offsets[title]:offsets[last]]
+        permuted += increments
+        signatures[title:last] = np.minimum.reduceat(permuted, offsets[title:last] - offsets[title], axis=1).T
+        title = last
+    return signatures
+
+def _band_keys(signatures, bands):
+    """Returns a 64-bit hash of each band of each signature as an array of shape (bands, titles)."""
+    rows = signatures.shape[1] // bands
+    keys = np.zeros((bands, len(signatures)), dtype=np.uint64)
+    for row in range(rows):
+        keys = keys * np.uint64(0x9e3779b97f4a7c15) + signatures[:, row::rows][:, :bands].T.astype(np.uint64)
+    return keys
+
+def _connected_components(count, sources, targets):
+    """Returns the smallest index in the connected component of each of count nodes.
+
+    Parameters
+    ----------
+    count: int
+        Number of nodes.
+    sources, targets: numpy arrays
+        Indices of the two nodes of each edge.
+    """
+    labels = np.arange(count)
+    while True:
+        smallest = np.minimum(labels[sources], labels[targets])
+        updated = labels.copy()
+        np.minimum.at(updated, sources, smallest)
+        np.minimum.at(updated, targets, smallest)
+        # Pointer jumping, so long chains collapse in logarithmically many passes
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+@instrumentation.timed("dedup")
+def near_duplicate_clusters(titles, threshold=THRESHOLD, num_permutations=NUM_PERMUTATIONS, bands=BANDS, shingle_size=SHINGLE_SIZE):
+    """Groups near-duplicate titles and returns the index of the first title in each title's cluster.
+
+    Titles whose signatures agree on a whole band are candidates, and a
+    candidate is linked to the first title in its band bucket if their
+    estimated Jaccard similarity is at least threshold. Clusters are the
+    connected components of these links. With the default 16 bands of 4 rows,
+    pairs with a similarity of 0.7 are found with a probability above 0.99.
+
+    Parameters
+    ----------
+    titles: list of strings
+        Titles to cluster.
+    threshold: float
+        Smallest estimated Jaccard similarity of the shingles of near-duplicates.
+    num_permutations: int
+        Length of each MinHash signature.
+    bands: int
+        Number of LSH bands the signatures are split into.
+    shingle_size: int
+        Number of bytes in each shingle.
+    """
+    if len(titles) == 0:
+        return np.zeros(0, dtype=np.int64)
+    signatures = minhash_signatures(titles, num_permutations, shingle_size)
+    sources, targets = [], []
+    for keys in _band_keys(signatures, bands):
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_first = np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+        firsts = order[np.flatnonzero(is_first)[np.cumsum(is_first) - 1]]
+        candidates = np.flatnonzero(~is_first)
+        members, representatives = order[candidates], firsts[candidates]
+        similarity = (signatures[members] == signatures[representatives]).mean(axis=1)
+        similar = similarity >= threshold
+        sources.append(representatives[similar])
+        targets.append(members[similar])
+    clusters = _connected_components(len(titles), np.concatenate(sources), np.concatenate(targets))
+    instrumentation.count("dedup.near_duplicates", int(np.count_nonzero(clusters != np.arange(len(titles)))))
+    return clusters
+
+class BloomFilter:
+    """A fixed-size set of strings that can report false positives but never false negatives.
+
+    Each string is hashed once with BLAKE2b, and its bit positions are derived
+    from the two halves of the digest by double hashing, so membership is
+    the same in every process and run, unlike with Python's salted hash.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of strings the filter is sized for.
+    error_rate: float
+        Probability of a false positive once capacity strings have been added.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def add(self, strings):
+        """Adds strings and returns a boolean array, True for each string not seen before.
+
+        A string repeated within strings is only new the first time. A string
+        that was never added is reported as seen with probability at most
+        error_rate, as long as no more than capacity strings were added.
+
+        Parameters
+        ----------
+        strings: list of strings
+            Strings to add.
+        """
+        if not strings:
+            return np.zeros(0, dtype=bool)
+        digests = b"".join(hashlib.blake2b(string.encode("utf-8"), digest_size=16).digest() for string in strings)
+        halves = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        positions = (halves[:, :1] + steps * halves[:, 1:]) % np.uint64(self.size)
+        bytes_, masks = positions // np.uint64(8), np.left_shift(np.uint8(1), (positions % np.uint64(8)).astype(np.uint8))
+        seen = ((self.bits[bytes_] & masks) != 0).all(axis=1)
+        # Only the first copy of a string repeated within strings is new
+        _, firsts = np.unique(halves.view(np.dtype((np.void, 16))).reshape(-1), return_index=True)
+        is_first = np.zeros(len(strings), dtype=bool)
+        is_first[firsts] = True
+        np.bitwise_or.at(self.bits, bytes_.reshape(-1), masks.reshape(-1))
+        return ~seen & is_first
+
+    def nbytes(self):
+        """Returns the bytes taken by the filter's bits."""
+        return self.bits.nbytes
@@ -0,0 +1,142 @@
+"""
+Fetches many pages concurrently over pooled keep-alive connections, with a
+per-host rate limit and retries with exponential backoff.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from urllib.parse import urlsplit
+import utils
+
+# Status codes that are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class HostRateLimiter:
+    """Spaces out requests to each host so that at most requests_per_second are started per second.
+
+    Parameters
+    ----------
+    requests_per_second: float
+        Largest number of requests started per host per second. None disables the limit.
+    """
+    def __init__(self, requests_per_second=None):
+        self.interval = 0 if not requests_per_second else 1 / requests_per_second
+        self.next_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Blocks until a request to the host of url may be started.
+
+        Parameters
+        ----------
+        url: string
+            URL about to be requested.
+        """
+        if self.interval == 0:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_times.get(host, now))
+            self.next_times[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def make_session(concurrency):
+    """Returns a requests Session whose connection pool fits concurrency connections per host.
+
+    Parameters
+    ----------
+    concurrency: int
+        Number of requests made at once.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def fetch(session, url, rate_limiter, retries=3, backoff=0.5, timeout=10, **kwargs):
+    """Fetches url with session, retrying failed requests with exponential backoff.
+
+    Returns the response text, or None if every attempt failed.
+
+    Parameters
+    ----------
+    session: requests Session
+        Session to make the request with.
+    url: string
+        URL to fetch.
+    rate_limiter: HostRateLimiter
+        Rate limiter shared by all requests.
+    retries: int
+        Number of retries after the first attempt.
+    backoff: float
+        Seconds to wait before the first retry; doubled for each retry after.
+    timeout: float
+        Seconds to wait for the server before giving up on an attempt.
+    kwargs:
+        Passed on to session.get, e.g. allow_redirects.
+    """
+    for attempt in range(retries + 1):
+        rate_limiter.wait(url)
+        delay = backoff * 2 ** attempt
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                return response.text
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            error = "HTTP {}".format(response.status_code)
+        except requests.RequestException as e:
+            error = e
+        if attempt < retries:
+            time.sleep(delay)
+    utils.handle_exception(error, "Failed to fetch `{0}` after {1} attempts:".format(url, retries + 1))
+    return None
+
+def fetch_all(urls, concurrency=8, requests_per_second=None, retries=3, backoff=0.5, timeout=10, session=None, cache=None, **kwargs):
+    """Fetches every URL in urls concurrently and returns their texts in the same order.
+
+    Failed URLs are returned as None. Up to concurrency requests are in flight
+    at once over a shared pool of keep-alive connections.
+
+    Parameters
+    ----------
+    urls: list of strings
+        URLs to fetch.
+    concurrency: int
+        Number of requests made at once.
+    requests_per_second: float
+        Largest number of requests started per host per second. None disables the limit.
+    retries: int
+        Number of retries after the first attempt.
+    backoff: float
+        Seconds to wait before the first retry; doubled for each retry after.
+    timeout: float
+        Seconds to wait for the server before giving up on an attempt.
+    session: requests Session
+        Session to make requests with. Defaults to a new session sized for concurrency.
+    cache: PageCache
+        Cache that every fetched page is stored in, or None.
+    kwargs:
+        Passed on to session.get, e.g. allow_redirects.
+    """
+    own_session = session is None
+    if own_session:
+        session = make_session(concurrency)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    def fetch_and_store(url):
+        page = fetch(session, url, rate_limiter, retries, backoff, timeout, **kwargs)
+        if cache is not None and page is not None:
+            cache.store(url, page)
+        return page
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(fetch_and_store, urls))
+    finally:
+        if own_session:
+            session.close()
@@ -0,0 +1,166 @@
+"""
+Generates headlines without the interactive shell, for scripts and cron jobs.
+Valid headlines are written to a file or stdout as soon as each chunk is
+validated, optionally gzip-compressed, and duplicates are dropped with a
+fixed-size Bloom filter, so memory stays constant however many headlines are
+asked for. The same seed always gives the same headlines, for any number of
+processes.
+
+Example:
+    python generate.py --n 3 --count 1000000 --seed 7 --format jsonl --out headlines.jsonl.gz
+"""
+import argparse
+from collections import Counter
+import config
+import dedup
+import gzip
+import io
+import json
+import multiprocessing
+import ngrams_lm
+import os
+import sys
+import time
+import utils
+
+# Output formats, mapping a headline to its line
+FORMATS = {
+    "text": lambda headline: headline + "\n",
+    "jsonl": lambda headline: json.dumps({"headline": headline}) + "\n"
+}
+
+def stream_headlines(sampler, title_index, count, seed=None, processes=1, error_rate=0.001, rejections=None):
+    """Yields count distinct valid headlines from sampler in the order they are generated.
+
+    Candidates are generated in seeded chunks by ngrams_lm.generate_bulk and
+    checked like in the shell. Duplicates are found with a Bloom filter sized
+    for count headlines, which takes about 1.8 MB per million at the default
+    error rate. A unique headline is wrongly dropped as a duplicate with
+    probability at most error_rate.
+
+    Raises a ValueError once utils.CONSECUTIVE_INVALID_LIMIT candidates in a row are invalid.
+
+    Parameters
+    ----------
+    sampler: ConstrainedSampler or BackoffModel
+        Anything with a generate_batch(k, rng=rng) method.
+    title_index: TitleIndex
+        An index of all headline titles in the training data.
+    count: int
+        Number of headlines to yield.
+    seed: int
+        Seed for the headlines, or None for fresh randomness.
+    processes: int
+        Number of processes generating candidates.
+    error_rate: float
+        Largest probability of dropping a unique headline as a duplicate.
+    rejections: Counter
+        Counter to add the number of candidates rejected for each reason to.
+    """
+    rejections = Counter() if rejections is None else rejections
+    seen = dedup.BloomFilter(count, error_rate)
+    produced = 0
+    consecutive_invalid_count = 0
+    if count <= 0:
+        return
+    for chunk in ngrams_lm.generate_bulk(sampler, None, seed, processes):
+        reasons = [utils.rejection_reason(headline, title_index) for headline in chunk]
+        is_new = iter(seen.add([headline for headline, reason in zip(chunk, reasons) if reason is None]))
+        for headline, reason in zip(chunk, reasons):
+            if reason is None and not next(is_new):
+                reason = "duplicate in batch"
+            if reason is not None:
+                rejections[reason] += 1
+                consecutive_invalid_count += 1
+                if consecutive_invalid_count >= utils.CONSECUTIVE_INVALID_LIMIT:
+                    raise ValueError("No valid headline in {0} attempts after {1} headlines.".format(consecutive_invalid_count, produced))
+                continue
+            consecutive_invalid_count = 0
+            produced += 1
+            yield headline
+            if produced == count:
+                return
+
+def open_output(path, compress=False):
+    """Opens path, or stdout for `-`, for writing text, gzip-compressed if compress is set.
+
+    Parameters
+    ----------
+    path: string
+        File to write to, or `-` for stdout.
+    compress: bool
+        Whether to gzip the output.
+    """
+    if path == "-":
+        # Closing the returned file leaves stdout itself open
+        stdout = open(sys.stdout.fileno(), "wb", closefd=False)
+        if compress:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=stdout, mode="wb"), encoding="utf-8", newline="\n")
+        return io.TextIOWrapper(stdout, encoding="utf-8", newline="\n")
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="\n")
+    return open(path, "w", encoding="utf-8", newline="\n")
+
+def load_sampler(n, backoff=False):
+    """Loads the model, from its snapshot if possible, and returns the sampler for n and the title index.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    backoff: bool
+        Whether to sample with backoff to shorter histories.
+    """
+    model, _, title_index = config.load_training_data()
+    return ngrams_lm.build_sampler(model, n, backoff), title_index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates Florida man headlines without the interactive shell.")
+    parser.add_argument("--n", type=int, default=2, help="Value of n for language model.")
+    parser.add_argument("--count", type=int, default=10, help="Number of distinct valid headlines to generate.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the headlines. Defaults to fresh randomness.")
+    parser.add_argument("--format", default="text", choices=sorted(FORMATS), help="One headline per line, as text or JSON.")
+    parser.add_argument("--out", default="-", help="File to write the headlines to, or `-` for stdout.")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output. Implied by an --out ending in .gz.")
+    parser.add_argument("--backoff", action="store_true", help="Generate with backoff sampling.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes generating candidates.")
+    parser.add_argument("--error-rate", type=float, default=0.001, help="Largest probability of dropping a unique headline as a duplicate.")
+    args = parser.parse_args(argv)
+    if not 1 <= args.n <= config.max_n:
+        parser.error("--n must be between 1 and {}.".format(config.max_n))
+    if args.count < 0:
+        parser.error("--count must not be negative.")
+    if not 0 < args.error_rate < 1:
+        parser.error("--error-rate must be between 0 and 1.")
+
+    try:
+        sampler, title_index = load_sampler(args.n, args.backoff)
+    except ValueError as e:
+        sys.exit(str(e))
+    rejections = Counter()
+    written = 0
+    start = time.perf_counter()
+    output = open_output(args.out, args.gzip or args.out.endswith(".gz"))
+    format_line = FORMATS[args.format]
+    try:
+        with output:
+            for headline in stream_headlines(sampler, title_index, args.count, args.seed, args.processes, args.error_rate, rejections):
+                output.write(format_line(headline))
+                written += 1
+    except BrokenPipeError:
+        # The reader went away, e.g. `| head`; stop quietly without another error at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except ValueError as e:
+        print(e, file=sys.stderr)
+    summary = {
+        "headlines": written,
+        "rejections": dict(rejections),
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+    print(json.dumps(summary), file=sys.stderr)
+    if written < args.count:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
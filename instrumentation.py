@@ -0,0 +1,214 @@
+"""
+Lightweight counters and stage timers for the language model and shell.
+While disabled, count returns immediately and timer returns a shared no-op
+context manager, so instrumentation can be left in hot paths. Also measures
+how much memory models take up, broken down by component.
+"""
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+from contextlib import nullcontext
+import functools
+import numpy as np
+import sys
+import threading
+import time
+
+enabled = False
+counters = Counter()
+timers = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+_lock = threading.Lock()
+_null_timer = nullcontext()
+
+def enable(on=True):
+    """Turns instrumentation on or off. Collected statistics are kept either way.
+
+    Parameters
+    ----------
+    on: bool
+        Whether to collect statistics.
+    """
+    global enabled
+    enabled = on
+
+def reset():
+    """Clears all collected statistics.
+
+    Parameters
+    ----------
+    None
+    """
+    with _lock:
+        counters.clear()
+        timers.clear()
+
+def count(name, amount=1):
+    """Adds amount to the counter name if instrumentation is enabled.
+
+    Parameters
+    ----------
+    name: string
+        Name of the counter.
+    amount: int
+        Amount to add.
+    """
+    if not enabled:
+        return
+    with _lock:
+        counters[name] += amount
+
+class _Timer:
+    """Adds the time spent inside a with block to a stage's timer."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            stage_timer = timers[self.stage]
+            stage_timer["calls"] += 1
+            stage_timer["seconds"] += elapsed
+        return False
+
+def timer(stage):
+    """Returns a context manager that times a stage, e.g. `with timer("train"):`.
+
+    Parameters
+    ----------
+    stage: string
+        Name of the stage, such as load, train or generate.
+    """
+    return _Timer(stage) if enabled else _null_timer
+
+def timed(stage):
+    """Decorator that times every call of a function as part of stage.
+
+    Parameters
+    ----------
+    stage: string
+        Name of the stage, such as load, train or generate.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with _Timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def snapshot():
+    """Returns a copy of all collected statistics as a dictionary.
+
+    Parameters
+    ----------
+    None
+    """
+    with _lock:
+        return {
+            "enabled": enabled,
+            "counters": dict(counters),
+            "timers": {stage: dict(stage_timer) for stage, stage_timer in timers.items()}
+        }
+
+def format_snapshot(stats):
+    """Formats the output of snapshot as a human readable string.
+
+    Parameters
+    ----------
+    stats: dictionary
+        Statistics returned by snapshot.
+    """
+    lines = ["Instrumentation is {}.".format("enabled" if stats["enabled"] else "disabled")]
+    lines.append("Stage timers:")
+    if not stats["timers"]:
+        lines.append("    None recorded.")
+    for stage, stage_timer in sorted(stats["timers"].items()):
+        lines.append("    {0:<10} {1:>6} calls {2:>10.4f} s".format(stage, stage_timer["calls"], stage_timer["seconds"]))
+    lines.append("Counters:")
+    if not stats["counters"]:
+        lines.append("    None recorded.")
+    for name, value in sorted(stats["counters"].items()):
+        lines.append("    {0:<45} {1:>10}".format(name, value))
+    return "\n".join(lines)
+
+def deep_sizeof(obj, seen=None):
+    """Returns the bytes taken by obj and every object it references, counting each object once.
+
+    Containers, NumPy arrays and instances of classes with a __dict__ are
+    followed; anything else counts as its own size. Arrays count their data
+    once no matter how many views of it there are, including memory-mapped
+    data, whose pages are only resident once read and are shared between
+    processes.
+
+    Parameters
+    ----------
+    obj: object
+        Object to measure.
+    seen: set
+        Ids of objects already counted, which are skipped and added to.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            root = obj
+            while isinstance(root.base, np.ndarray):
+                root = root.base
+            size += sys.getsizeof(obj) - (obj.nbytes if obj.flags.owndata else 0)
+            if root is obj or id(root) not in seen:
+                seen.add(id(root))
+                size += root.nbytes
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+            stack.append(vars(obj))
+    return size
+
+def memory_report(components):
+    """Returns the bytes taken by each component and their total.
+
+    Objects shared between components are counted in the first one that
+    references them.
+
+    Parameters
+    ----------
+    components: dictionary
+        Maps component names to the objects that make them up.
+    """
+    seen = set()
+    report = {name: deep_sizeof(value, seen) for name, value in components.items()}
+    report["total"] = sum(report.values())
+    return report
+
+def format_memory_report(report):
+    """Formats the output of memory_report as a human readable string.
+
+    Parameters
+    ----------
+    report: dictionary
+        Bytes taken by each component, as returned by memory_report.
+    """
+    total = report["total"]
+    lines = []
+    for name, size in report.items():
+        share = size / total if total else 0.0
+        lines.append("    {0:<25} {1:>12.1f} KB {2:>6.1%}".format(name, size / 1024, share))
+    return "\n".join(lines)
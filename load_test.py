@@ -0,0 +1,120 @@
+"""
+Load tests a running server.py from many concurrent keep-alive connections
+and reports requests per second and latency percentiles as JSON.
+
+Example:
+    python server.py --port 8080 &
+    python load_test.py --port 8080 --endpoint generate --concurrency 32 --requests 2000
+"""
+import argparse
+import asyncio
+from benchmark import percentiles
+from collections import Counter
+import json
+import platform
+import sys
+import time
+
+# Request body sent to each endpoint
+BODIES = {
+    "generate": lambda args: {"n": args.n, "count": args.count, "backoff": args.backoff},
+    "validate": lambda args: {"headline": "florida man arrested for stealing a boat full of alligators"},
+    "score": lambda args: {"n": args.n, "headline": "florida man arrested after he was caught driving a stolen car"}
+}
+
+async def _request(reader, writer, host, path, body):
+    """Sends one POST request on an open connection and returns the response status and JSON."""
+    writer.write((
+        "POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n"
+    ).format(path, host, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+async def _client(host, port, path, body, remaining, latencies, statuses):
+    """Sends requests on one connection until remaining runs out."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            status, _ = await _request(reader, writer, host, path, body)
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def run_load_test(host, port, endpoint, body, concurrency, requests):
+    """Sends requests to endpoint from concurrency connections and returns the results.
+
+    Parameters
+    ----------
+    host: string
+        Address of the server.
+    port: int
+        Port of the server.
+    endpoint: string
+        Endpoint to request, one of BODIES.
+    body: dictionary
+        JSON body of each request.
+    concurrency: int
+        Number of connections sending requests at once.
+    requests: int
+        Total number of requests.
+    """
+    encoded = json.dumps(body).encode("utf-8")
+    latencies = []
+    statuses = Counter()
+    remaining = [requests]
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client(host, port, "/" + endpoint, encoded, remaining, latencies, statuses)
+        for _ in range(concurrency)
+    ))
+    seconds = time.perf_counter() - start
+    return {
+        "endpoint": endpoint,
+        "body": body,
+        "concurrency": concurrency,
+        "requests": requests,
+        "seconds": seconds,
+        "requests_per_second": requests / seconds if seconds > 0 else None,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "latency": percentiles(latencies)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests the headline server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--endpoint", default="generate", choices=sorted(BODIES))
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of connections sending requests at once.")
+    parser.add_argument("--requests", type=int, default=1000, help="Total number of requests.")
+    parser.add_argument("--n", type=int, default=2, help="Value of n for generate and score requests.")
+    parser.add_argument("--count", type=int, default=1, help="Headlines asked for by each generate request.")
+    parser.add_argument("--backoff", action="store_true", help="Generate with backoff sampling.")
+    parser.add_argument("--output", default="-", help="File to write the JSON report to, or `-` for stdout.")
+    args = parser.parse_args(argv)
+
+    report = {"python": platform.python_version(), "platform": platform.platform()}
+    report.update(asyncio.run(run_load_test(
+        args.host, args.port, args.endpoint, BODIES[args.endpoint](args), args.concurrency, args.requests
+    )))
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,49 @@
+from bisect import bisect_right
+from multiprocessing import Pool
+import instrumentation
 import numpy as np
+import os
 import pandas as pd
+import threading
+import utils
 from collections import Counter
 from collections import defaultdict
+from collections import deque
+from itertools import chain
+from itertools import repeat
+from tokenizer import Tokenizer
+
+# Padding word used for histories at the start of a headline. Tokens never
+# contain whitespace, so it can't be confused with a word, such as the `~`
+# that marks user headlines
+PAD = " "
+
+# Splits titles into words and joins generated words back into headlines
+word_tokenizer = Tokenizer()
+
+def set_tokenizer(rules):
+    """Switches the tokenizer used for training and generation to rules.
+
+    Models trained with different rules are not interchangeable, so models
+    should be retrained (or loaded from a matching snapshot) after switching.
+
+    Parameters
+    ----------
+    rules: string
+        Name of the rule set, one of tokenizer.RULES.
+    """
+    global word_tokenizer
+    word_tokenizer = Tokenizer(rules)
+
+def _uniform(rng):
+    """Returns a function drawing floats in [0, 1) from rng, or from numpy's global random state if rng is None."""
+    return np.random.random_sample if rng is None else rng.random
 
 def single_headline_grams(n, headline):
     """Generates grams for a single headline.
 
-    Returns a dictionary that maps histories (phrase of words) to a list of
-    tuples that describe how likely it is for another phrase to follow.
+    Returns a dictionary that maps histories (tuples of n words) to a Counter
+    of how often each word follows them.
 
     Also makes the headline all lowercase and removes special characters.
 
@@ -19,12 +55,10 @@ def single_headline_grams(n, headline):
         A single Florida man headline.
     """
     counts = defaultdict(Counter)
-    history = ("~ " * n).strip()
-    headline = headline.split()
-    for word in headline:
+    history = (PAD,) * n
+    for word in word_tokenizer.tokenize(headline):
         counts[history][word] += 1
-        history = history.split()[1:] + [word]
-        history = " ".join(history)
+        history = history[1:] + (word,)
     return counts
 
 def combine_two_headlines(headline_1, headline_2):
@@ -35,15 +69,15 @@ def combine_two_headlines(headline_1, headline_2):
     Parameters
     ----------
     headline_1: dictionary
-        Key-value pair is string, Counter
+        Key-value pair is tuple, Counter
     headline_2: dictionary
-        Key-value pair is string, Counter
+        Key-value pair is tuple, Counter
     """
     for phrase, next_words in headline_2.items():
         if phrase in headline_1:
-            headline_1[phrase] = next_words + headline_1[phrase]
+            headline_1[phrase].update(next_words)
         else:
-            headline_1[phrase] = next_words
+            headline_1[phrase] = Counter(next_words)
     return headline_1
 
 def normalize_counts(counter):
@@ -57,6 +91,7 @@ def normalize_counts(counter):
     total = sum(counter.values())
     return [(word, count / total) for word, count in counter.most_common()]
 
+@instrumentation.timed("train")
 def generate_grams(n, entries):
     """Aggregates grams for every headline.
 
@@ -87,7 +122,8 @@ def generate_grams(n, entries):
 
     return headline_aggregate
 
-def generate_headline(n, headline_aggregate):
+@instrumentation.timed("generate")
+def generate_headline(n, headline_aggregate, rng=None):
     """Generates a headline using the language model.
 
     Parameters
@@ -96,32 +132,33 @@ def generate_headline(n, headline_aggregate):
         Value of n for language model.
     headline_aggregate: dictionary
         A dictionary of histories and corresponding frequencies for following words.
+    rng: numpy Generator
+        Source of randomness. Defaults to numpy's global random state.
     """
-    history = ("~ " * n).strip()
-    headline = ""
-
-    next_word = generate_word(headline_aggregate, history)
-    history = (history[1:] + " " + next_word).strip()
-    headline += next_word + " "
+    history = (PAD,) * n
+    words = []
+    next_word = generate_word(headline_aggregate, history, rng)
     while next_word != "":
-        next_word = generate_word(headline_aggregate, history)
-        history = history.split()[1:]
-        history.append(next_word)
-        history = " ".join(history).strip()
-        headline += next_word + " "
-    return headline.strip()
-
-def generate_word(headline_aggregate, history):
+        words.append(next_word)
+        history = history[1:] + (next_word,)
+        next_word = generate_word(headline_aggregate, history, rng)
+    return word_tokenizer.detokenize(words)
+
+def generate_word(headline_aggregate, history, rng=None):
     """Generates a word using the language model and preceding history.
 
     Parameters
     ----------
     headline_aggregate: dictionary
         A dictionary of histories and corresponding frequencies for following words.
-    history: str
-        A history of the last observed words.
+    history: tuple
+        A tuple of the last n observed words.
+    rng: numpy Generator
+        Source of randomness. Defaults to numpy's global random state.
     """
     if history not in headline_aggregate:
+        # The dictionary has no end marker, so a history is only missing where training headlines ended
+        instrumentation.count("model.ended_headlines")
         return ""
     next = headline_aggregate[history]
     words = []
@@ -129,9 +166,9 @@ def generate_word(headline_aggregate, history):
     for frequency in next:
         words.append(frequency[0])
         p.append(frequency[1])
-    return np.random.choice(words, p=p)
+    return (np.random if rng is None else rng).choice(words, p=p)
 
-def is_valid_headline(headline, entries):
+def is_valid_headline(headline, title_index):
     """Checks that headline is valid.
 
     Checks that headline is not identical to any headline in the training data,
@@ -142,10 +179,1586 @@ def is_valid_headline(headline, entries):
     ----------
     headline: str
         Language model generated headlines
-    entries: DataFrame
-        A DataFrame containing all headline entries.
+    title_index: TitleIndex
+        An index of all headline titles in the training data.
     """
-    return headline not in list(entries["title"])\
+    return headline not in title_index\
         and len(headline.split()) > 5\
         and len(headline.split()) < 20\
         and "florida man" in headline
+
+class HistoryIndex:
+    """Maps histories (tuples of n word ids) to rows like a dictionary, but stored as arrays.
+
+    Row r's history is histories[r]. A dictionary would hold a tuple and its
+    ids as separate Python objects for every row, while this holds the n ids
+    and a 64-bit hash. Histories are found by searchsorted over the sorted
+    hashes, one at a time with get or many at once with lookup. Compiled views
+    number their rows in hash order, so the hashes are already sorted and no
+    separate order has to be kept until rows are added.
+
+    Parameters
+    ----------
+    histories: numpy array
+        The history of each row, of shape (rows, n).
+    sorted_hashes: numpy array
+        The sorted hashes of histories, as saved in a snapshot, or None to hash them.
+    order: numpy array
+        The row of each sorted hash, or None if rows are in hash order.
+    """
+    def __init__(self, histories, sorted_hashes=None, order=None):
+        self.histories = histories
+        if sorted_hashes is not None:
+            self.sorted_hashes = sorted_hashes
+            self.order = order
+            return
+        hashes = _history_hashes(histories)
+        if (hashes[1:] >= hashes[:-1]).all():
+            self.order = None
+            self.sorted_hashes = hashes
+        else:
+            self.order = np.argsort(hashes, kind="stable").astype(np.int32)
+            self.sorted_hashes = hashes[self.order]
+
+    def __len__(self):
+        return len(self.histories)
+
+    def __iter__(self):
+        return map(tuple, self.histories.tolist())
+
+    def __contains__(self, history):
+        return self.get(history) is not None
+
+    def __getitem__(self, history):
+        row = self.get(history)
+        if row is None:
+            raise KeyError(history)
+        return row
+
+    def get(self, history, default=None):
+        """Returns the row of history, or default if it has none.
+
+        Parameters
+        ----------
+        history: tuple
+            A tuple of n word ids.
+        """
+        hashed = 0
+        for word_id in history:
+            hashed = (hashed * _HASH_MULTIPLIER + word_id + 2) & _HASH_MASK
+        position = int(self.sorted_hashes.searchsorted(np.uint64(hashed)))
+        # Checking every history with the same hash, in case of collisions
+        while position < len(self.sorted_hashes) and self.sorted_hashes[position] == hashed:
+            row = position if self.order is None else int(self.order[position])
+            if tuple(self.histories[row].tolist()) == history:
+                return row
+            position += 1
+        return default
+
+    def lookup(self, queries):
+        """Returns the row of each history in queries, or -1 for histories without one.
+
+        Parameters
+        ----------
+        queries: numpy array
+            Histories of shape (count, n).
+        """
+        return _find_rows(self.sorted_hashes, self.order, self.histories, queries)
+
+    def extend(self, histories, vocab_size):
+        """Returns a new index with histories added as the next rows.
+
+        Only the added histories are hashed, and their hashes are inserted
+        into the sorted ones after any equal hash, so the result is the same
+        as indexing every history again.
+
+        Parameters
+        ----------
+        histories: list of tuples
+            New histories, none of which are in the index.
+        vocab_size: int
+            Number of words the ids are drawn from, which may have grown.
+        """
+        dtype = np.promote_types(self.histories.dtype, _id_dtype(vocab_size))
+        added = np.array(histories, dtype=dtype).reshape(-1, self.histories.shape[1])
+        hashes = _history_hashes(added)
+        added_order = np.argsort(hashes, kind="stable")
+        positions = self.sorted_hashes.searchsorted(hashes[added_order], side="right")
+        order = np.arange(len(self.histories)) if self.order is None else self.order
+        return HistoryIndex(
+            np.concatenate([self.histories.astype(dtype), added]),
+            np.insert(self.sorted_hashes, positions, hashes[added_order]),
+            np.insert(order, positions, len(self.histories) + added_order).astype(np.int32)
+        )
+
+class CompiledModel:
+    """An array-backed version of the language model used for fast generation.
+
+    Words are interned to integer ids, and every history (a tuple of n word ids)
+    is assigned a row. The successors of row r are stored CSR-style in the slice
+    offsets[r]:offsets[r + 1] of successors and cumulative, ordered from most to
+    least common. Histories that were only ever seen at the end of a headline
+    get an empty row, which ends generation the same way a missing history does
+    in generate_word. Since every history reached during generation has a row,
+    transitions stores the row each successor leads to, letting generate_batch
+    advance histories without building any tuples.
+
+    Models counted from entries also keep the raw counts behind each row, which
+    lets add_headlines and remove_headlines update them without retraining.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    vocab: list
+        A list of words, where each word's index is its id.
+    histories: HistoryIndex
+        Maps histories (tuples of word ids) to row indices.
+    offsets: numpy array
+        Row boundaries into successors and cumulative, of length rows + 1.
+    successors: numpy array
+        Word ids of every following word, grouped by row.
+    cumulative: numpy array
+        Cumulative probabilities of the following words within each row.
+    transitions: numpy array
+        Row of the history formed by appending each successor to its history.
+    counts: numpy array
+        Raw counts of the following words within each row, or None if unknown.
+    word_ids: dictionary
+        Maps words to their ids in vocab, or None to build it. Views of a
+        MultiOrderModel share its vocab and word_ids instead of copying them.
+    """
+    def __init__(self, n, vocab, histories, offsets, successors, cumulative, transitions, counts=None, word_ids=None):
+        self.n = n
+        self.vocab = vocab
+        self.word_ids = {word: i for i, word in enumerate(vocab)} if word_ids is None else word_ids
+        self.histories = histories
+        self.offsets = offsets
+        self.successors = successors
+        self.cumulative = cumulative
+        self.transitions = transitions
+        self.counts = counts
+        self.start_history = (self.word_ids[PAD],) * n
+        self.start_row = histories[self.start_history]
+        self._index_rows()
+
+    def _index_rows(self):
+        """Recomputes the per-row lookup arrays after offsets or cumulative change."""
+        self.lengths = np.diff(self.offsets)
+        # Sampling keys, built when generate_batch first needs them
+        self._keys = None
+        # Python lists of the arrays, built when generate_headline first needs them
+        self._row_lists = None
+        # Sorted (row, successor) pairs, built when score_batch first needs them
+        self._successor_index = None
+
+    @property
+    def keys(self):
+        """Cumulative probabilities shifted by their row index, built on first use.
+
+        The shift makes the whole array sorted, so one searchsorted can sample
+        many rows.
+        """
+        if self._keys is None:
+            self._keys = self.cumulative + np.repeat(np.arange(len(self.lengths)), self.lengths)
+        return self._keys
+
+    def sample(self, row, rng=None):
+        """Draws the id of the word following the history in row.
+
+        Returns -1 if the history has no following words.
+
+        Parameters
+        ----------
+        row: int
+            Row of the history in the model.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        start, end = self.offsets[row], self.offsets[row + 1]
+        if start == end:
+            return -1
+        u = _uniform(rng)()
+        return int(self.successors[start + self.cumulative[start:end].searchsorted(u, side="right")])
+
+    def generate_word(self, history, rng=None):
+        """Generates a word following history, or "" if the headline ends or history isn't in the model.
+
+        Histories missing from the model count as dead ends in instrumentation.
+
+        Parameters
+        ----------
+        history: tuple
+            A tuple of the ids of the last n observed words.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        row = self.histories.get(history)
+        if row is None:
+            instrumentation.count("model.dead_end_histories")
+            return ""
+        word_id = self.sample(row, rng)
+        if word_id < 0:
+            instrumentation.count("model.ended_headlines")
+            return ""
+        return self.vocab[word_id]
+
+    @instrumentation.timed("generate")
+    def generate_headline(self, rng=None):
+        """Generates a headline using the language model.
+
+        Parameters
+        ----------
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        # Following transitions from row to row over plain lists, so no history
+        # tuples or numpy scalars are allocated for each word
+        if self._row_lists is None:
+            self._row_lists = tuple(array.tolist() for array in (self.offsets, self.cumulative, self.successors, self.transitions))
+        offsets, cumulative, successors, transitions = self._row_lists
+        vocab = self.vocab
+        random_sample = _uniform(rng)
+        words = []
+        row = self.start_row
+        start, end = offsets[row], offsets[row + 1]
+        while start != end:
+            position = bisect_right(cumulative, random_sample(), start, end)
+            words.append(vocab[successors[position]])
+            row = transitions[position]
+            start, end = offsets[row], offsets[row + 1]
+        instrumentation.count("model.ended_headlines")
+        return word_tokenizer.detokenize(words)
+
+    def generate_batch(self, k, max_words=utils.MAX_WORDS, rng=None):
+        """Generates k headlines at once; see the generate_batch function.
+
+        Parameters
+        ----------
+        k: int
+            Number of headlines to generate.
+        max_words: int
+            Length after which headlines are no longer extended.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        return generate_batch(self.n, self, k, max_words, rng)
+
+    def score(self, headline):
+        """Returns how likely the model is to generate the words of headline.
+
+        The result has the number of words, the natural log probability of
+        drawing them in order (-inf if the model cannot generate them), the
+        perplexity per word (None for an empty headline), the number of words
+        not in the vocabulary, and the number of words drawn from a history the
+        model has never seen.
+
+        Parameters
+        ----------
+        headline: str
+            A cleaned headline.
+        """
+        scores = self.score_batch([headline])
+        score = {name: values[0].item() for name, values in scores.items()}
+        if score["words"] == 0:
+            score["perplexity"] = None
+        return score
+
+    @instrumentation.timed("score")
+    def score_batch(self, headlines, chunk_size=1000):
+        """Scores many headlines at once; see score.
+
+        Every word's history is found with one HistoryIndex lookup over all
+        words of a chunk of headlines, and every word's position within its
+        history's row with a second one, so nothing is looked up word by word
+        except the word ids themselves. Chunks keep the word lists and
+        temporary arrays small enough to stay in cache.
+
+        Returns a dictionary of arrays with one entry per headline, with the
+        same keys as score. Empty headlines have a perplexity of nan.
+
+        Parameters
+        ----------
+        headlines: list of strings
+            Cleaned headlines.
+        chunk_size: int
+            Number of headlines scored together.
+        """
+        chunks = [self._score_chunk(headlines[i:i + chunk_size]) for i in range(0, len(headlines), chunk_size)]
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            chunks = [self._score_chunk([])]
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+    def _score_chunk(self, headlines):
+        """Scores a list of headlines with vectorized lookups; see score_batch."""
+        tokens = [word_tokenizer.tokenize(headline, intern=False) for headline in headlines]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        total = int(lengths.sum())
+        ids = np.fromiter(map(self.word_ids.get, chain.from_iterable(tokens), repeat(-1)), dtype=np.int64, count=total)
+        # Laying the headlines out one after another, each behind n padding
+        # words, so the n ids before every word form its history
+        padded = np.full(total + self.n * len(tokens), self.word_ids[PAD], dtype=np.int64)
+        word_positions = np.arange(total) + self.n * np.repeat(np.arange(1, len(tokens) + 1), lengths)
+        padded[word_positions] = ids
+        histories = padded[np.add.outer(word_positions - self.n, np.arange(self.n))]
+        rows = self.histories.lookup(histories)
+        positions = self._lookup_successors(rows, ids)
+        found = positions >= 0
+        probabilities = np.zeros(total)
+        probabilities[found] = self.cumulative[positions[found]]
+        follows_previous = found & (positions > self.offsets[np.maximum(rows, 0)])
+        probabilities[follows_previous] -= self.cumulative[positions[follows_previous] - 1]
+        with np.errstate(divide="ignore"):
+            word_log_probabilities = np.where(found, np.log(probabilities), -np.inf)
+        headline_ids = np.repeat(np.arange(len(tokens)), lengths)
+        # bincount returns integers when there are no words at all
+        log_probability = np.bincount(headline_ids, weights=word_log_probabilities, minlength=len(tokens)).astype(np.float64)
+        # bincount adds -inf and finite weights into nan rather than -inf
+        log_probability[np.bincount(headline_ids, weights=~found, minlength=len(tokens)) > 0] = -np.inf
+        with np.errstate(divide="ignore", invalid="ignore"):
+            perplexity = np.exp(-log_probability / lengths)
+        return {
+            "words": lengths,
+            "log_probability": log_probability,
+            "perplexity": perplexity,
+            "unknown_words": np.bincount(headline_ids, weights=ids < 0, minlength=len(tokens)).astype(np.int64),
+            "unseen_histories": np.bincount(headline_ids, weights=rows < 0, minlength=len(tokens)).astype(np.int64)
+        }
+
+    def _lookup_successors(self, rows, word_ids):
+        """Returns the position of each word id in its row of successors, or -1 if it never follows that row.
+
+        Parameters
+        ----------
+        rows: numpy array
+            Rows of the histories, or -1 for unknown histories.
+        word_ids: numpy array
+            Word ids to find, or -1 for unknown words.
+        """
+        if self._successor_index is None:
+            # Sorting (row, successor) pairs, which are ordered by count within each row
+            pairs = np.repeat(np.arange(len(self.lengths)), self.lengths) * len(self.vocab) + self.successors
+            order = np.argsort(pairs, kind="stable")
+            self._successor_index = (len(self.vocab), pairs[order], order)
+        stride, sorted_pairs, order = self._successor_index
+        if len(sorted_pairs) == 0 or len(rows) == 0:
+            return np.full(len(rows), -1, dtype=np.int64)
+        queries = rows * stride + word_ids
+        positions = np.minimum(sorted_pairs.searchsorted(queries), len(sorted_pairs) - 1)
+        found = (rows >= 0) & (word_ids >= 0) & (word_ids < stride) & (sorted_pairs[positions] == queries)
+        return np.where(found, order[positions], -1)
+
+    def memory_report(self):
+        """Returns the bytes taken by each component of the model and their total.
+
+        The sampling keys built by generate_batch, the lists built by
+        generate_headline and the index built by score_batch are counted once
+        they exist.
+        """
+        return instrumentation.memory_report({
+            "vocab": self.vocab,
+            "word ids": self.word_ids,
+            "histories": self.histories,
+            "offsets": self.offsets,
+            "successors": self.successors,
+            "cumulative": self.cumulative,
+            "transitions": self.transitions,
+            "counts": self.counts,
+            "row lengths": self.lengths,
+            "sampling keys": self._keys,
+            "generate_headline lists": self._row_lists,
+            "score_batch index": self._successor_index
+        })
+
+    def view(self, n):
+        """Returns the model for n, which must be the value this model was trained with.
+
+        Parameters
+        ----------
+        n: int
+            Value of n for language model.
+        """
+        if n != self.n:
+            raise ValueError("Model was trained with n = {0}, not n = {1}.".format(self.n, n))
+        return self
+
+    @instrumentation.timed("update")
+    def add_headlines(self, headlines):
+        """Adds the grams of headlines to the model.
+
+        Only the rows of histories that occur in headlines are recounted and
+        renormalized; the rest of the model is copied over as is.
+
+        Parameters
+        ----------
+        headlines: iterable
+            Cleaned headlines to add.
+        """
+        self._update_rows(self._count_headlines(headlines, 1))
+
+    @instrumentation.timed("update")
+    def remove_headlines(self, headlines):
+        """Removes the grams of previously added headlines from the model.
+
+        Histories left without any following words become dead ends. Raises a
+        ValueError, leaving the model unchanged, if a headline was never added.
+
+        Parameters
+        ----------
+        headlines: iterable
+            Cleaned headlines to remove.
+        """
+        self._update_rows(self._count_headlines(headlines, -1))
+
+    def _count_headlines(self, headlines, sign):
+        """Returns the change in counts for every history in headlines.
+
+        Parameters
+        ----------
+        headlines: iterable
+            Cleaned headlines to count.
+        sign: int
+            1 when adding headlines, -1 when removing them.
+        """
+        if self.counts is None:
+            raise ValueError("Model was compiled without counts and cannot be updated.")
+        deltas = defaultdict(Counter)
+        for headline in headlines:
+            history = self.start_history
+            for word in word_tokenizer.tokenize(headline):
+                if word not in self.word_ids:
+                    if sign < 0:
+                        raise ValueError("`{}` is not in the model.".format(headline))
+                    self.word_ids[word] = len(self.vocab)
+                    self.vocab.append(word)
+                word_id = self.word_ids[word]
+                deltas[history][word_id] += sign
+                history = history[1:] + (word_id,)
+            deltas[history]
+        return deltas
+
+    def _update_rows(self, deltas):
+        """Applies changes in counts to the affected rows and repacks the arrays.
+
+        Parameters
+        ----------
+        deltas: dictionary
+            Maps histories to a Counter of changes in following word counts.
+        """
+        new_histories = {}
+        updated = {}
+        for history, delta in deltas.items():
+            row = self.histories.get(history)
+            if row is None:
+                row = new_histories.setdefault(history, len(self.histories) + len(new_histories))
+                counter = Counter()
+            else:
+                start, end = self.offsets[row], self.offsets[row + 1]
+                counter = Counter(dict(zip(self.successors[start:end].tolist(), self.counts[start:end].tolist())))
+            counter.update(delta)
+            if min(counter.values(), default=0) < 0:
+                raise ValueError("Cannot remove headlines that are not in the model.")
+            updated[row] = (history, +counter)
+        if new_histories:
+            self.histories = self.histories.extend(list(new_histories), len(self.vocab))
+
+        # Copying every untouched row over in one vectorized pass
+        old_rows = len(self.lengths)
+        lengths = np.zeros(len(self.histories), dtype=np.int64)
+        lengths[:old_rows] = self.lengths
+        changed = np.fromiter(updated, dtype=np.int64, count=len(updated))
+        lengths[changed] = [len(updated[row][1]) for row in changed.tolist()]
+        kept = np.ones(len(lengths), dtype=bool)
+        kept[changed] = False
+        old_positions = kept[:old_rows].repeat(self.lengths)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        new_positions = kept.repeat(lengths)
+        arrays = []
+        for old in (self.successors, self.cumulative, self.transitions, self.counts):
+            dtype = np.promote_types(old.dtype, _id_dtype(len(self.vocab))) if old is self.successors else old.dtype
+            new = np.empty(offsets[-1], dtype=dtype)
+            new[new_positions] = old[old_positions]
+            arrays.append(new)
+        self.successors, self.cumulative, self.transitions, self.counts = arrays
+
+        for row, (history, counter) in updated.items():
+            start, end = offsets[row], offsets[row + 1]
+            next_ids, next_counts, next_cumulative = _cumulative_counts(counter)
+            self.successors[start:end] = next_ids
+            self.transitions[start:end] = [self.histories[history[1:] + (word_id,)] for word_id in next_ids]
+            self.counts[start:end] = next_counts
+            self.cumulative[start:end] = next_cumulative
+        self.offsets = offsets
+        self._index_rows()
+
+def _compile_rows(n, vocab, rows):
+    """Packs rows of successors into a CompiledModel.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    vocab: list
+        A list of words, where each word's index is its id.
+    rows: iterable
+        Yields (history, successor ids, successor counts, cumulative probabilities)
+        for every row. Successor counts are None if they are not known.
+    """
+    histories = {}
+    offsets = [0]
+    successors = []
+    counts = []
+    cumulative = []
+    for history, next_ids, next_counts, next_cumulative in rows:
+        histories[history] = len(histories)
+        successors.extend(next_ids)
+        if next_counts is None:
+            counts = None
+        elif counts is not None:
+            counts.extend(next_counts)
+        cumulative.extend(next_cumulative)
+        offsets.append(len(successors))
+    transitions = []
+    for row, history in enumerate(histories):
+        next_ids = successors[offsets[row]:offsets[row + 1]]
+        transitions.extend(histories[history[1:] + (word_id,)] for word_id in next_ids)
+    return CompiledModel(
+        n,
+        vocab,
+        HistoryIndex(np.array(list(histories), dtype=_id_dtype(len(vocab))).reshape(-1, n)),
+        np.array(offsets, dtype=np.int32),
+        np.array(successors, dtype=_id_dtype(len(vocab))),
+        np.array(cumulative, dtype=np.float64),
+        np.array(transitions, dtype=np.int32),
+        None if counts is None else np.array(counts, dtype=np.int32)
+    )
+
+def compile_grams(n, headline_aggregate):
+    """Compiles the output of generate_grams into a CompiledModel.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    headline_aggregate: dictionary
+        A dictionary of histories and corresponding frequencies for following words.
+    """
+    word_ids = {PAD: 0}
+    intern = lambda word: word_ids.setdefault(word, len(word_ids))
+    rows = {}
+    for phrase, frequencies in headline_aggregate.items():
+        history = tuple(map(intern, phrase))
+        next_ids = [intern(word) for word, _ in frequencies]
+        next_cumulative = np.cumsum([p for _, p in frequencies])
+        next_cumulative[-1] = 1.0
+        rows[history] = (next_ids, None, next_cumulative)
+        for word_id in next_ids:
+            rows.setdefault(history[1:] + (word_id,), ([], None, []))
+    vocab = sorted(word_ids, key=word_ids.get)
+    return _compile_rows(n, vocab, ((history, *row) for history, row in rows.items()))
+
+@instrumentation.timed("train")
+def compile_entries(n, entries):
+    """Counts grams for every headline directly into a CompiledModel.
+
+    Produces the same distributions as compile_grams(n, generate_grams(n, entries))
+    without building the intermediate dictionaries of strings.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    entries: pandas DataFrame
+        A pandas Dataframe containing the Florida man headlines.
+    """
+    word_ids = {PAD: 0}
+    vocab = [PAD]
+    counts = defaultdict(Counter)
+    for headline in entries["title"]:
+        history = (0,) * n
+        for word_id in word_tokenizer.token_ids(headline, word_ids, vocab):
+            counts[history][word_id] += 1
+            history = history[1:] + (word_id,)
+        # Touching the final history gives it an empty row
+        counts[history]
+    return _compile_rows(n, vocab, ((history, *_cumulative_counts(counter)) for history, counter in counts.items()))
+
+def _cumulative_counts(counter):
+    """Returns the words of counter from most to least common with their counts and cumulative probabilities.
+
+    Parameters
+    ----------
+    counter: Counter
+        The aggregate counts of how often each following word shows up.
+    """
+    total = sum(counter.values())
+    next_ids = []
+    next_counts = []
+    next_cumulative = []
+    running = 0
+    for word_id, count in counter.most_common():
+        running += count
+        next_ids.append(word_id)
+        next_counts.append(count)
+        next_cumulative.append(running / total)
+    return next_ids, next_counts, next_cumulative
+
+# Word id marking the end of a headline in MultiOrderModel grams
+END = -1
+
+class MultiOrderModel:
+    """Gram counts for every value of n up to max_n, collected in one training pass.
+
+    Every position of every headline is stored once as a gram of max_n history
+    ids followed by the next word id (or END after the last word). The grams
+    are kept sorted and deduplicated with their counts, so the counts for any
+    smaller n are the sums over grams sharing their last n + 1 ids. This works
+    like a count trie over reversed histories, stored as flat arrays.
+
+    Views for each n are compiled from the counts on first use and cached, so
+    switching n never requires another pass over the training data.
+
+    Parameters
+    ----------
+    max_n: int
+        Largest value of n that views can be served for.
+    vocab: list
+        A list of words, where each word's index is its id.
+    grams: numpy array
+        Unique grams of shape (count, max_n + 1), sorted lexicographically.
+    counts: numpy array
+        Number of times each gram was observed.
+    """
+    def __init__(self, max_n, vocab, grams, counts):
+        self.max_n = max_n
+        self.vocab = vocab
+        self.word_ids = {word: i for i, word in enumerate(vocab)}
+        self.grams = grams
+        self.counts = counts
+        self.views = {}
+        self.backoff_views = {}
+        # Bumped by every update, so users of the model can tell it changed
+        self.version = 0
+        # Held while the model is updated; hold it to sample from views on another thread
+        self.lock = threading.RLock()
+
+    def view(self, n):
+        """Returns the CompiledModel for n, compiling it from the counts if needed.
+
+        Parameters
+        ----------
+        n: int
+            Value of n for language model.
+        """
+        if n not in self.views:
+            if not 1 <= n <= self.max_n:
+                raise ValueError("Model was trained for n up to {0}, not n = {1}.".format(self.max_n, n))
+            with instrumentation.timer("compile"):
+                self.views[n] = _compile_view(n, self.vocab, self.grams[:, self.max_n - n:], self.counts, self.word_ids)
+        return self.views[n]
+
+    def backoff(self, n, discount=0.75):
+        """Returns the BackoffModel for n and discount, building its tables from the counts if needed.
+
+        Parameters
+        ----------
+        n: int
+            Value of n for language model.
+        discount: float
+            Amount taken off each count, between 0 and 1.
+        """
+        if (n, discount) not in self.backoff_views:
+            if not 1 <= n <= self.max_n:
+                raise ValueError("Model was trained for n up to {0}, not n = {1}.".format(self.max_n, n))
+            with instrumentation.timer("compile"):
+                self.backoff_views[(n, discount)] = _compile_backoff(n, self.vocab, self.grams[:, self.max_n - n:], self.counts, discount)
+        return self.backoff_views[(n, discount)]
+
+    def memory_report(self):
+        """Returns the bytes taken by the counts, each cached view and their total.
+
+        Words shared with the views are counted in the model's vocab.
+        """
+        components = {"vocab": self.vocab, "word ids": self.word_ids, "grams": self.grams, "counts": self.counts}
+        for n, model in sorted(self.views.items()):
+            components["view {}".format(n)] = model
+        for (n, discount), model in sorted(self.backoff_views.items()):
+            components["backoff view {0} ({1})".format(n, discount)] = model
+        return instrumentation.memory_report(components)
+
+    def add_headlines(self, headlines):
+        """Adds the grams of headlines to the counts and to every cached view.
+
+        Parameters
+        ----------
+        headlines: iterable
+            Cleaned headlines to add.
+        """
+        headlines = list(headlines)
+        with self.lock:
+            grams = _headline_grams(self.max_n, headlines, self.word_ids, self.vocab)
+            self._merge(grams, np.ones(len(grams), dtype=np.int64))
+            self.backoff_views.clear()
+            for model in self.views.values():
+                model.add_headlines(headlines)
+            self.version += 1
+
+    def remove_headlines(self, headlines):
+        """Removes the grams of previously added headlines from the counts and every cached view.
+
+        Raises a ValueError, leaving the model unchanged, if a headline was never added.
+
+        Parameters
+        ----------
+        headlines: iterable
+            Cleaned headlines to remove.
+        """
+        headlines = list(headlines)
+        for headline in headlines:
+            if any(word not in self.word_ids for word in word_tokenizer.tokenize(headline)):
+                raise ValueError("`{}` is not in the model.".format(headline))
+        with self.lock:
+            grams = _headline_grams(self.max_n, headlines, self.word_ids, self.vocab)
+            self._merge(grams, -np.ones(len(grams), dtype=np.int64))
+            self.backoff_views.clear()
+            for model in self.views.values():
+                model.remove_headlines(headlines)
+            self.version += 1
+
+    def _merge(self, grams, counts):
+        """Adds counts for grams to the stored counts.
+
+        Parameters
+        ----------
+        grams: numpy array
+            Grams of shape (count, max_n + 1), in any order and possibly repeated.
+        counts: numpy array
+            Change in count for each gram.
+        """
+        grams, counts = _sum_grams(grams, counts)
+        # Only the changed grams are searched for; the stored ones stay sorted
+        positions = _search_grams(self.grams, grams)
+        matched = positions < len(self.grams)
+        matched[matched] = (self.grams[positions[matched]] == grams[matched]).all(axis=1)
+        matched_positions = positions[matched]
+        totals = self.counts[matched_positions] + counts[matched]
+        if (totals < 0).any() or (counts[~matched] < 0).any():
+            raise ValueError("Cannot remove headlines that are not in the model.")
+        # Snapshot counts are memory-mapped read-only
+        if not self.counts.flags.writeable:
+            self.counts = self.counts.copy()
+        self.counts[matched_positions] = totals
+        emptied = matched_positions[totals == 0]
+        if len(emptied):
+            self.grams = np.delete(self.grams, emptied, axis=0)
+            self.counts = np.delete(self.counts, emptied)
+        added = ~matched & (counts > 0)
+        if added.any():
+            # Removed rows before each insertion point shift it down
+            insert_at = positions[added] - emptied.searchsorted(positions[added])
+            dtype = np.promote_types(self.grams.dtype, grams.dtype)
+            self.grams = np.insert(self.grams.astype(dtype, copy=False), insert_at, grams[added], axis=0)
+            self.counts = np.insert(self.counts, insert_at, counts[added])
+
+@instrumentation.timed("train")
+def train_multi_order(max_n, entries):
+    """Counts grams for every n up to max_n in a single pass over entries.
+
+    Parameters
+    ----------
+    max_n: int
+        Largest value of n that the model can serve.
+    entries: pandas DataFrame
+        A pandas Dataframe containing the Florida man headlines.
+    """
+    word_ids = {PAD: 0}
+    vocab = [PAD]
+    grams = _headline_grams(max_n, entries["title"], word_ids, vocab)
+    grams, counts = _sum_grams(grams, np.ones(len(grams), dtype=np.int64))
+    return MultiOrderModel(max_n, vocab, grams, counts)
+
+@instrumentation.timed("train")
+def train_multi_order_ids(max_n, vocab, tokens, offsets):
+    """Counts grams like train_multi_order from headlines that are already token ids, e.g. from a corpus.Corpus.
+
+    Ids are renumbered in order of first appearance, so the model is the same
+    as train_multi_order gives for the same headlines.
+
+    Parameters
+    ----------
+    max_n: int
+        Largest value of n that the model can serve.
+    vocab: list
+        A list of tokens, where each token's index is its id. Id 0 is PAD.
+    tokens: numpy array
+        Token ids of every headline, one after the other.
+    offsets: numpy array
+        Start of each headline in tokens, followed by the total number of tokens.
+    """
+    unique_ids, first, inverse = np.unique(tokens, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    new_ids = np.empty(len(unique_ids), dtype=np.int32)
+    new_ids[order] = np.arange(1, len(unique_ids) + 1, dtype=np.int32)
+    # Each headline is laid out like in _headline_grams: max_n PADs, its ids and END
+    lengths = np.diff(offsets)
+    starts = np.arange(len(lengths), dtype=np.int64) * (max_n + 1) + offsets[:-1]
+    stream = np.zeros(starts[-1] + lengths[-1] + max_n + 1 if len(lengths) else 0, dtype=np.int32)
+    stream[np.repeat(starts + max_n - offsets[:-1], lengths) + np.arange(len(tokens))] = new_ids[inverse.reshape(-1)]
+    stream[starts + max_n + lengths] = END
+    gram_starts = np.repeat(starts - offsets[:-1] - np.arange(len(lengths)), lengths + 1) + np.arange(len(tokens) + len(lengths))
+    grams = stream[np.add.outer(gram_starts, np.arange(max_n + 1))]
+    grams, counts = _sum_grams(grams, np.ones(len(grams), dtype=np.int64))
+    return MultiOrderModel(max_n, [PAD] + [vocab[word_id] for word_id in unique_ids[order].tolist()], grams, counts)
+
+@instrumentation.timed("train")
+def train_multi_order_stream(max_n, chunks):
+    """Counts grams like train_multi_order from an iterable of lists of headlines.
+
+    Only one chunk of headlines is held at a time. Chunk counts are buffered
+    and folded into the totals whenever the buffer grows as large as the
+    totals, so memory stays proportional to the size of the model rather
+    than the size of the corpus.
+
+    Parameters
+    ----------
+    max_n: int
+        Largest value of n that the model can serve.
+    chunks: iterable
+        Yields lists of cleaned headlines, e.g. utils.stream_titles.
+    """
+    word_ids = {PAD: 0}
+    vocab = [PAD]
+    grams = np.empty((0, max_n + 1), dtype=np.int32)
+    counts = np.empty(0, dtype=np.int64)
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        chunk_grams = _headline_grams(max_n, chunk, word_ids, vocab)
+        buffered.append(_sum_grams(chunk_grams, np.ones(len(chunk_grams), dtype=np.int64)))
+        buffered_size += len(buffered[-1][0])
+        if buffered_size >= len(grams):
+            grams, counts = _sum_grams(
+                np.concatenate([grams] + [part[0] for part in buffered]),
+                np.concatenate([counts] + [part[1] for part in buffered])
+            )
+            buffered = []
+            buffered_size = 0
+    if buffered:
+        grams, counts = _sum_grams(
+            np.concatenate([grams] + [part[0] for part in buffered]),
+            np.concatenate([counts] + [part[1] for part in buffered])
+        )
+    return MultiOrderModel(max_n, vocab, grams, counts)
+
+@instrumentation.timed("train")
+def train_multi_order_parallel(max_n, entries, processes=None, shard_size=50000):
+    """Counts grams like train_multi_order, spreading the work across a process pool.
+
+    Each shard of headlines is counted with its own vocabulary in a worker.
+    Shard vocabularies are then merged in order, which assigns every word the
+    same id as the serial path, and the shard counts are summed pairwise in a
+    tree reduction. The result is identical to train_multi_order(max_n, entries).
+
+    Parameters
+    ----------
+    max_n: int
+        Largest value of n that the model can serve.
+    entries: pandas DataFrame
+        A pandas Dataframe containing the Florida man headlines.
+    processes: int
+        Number of worker processes. Defaults to the number of CPUs.
+    shard_size: int
+        Number of headlines counted by each task.
+    """
+    headlines = list(entries["title"])
+    shards = [headlines[i:i + shard_size] for i in range(0, len(headlines), shard_size)]
+    with Pool(processes) as pool:
+        results = pool.starmap(_count_shard, [(max_n, shard) for shard in shards])
+        word_ids = {PAD: 0}
+        vocab = [PAD]
+        parts = []
+        for shard_vocab, grams, counts in results:
+            mapping = []
+            for word in shard_vocab:
+                if word not in word_ids:
+                    word_ids[word] = len(vocab)
+                    vocab.append(word)
+                mapping.append(word_ids[word])
+            # END is -1, so appending it lets it map to itself
+            mapping.append(END)
+            parts.append((np.array(mapping, dtype=np.int32)[grams], counts))
+        while len(parts) > 1:
+            pairs = [(parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2)]
+            parts = pool.map(_merge_counts, pairs) + parts[len(pairs) * 2:]
+    if not parts:
+        parts = [(np.empty((0, max_n + 1), dtype=np.int32), np.empty(0, dtype=np.int64))]
+    grams, counts = _sum_grams(*parts[0])
+    return MultiOrderModel(max_n, vocab, grams, counts)
+
+def _count_shard(max_n, headlines):
+    """Counts the grams of a shard of headlines using a vocabulary local to the shard.
+
+    Parameters
+    ----------
+    max_n: int
+        Number of history ids in each gram.
+    headlines: list
+        Cleaned headlines to count.
+    """
+    word_ids = {PAD: 0}
+    vocab = [PAD]
+    grams = _headline_grams(max_n, headlines, word_ids, vocab)
+    grams, counts = _sum_grams(grams, np.ones(len(grams), dtype=np.int64))
+    return vocab, grams, counts
+
+def _merge_counts(pair):
+    """Sums two sets of gram counts.
+
+    Parameters
+    ----------
+    pair: tuple
+        Two (grams, counts) tuples sharing the same vocabulary.
+    """
+    (grams_1, counts_1), (grams_2, counts_2) = pair
+    return _sum_grams(np.concatenate([grams_1, grams_2]), np.concatenate([counts_1, counts_2]))
+
+def _headline_grams(max_n, headlines, word_ids, vocab):
+    """Returns every gram of max_n history ids and the following id in headlines.
+
+    New words are added to word_ids and vocab.
+
+    Parameters
+    ----------
+    max_n: int
+        Number of history ids in each gram.
+    headlines: iterable
+        Cleaned headlines to split into grams.
+    word_ids: dictionary
+        Maps words to their ids.
+    vocab: list
+        A list of words, where each word's index is its id.
+    """
+    stream = []
+    starts = []
+    for headline in headlines:
+        start = len(stream)
+        stream.extend([word_ids[PAD]] * max_n)
+        stream.extend(word_tokenizer.token_ids(headline, word_ids, vocab))
+        stream.append(END)
+        starts.extend(range(start, len(stream) - max_n))
+    stream = np.array(stream, dtype=np.int32)
+    if len(stream) <= max_n:
+        return np.empty((0, max_n + 1), dtype=np.int32)
+    return stream[np.add.outer(np.array(starts, dtype=np.int64), np.arange(max_n + 1))]
+
+def _sum_grams(grams, counts):
+    """Deduplicates grams, summing the counts of repeated grams.
+
+    Returns the unique grams sorted lexicographically with their total counts.
+
+    Parameters
+    ----------
+    grams: numpy array
+        Grams of shape (count, width).
+    counts: numpy array
+        Count for each gram.
+    """
+    if len(grams) == 0:
+        return grams, counts.astype(np.int64)
+    # Sorting by the first column last makes it the primary key
+    order = np.lexsort(grams.T[::-1])
+    grams, counts = grams[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], (grams[1:] != grams[:-1]).any(axis=1)]))
+    return grams[starts], np.add.reduceat(counts, starts).astype(np.int64)
+
+def _search_grams(grams, queries):
+    """Returns where each of queries would be inserted into grams to keep them sorted, like searchsorted.
+
+    Every query is bisected over the rows at once, comparing rows by their
+    first differing column, so finding a few grams takes a few passes over
+    them rather than a sort of grams.
+
+    Parameters
+    ----------
+    grams: numpy array
+        Grams of shape (count, width), sorted lexicographically.
+    queries: numpy array
+        Grams to find, of shape (queries, width).
+    """
+    queries = queries.astype(np.int64)
+    low = np.zeros(len(queries), dtype=np.int64)
+    high = np.full(len(queries), len(grams), dtype=np.int64)
+    active = np.flatnonzero(low < high)
+    while active.size:
+        middle = (low[active] + high[active]) // 2
+        rows, targets = grams[middle].astype(np.int64), queries[active]
+        differs = rows != targets
+        column = differs.argmax(axis=1)
+        items = np.arange(active.size)
+        below = differs[items, column] & (rows[items, column] < targets[items, column])
+        low[active[below]] = middle[below] + 1
+        high[active[~below]] = middle[~below]
+        active = active[low[active] < high[active]]
+    return low
+
+def _compile_view(n, vocab, grams, counts, word_ids=None):
+    """Compiles grams of n history ids and a following id into a CompiledModel.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    vocab: list
+        A list of words, where each word's index is its id.
+    grams: numpy array
+        Grams of shape (count, n + 1), possibly repeated.
+    counts: numpy array
+        Count for each gram.
+    word_ids: dictionary
+        Maps words to their ids in vocab, or None to build it.
+    """
+    grams, counts = _sum_grams(grams, counts)
+    history_grams, rows = np.unique(grams[:, :n], axis=0, return_inverse=True)
+    # Numbering rows in the order of their hashes, so HistoryIndex needs no separate order
+    by_hash = np.argsort(_history_hashes(history_grams), kind="stable")
+    rank = np.empty_like(by_hash)
+    rank[by_hash] = np.arange(len(by_hash))
+    history_grams = history_grams[by_hash]
+    rows = rank[rows.reshape(-1)]
+    # END grams only give histories at the end of a headline a row
+    is_word = grams[:, n] != END
+    grams, counts, rows = grams[is_word], counts[is_word], rows[is_word]
+    order = np.lexsort((-counts, rows))
+    grams, counts, rows = grams[order], counts[order], rows[order]
+
+    offsets = np.zeros(len(history_grams) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(history_grams)), out=offsets[1:])
+    running = np.cumsum(counts)
+    before_row = np.concatenate([[0], running])[offsets[:-1]]
+    totals = np.concatenate([[0], running])[offsets[1:]] - before_row
+    cumulative = (running - before_row[rows]) / totals[rows]
+
+    # Every gram's next history is also a history, so the unique histories
+    # are unchanged by adding them and their inverse gives each transition
+    next_histories = np.concatenate([history_grams, grams[:, 1:]])
+    transitions = rank[np.unique(next_histories, axis=0, return_inverse=True)[1].reshape(-1)[len(history_grams):]]
+
+    return CompiledModel(
+        n,
+        vocab,
+        HistoryIndex(history_grams.astype(_id_dtype(len(vocab)))),
+        offsets.astype(np.int32),
+        grams[:, n].astype(_id_dtype(len(vocab))),
+        cumulative,
+        transitions.astype(np.int32),
+        counts.astype(np.int32),
+        word_ids
+    )
+
+@instrumentation.timed("generate")
+def generate_batch(n, model, k, max_words=utils.MAX_WORDS, rng=None):
+    """Generates k headlines at once, advancing all of them one word per step.
+
+    Each step draws the next word for every unfinished headline with a single
+    vectorized searchsorted. Headlines that run past max_words are cut off after
+    max_words + 1 words, which keeps cycles in the model from running forever
+    while still failing validation.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    model: CompiledModel or MultiOrderModel
+        The trained n-grams language model.
+    k: int
+        Number of headlines to generate.
+    max_words: int
+        Length after which headlines are no longer extended.
+    rng: numpy Generator
+        Source of randomness. Defaults to numpy's global random state.
+    """
+    model = model.view(n)
+    random_sample = _uniform(rng)
+    rows = np.full(k, model.start_row, dtype=np.int64)
+    words = np.full((k, max_words + 1), -1, dtype=np.int64)
+    active = np.flatnonzero(model.lengths[rows] > 0)
+    for step in range(max_words + 1):
+        if active.size == 0:
+            break
+        active_rows = rows[active]
+        positions = model.keys.searchsorted(active_rows + random_sample(active.size), side="right")
+        # Rounding can push draws close to 1 past the end of large rows
+        np.minimum(positions, model.offsets[active_rows + 1] - 1, out=positions)
+        words[active, step] = model.successors[positions]
+        rows[active] = model.transitions[positions]
+        active = active[model.lengths[rows[active]] > 0]
+    if instrumentation.enabled:
+        instrumentation.count("model.ended_headlines", k - active.size)
+        instrumentation.count("model.cut_off_at_max_words", active.size)
+    vocab = np.array(model.vocab, dtype=object)
+    return [word_tokenizer.detokenize(vocab[headline[headline >= 0]]) for headline in words]
+
+def generate_bulk(sampler, count, seed, processes=None, chunk_size=10000):
+    """Yields count headlines from sampler in lists of chunk_size, generating the chunks in a process pool.
+
+    Chunk i is generated from the i-th seed spawned from SeedSequence(seed), so
+    the headlines depend only on the sampler, count, seed and chunk_size, and
+    are identical for any number of processes. Chunks are yielded in order, and
+    only a few chunks per process are generated ahead of the caller, which
+    keeps memory bounded for any count.
+
+    Parameters
+    ----------
+    sampler: CompiledModel, ConstrainedSampler or BackoffModel
+        Anything with a generate_batch(k, rng=rng) method.
+    count: int
+        Number of headlines to generate, or None to keep yielding chunks until the caller stops.
+    seed: int
+        Seed the chunks' random generators are spawned from.
+    processes: int
+        Number of worker processes. Defaults to the number of CPUs; 1 generates in this process.
+    chunk_size: int
+        Number of headlines generated by each task.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    sizes = repeat(chunk_size) if count is None else (min(chunk_size, count - start) for start in range(0, count, chunk_size))
+    # Spawning one seed at a time gives the same seeds as spawning them all at once
+    tasks = ((size, seed_sequence.spawn(1)[0]) for size in sizes)
+    if processes == 1:
+        _set_bulk_sampler(sampler)
+        for task in tasks:
+            yield _generate_chunk(task)
+        return
+    with Pool(processes, initializer=_set_bulk_sampler, initargs=(sampler,)) as pool:
+        in_flight = 2 * (processes or os.cpu_count() or 1)
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_generate_chunk, (task,)))
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+# Sampler used by generate_bulk in the current process
+_bulk_sampler = None
+
+def _set_bulk_sampler(sampler):
+    global _bulk_sampler
+    _bulk_sampler = sampler
+
+def _generate_chunk(task):
+    """Generates one chunk of generate_bulk from its size and seed."""
+    size, seed_sequence = task
+    return _bulk_sampler.generate_batch(size, rng=np.random.default_rng(seed_sequence))
+
+class ConstrainedSampler:
+    """Generates headlines that are guaranteed to satisfy the length and phrase constraints.
+
+    For every step t, row and phrase progress s, table[t, s, row] holds the
+    probability that the model, continuing from that state, finishes a headline
+    of between min_words and max_words words containing phrase. Sampling each
+    word in proportion to its probability times the table entry it leads to
+    draws from exactly the distribution of model headlines that pass those
+    checks, without generating the ones that would fail. Only the novelty of
+    generated headlines still has to be checked afterwards.
+
+    Progress through phrase is tracked at word level the same way the substring
+    check in utils.validate_headline sees it: the first phrase word may end a
+    word, the last one may start one, and any in between must match exactly.
+    Phrases are assumed not to overlap with themselves.
+
+    Words are counted as tokens, which is how utils.validate_headline counts
+    them only with the `whitespace` tokenizer rules; the `words` rules join
+    punctuation and quotes onto words, so with them a ValueError is raised and
+    headlines have to be generated from the model and validated instead.
+
+    Parameters
+    ----------
+    model: CompiledModel
+        The trained n-grams language model.
+    min_words: int
+        Fewest words a headline may have.
+    max_words: int
+        Most words a headline may have.
+    phrase: str
+        Phrase every headline must contain.
+    """
+    def __init__(self, model, min_words=utils.MIN_WORDS, max_words=utils.MAX_WORDS, phrase="florida man"):
+        if word_tokenizer.rules != "whitespace":
+            raise ValueError("Constrained sampling needs the `whitespace` tokenizer rules, not `{}`.".format(word_tokenizer.rules))
+        self.model = model
+        self.min_words = min_words
+        self.max_words = max_words
+        phrase_words = word_tokenizer.tokenize(phrase)
+        self.phrase_length = len(phrase_words)
+
+        # steps[s, position] is the phrase progress after picking the successor at position
+        vocab_steps = _phrase_steps(model.vocab, phrase_words)
+        self.steps = vocab_steps[:, model.successors]
+        row_of_position = np.repeat(np.arange(len(model.lengths)), model.lengths)
+        self.probabilities = np.diff(np.concatenate([[0.0], model.cumulative]))
+        row_starts = model.offsets[:-1][model.lengths > 0]
+        self.probabilities[row_starts] = model.cumulative[row_starts]
+
+        rows = len(model.lengths)
+        is_end = model.lengths == 0
+        self.table = np.zeros((max_words + 2, self.phrase_length + 1, rows))
+        for t in range(max_words, -1, -1):
+            for s in range(self.phrase_length + 1):
+                following = self.table[t + 1, self.steps[s], model.transitions]
+                self.table[t, s] = np.bincount(row_of_position, weights=self.probabilities * following, minlength=rows)
+                if s == self.phrase_length and t >= min_words:
+                    self.table[t, s, is_end] = 1.0
+        # Probability that an unconstrained headline would satisfy the constraints
+        self.acceptance_probability = self.table[0, 0, model.start_row]
+
+    @instrumentation.timed("generate")
+    def generate_batch(self, k, rng=None):
+        """Generates k headlines that satisfy the constraints.
+
+        Parameters
+        ----------
+        k: int
+            Number of headlines to generate.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        if self.acceptance_probability == 0:
+            raise ValueError("The model cannot generate any headline satisfying the constraints.")
+        model = self.model
+        random_sample = _uniform(rng)
+        rows = np.full(k, model.start_row, dtype=np.int64)
+        states = np.zeros(k, dtype=np.int64)
+        words = np.full((k, self.max_words), -1, dtype=np.int64)
+        active = np.flatnonzero(model.lengths[rows] > 0)
+        for t in range(self.max_words):
+            if active.size == 0:
+                break
+            # Laying out the successors of every active row back to back
+            active_rows = rows[active]
+            lengths = model.lengths[active_rows]
+            block_starts = np.cumsum(lengths) - lengths
+            item = np.repeat(np.arange(active.size), lengths)
+            positions = model.offsets[active_rows][item] + np.arange(len(item)) - block_starts[item]
+            next_states = self.steps[states[active][item], positions]
+            weights = self.probabilities[positions] * self.table[t + 1, next_states, model.transitions[positions]]
+
+            running = np.cumsum(weights)
+            before = np.concatenate([[0.0], running])[block_starts]
+            totals = running[block_starts + lengths - 1] - before
+            choices = running.searchsorted(before + random_sample(active.size) * totals, side="right")
+            np.clip(choices, block_starts, block_starts + lengths - 1, out=choices)
+
+            chosen = positions[choices]
+            words[active, t] = model.successors[chosen]
+            rows[active] = model.transitions[chosen]
+            states[active] = next_states[choices]
+            active = active[model.lengths[rows[active]] > 0]
+        vocab = np.array(model.vocab, dtype=object)
+        return [word_tokenizer.detokenize(vocab[headline[headline >= 0]]) for headline in words]
+
+def build_sampler(model, n, backoff=False):
+    """Returns the sampler of model for n, with backoff to shorter histories if backoff is set.
+
+    Raises a ValueError if, without backoff, the model can't generate any
+    headline satisfying the constraints.
+
+    Parameters
+    ----------
+    model: MultiOrderModel
+        The trained n-grams language model.
+    n: int
+        Value of n for language model.
+    backoff: bool
+        Whether to sample with backoff to shorter histories.
+    """
+    if backoff:
+        return model.backoff(n)
+    sampler = ConstrainedSampler(model.view(n))
+    if sampler.acceptance_probability == 0:
+        raise ValueError("The model cannot generate headlines between {0} and {1} words that contain `florida man` with n = {2}.".format(utils.MIN_WORDS, utils.MAX_WORDS, n))
+    return sampler
+
+def _phrase_steps(vocab, phrase_words):
+    """Returns the phrase progress after each word for every amount of progress before it.
+
+    Parameters
+    ----------
+    vocab: list
+        A list of words, where each word's index is its id.
+    phrase_words: list
+        The words of the required phrase.
+    """
+    m = len(phrase_words)
+    first, last = phrase_words[0], phrase_words[-1]
+    if m == 1:
+        restart = np.array([m if first in word else 0 for word in vocab], dtype=np.int64)
+    else:
+        restart = np.array([1 if word.endswith(first) else 0 for word in vocab], dtype=np.int64)
+    steps = np.empty((m + 1, len(vocab)), dtype=np.int64)
+    steps[0] = restart
+    for s in range(1, m):
+        if s < m - 1:
+            matches = np.array([word == phrase_words[s] for word in vocab], dtype=bool)
+        else:
+            matches = np.array([word.startswith(last) for word in vocab], dtype=bool)
+        steps[s] = np.where(matches, s + 1, restart)
+    steps[m] = m
+    return steps
+
+class BackoffModel:
+    """Samples headlines with absolute-discounting backoff from precomputed tables for every order up to n.
+
+    Table m holds every history of m word ids with the counts of the words,
+    and of END, that followed it. A discount is taken off every count, and the
+    mass it frees, discount * distinct followers / total count, is the chance
+    of backing off from a history to its suffix of m - 1 ids in table m - 1.
+
+    Table 1, which has a row for every word, is the last resort and is not
+    discounted; backing off further to single word frequencies would mostly
+    produce word salad. Each step starts at the longest suffix of the last n
+    words that is in a table, so histories never seen as a whole back off
+    instead of ending the headline, and headlines only end by drawing END. Backing off also mixes in
+    continuations never seen after the full history, so far fewer headlines
+    repeat the training data word for word. All lookups and draws are
+    vectorized over the batch; the tables are never rebuilt while sampling.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    vocab: list
+        A list of words, where each word's index is its id.
+    tables: list
+        A BackoffTable for every order from 1 to n, indexed by order; tables[0] is None.
+    discount: float
+        Amount taken off each count, between 0 and 1.
+    """
+    def __init__(self, n, vocab, tables, discount):
+        self.n = n
+        self.vocab = vocab
+        self.tables = tables
+        self.discount = discount
+        self.pad_id = vocab.index(PAD)
+
+    def longest_histories(self, contexts):
+        """Returns the order and row of the longest suffix of each context that is in a table.
+
+        Parameters
+        ----------
+        contexts: numpy array
+            The last n word ids of each headline, of shape (count, n).
+        """
+        orders = np.ones(len(contexts), dtype=np.int64)
+        rows = self.tables[1].lookup(contexts[:, -1:])
+        for m in range(2, self.n + 1):
+            found_rows = self.tables[m].lookup(contexts[:, self.n - m:])
+            found = found_rows >= 0
+            orders[found] = m
+            rows[found] = found_rows[found]
+        return orders, rows
+
+    @instrumentation.timed("generate")
+    def generate_batch(self, k, max_words=utils.MAX_WORDS, rng=None):
+        """Generates k headlines at once, advancing all of them one word per step.
+
+        Headlines that run past max_words are cut off after max_words + 1 words,
+        like in generate_batch.
+
+        Parameters
+        ----------
+        k: int
+            Number of headlines to generate.
+        max_words: int
+            Length after which headlines are no longer extended.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        random_sample = _uniform(rng)
+        contexts = np.full((k, self.n), self.pad_id, dtype=np.int64)
+        words = np.full((k, max_words + 1), -1, dtype=np.int64)
+        active = np.arange(k)
+        backoffs = 0
+        for step in range(max_words + 1):
+            if active.size == 0:
+                break
+            orders, rows = self.longest_histories(contexts[active])
+            for m in range(self.n, 1, -1):
+                at = np.flatnonzero(orders == m)
+                back = at[random_sample(at.size) < self.tables[m].backoff[rows[at]]]
+                rows[back] = self.tables[m].suffix_rows[rows[back]]
+                orders[back] = m - 1
+                backoffs += back.size
+            next_words = np.empty(active.size, dtype=np.int64)
+            for m in range(1, self.n + 1):
+                at = np.flatnonzero(orders == m)
+                next_words[at] = self.tables[m].sample(rows[at], rng)
+            is_word = next_words != END
+            active = active[is_word]
+            words[active, step] = next_words[is_word]
+            contexts[active, :-1] = contexts[active, 1:]
+            contexts[active, -1] = next_words[is_word]
+        if instrumentation.enabled:
+            instrumentation.count("model.backoffs", backoffs)
+            instrumentation.count("model.cut_off_at_max_words", active.size)
+        vocab = np.array(self.vocab, dtype=object)
+        return [word_tokenizer.detokenize(vocab[headline[headline >= 0]]) for headline in words]
+
+    def generate_headline(self, rng=None):
+        """Generates a headline using the language model.
+
+        Parameters
+        ----------
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        return self.generate_batch(1, rng=rng)[0]
+
+class BackoffTable:
+    """The histories of one order of a BackoffModel with their discounted follower distributions.
+
+    Rows are laid out CSR-style like in CompiledModel, with successors that
+    may be END. Histories are found by a sorted array of 64-bit hashes, so a
+    batch of lookups is a single searchsorted.
+
+    Parameters
+    ----------
+    histories: numpy array
+        Unique histories of shape (rows, m), sorted lexicographically.
+    offsets: numpy array
+        Row boundaries into successors and cumulative, of length rows + 1.
+    successors: numpy array
+        Word ids (or END) of every following word, grouped by row.
+    cumulative: numpy array
+        Cumulative discounted probabilities of the following words within each row.
+    backoff: numpy array
+        Probability of backing off from each row.
+    suffix_rows: numpy array
+        Row of each history's suffix of m - 1 ids in the table one order lower, or -1 in table 1.
+    """
+    def __init__(self, histories, offsets, successors, cumulative, backoff, suffix_rows):
+        self.histories = histories
+        self.offsets = offsets
+        self.successors = successors
+        self.cumulative = cumulative
+        self.backoff = backoff
+        self.suffix_rows = suffix_rows
+        lengths = np.diff(offsets)
+        self.keys = cumulative + np.repeat(np.arange(len(lengths)), lengths)
+        hashes = _history_hashes(histories)
+        self.hash_order = np.argsort(hashes, kind="stable")
+        self.sorted_hashes = hashes[self.hash_order]
+
+    def lookup(self, queries):
+        """Returns the row of each history in queries, or -1 for histories not in the table.
+
+        Parameters
+        ----------
+        queries: numpy array
+            Histories of shape (count, m).
+        """
+        return _find_rows(self.sorted_hashes, self.hash_order, self.histories, queries)
+
+    def sample(self, rows, rng=None):
+        """Draws the id of a word (or END) following each row from its discounted distribution.
+
+        Parameters
+        ----------
+        rows: numpy array
+            Rows to draw from.
+        rng: numpy Generator
+            Source of randomness. Defaults to numpy's global random state.
+        """
+        positions = self.keys.searchsorted(rows + _uniform(rng)(len(rows)), side="right")
+        np.minimum(positions, self.offsets[rows + 1] - 1, out=positions)
+        return self.successors[positions]
+
+# Multiplier of the polynomial history hash, and the mask that keeps Python ints to its 64 bits
+_HASH_MULTIPLIER = 0x100000001b3
+_HASH_MASK = 2 ** 64 - 1
+
+def _history_hashes(histories):
+    """Returns a 64-bit polynomial hash of each row of histories."""
+    hashes = np.zeros(len(histories), dtype=np.uint64)
+    for column in histories.T:
+        # Widening before adding, so narrow ids can't wrap around
+        hashes = hashes * np.uint64(_HASH_MULTIPLIER) + column.astype(np.int64).astype(np.uint64) + np.uint64(2)
+    return hashes
+
+def _find_rows(sorted_hashes, order, histories, queries):
+    """Returns the row of each history in queries, or -1 for histories without one.
+
+    Every row whose hash equals a query's is compared with it, so a hash
+    collision can't hide the row that matches. Runs of equal hashes almost
+    always hold a single row, so this is one pass in practice.
+
+    Parameters
+    ----------
+    sorted_hashes: numpy array
+        The sorted hashes of histories.
+    order: numpy array
+        The row of each sorted hash, or None if rows are in hash order.
+    histories: numpy array
+        The history of each row.
+    queries: numpy array
+        Histories to find, of the same width as histories.
+    """
+    hashes = _history_hashes(queries)
+    starts = sorted_hashes.searchsorted(hashes)
+    ends = sorted_hashes.searchsorted(hashes, side="right")
+    found = np.full(len(queries), -1, dtype=np.int64)
+    pending = np.flatnonzero(ends > starts)
+    offset = 0
+    while pending.size:
+        positions = starts[pending] + offset
+        rows = positions if order is None else order[positions].astype(np.int64)
+        match = (histories[rows] == queries[pending]).all(axis=1)
+        found[pending[match]] = rows[match]
+        offset += 1
+        pending = pending[~match & (starts[pending] + offset < ends[pending])]
+    return found
+
+def _id_dtype(vocab_size):
+    """Returns the narrowest integer type that holds the ids of vocab_size words."""
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max else np.int32
+
+def _compile_backoff(n, vocab, grams, counts, discount):
+    """Builds a BackoffModel from grams of n history ids and a following id (or END).
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    vocab: list
+        A list of words, where each word's index is its id.
+    grams: numpy array
+        Grams of shape (count, n + 1), possibly repeated.
+    counts: numpy array
+        Count for each gram.
+    discount: float
+        Amount taken off each count, between 0 and 1.
+    """
+    if not 0 <= discount < 1:
+        raise ValueError("Discount must be at least 0 and less than 1, not {}.".format(discount))
+    tables = [None]
+    for m in range(1, n + 1):
+        order_grams, order_counts = _sum_grams(grams[:, n - m:], counts)
+        starts = np.flatnonzero(np.concatenate([[True], (order_grams[1:, :m] != order_grams[:-1, :m]).any(axis=1)]))
+        offsets = np.append(starts, len(order_grams)).astype(np.int64)
+        lengths = np.diff(offsets)
+        rows = np.repeat(np.arange(len(starts)), lengths)
+        totals = np.add.reduceat(order_counts, starts)
+        # Order 1 is the last resort, so nothing is discounted there
+        order_discount = discount if m > 1 else 0.0
+        discounted = order_counts - order_discount
+        backoff = order_discount * lengths / totals
+        running = np.cumsum(discounted)
+        before_row = np.concatenate([[0.0], running])[starts]
+        cumulative = (running - before_row[rows]) / (totals - order_discount * lengths)[rows]
+        histories = order_grams[starts, :m]
+        suffix_rows = np.full(len(starts), -1, dtype=np.int64) if m == 1 else tables[m - 1].lookup(histories[:, 1:])
+        tables.append(BackoffTable(histories, offsets, order_grams[:, m].astype(np.int64), cumulative, backoff, suffix_rows))
+    return BackoffModel(n, vocab, tables, discount)
@@ -0,0 +1,131 @@
+"""
+Stores every page the scrapers fetch in a compressed, content-addressed cache
+in ./page_cache, so pages can be re-extracted later without a browser or network.
+
+Page contents are gzipped into `objects/<hash[:2]>/<hash>.gz`, named by the
+sha256 of the page, so a page fetched many times unchanged is stored once.
+`index.jsonl` records every fetch as a line with the URL, fetch time and hash.
+"""
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+cache_directory = "page_cache/"
+
+class PageCache:
+    """A content-addressed cache of fetched pages, keyed by URL and fetch time.
+
+    Parameters
+    ----------
+    directory: string
+        Directory the cache is stored in. Created if it does not exist.
+    """
+    def __init__(self, directory=cache_directory):
+        self.directory = directory
+        self.index_filename = os.path.join(directory, "index.jsonl")
+        self.fetches = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        fetch = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted write
+                        continue
+                    self.fetches.setdefault(fetch["url"], []).append((fetch["fetched_at"], fetch["sha256"]))
+        for fetches in self.fetches.values():
+            fetches.sort()
+
+    def _object_filename(self, sha256):
+        return os.path.join(self.directory, "objects", sha256[:2], sha256 + ".gz")
+
+    def store(self, url, page, fetched_at=None):
+        """Stores page as fetched from url at fetched_at and returns its hash.
+
+        Parameters
+        ----------
+        url: string
+            URL, or other key such as a search result page, the page was fetched from.
+        page: string
+            HTML of the page.
+        fetched_at: string
+            Fetch time as an ISO 8601 UTC timestamp. Defaults to now.
+        """
+        if fetched_at is None:
+            fetched_at = datetime.now(timezone.utc).isoformat()
+        content = page.encode("utf-8")
+        sha256 = hashlib.sha256(content).hexdigest()
+        filename = self._object_filename(sha256)
+        if not os.path.isfile(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            temporary_filename = "{0}.tmp{1}.{2}".format(filename, os.getpid(), threading.get_ident())
+            with open(temporary_filename, "wb") as f:
+                f.write(gzip.compress(content))
+            os.replace(temporary_filename, filename)
+        with self.lock:
+            with open(self.index_filename, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"url": url, "fetched_at": fetched_at, "sha256": sha256}) + "\n")
+            fetches = self.fetches.setdefault(url, [])
+            fetches.append((fetched_at, sha256))
+            fetches.sort()
+        return sha256
+
+    def get(self, url, at=None):
+        """Returns the page most recently fetched from url, or None if it was never fetched.
+
+        Parameters
+        ----------
+        url: string
+            URL or other key the page was stored under.
+        at: string
+            ISO 8601 UTC timestamp. If given, returns the latest page fetched at or before it.
+        """
+        fetches = [fetch for fetch in self.fetches.get(url, ()) if at is None or fetch[0] <= at]
+        if not fetches:
+            return None
+        with open(self._object_filename(fetches[-1][1]), "rb") as f:
+            return gzip.decompress(f.read()).decode("utf-8")
+
+    def fetch_times(self, url):
+        """Returns the times url was fetched, oldest first.
+
+        Parameters
+        ----------
+        url: string
+            URL or other key the page was stored under.
+        """
+        return [fetched_at for fetched_at, _ in self.fetches.get(url, ())]
+
+    def __contains__(self, url):
+        return url in self.fetches
+
+    def record(self, pages):
+        """Stores every (url, page) pair of the iterable pages, passing them on as they come.
+
+        Parameters
+        ----------
+        pages: iterable of pairs
+            (url, page) pairs, such as those a scraper's browse function yields.
+        """
+        for url, page in pages:
+            self.store(url, page)
+            yield url, page
+
+    def replay(self, urls):
+        """Yields (url, page) pairs for each of urls from the cache, stopping at the first one missing.
+
+        Parameters
+        ----------
+        urls: iterable of strings
+            URLs or other keys in the order they were fetched.
+        """
+        for url in urls:
+            page = self.get(url)
+            if page is None:
+                return
+            yield url, page
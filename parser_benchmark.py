@@ -0,0 +1,206 @@
+"""
+Benchmarks each parser backend on every site's extractor over a directory of
+saved HTML fixtures, checks that all backends return identical records, and
+reports the results as JSON.
+
+Fixtures are read from `<fixtures>/<site>/*.html`, where site is one of
+parsers.SITES. Without saved pages, `--synthetic` writes pages with each site's
+markup and the shipped headlines to a temporary directory instead, plus one
+malformed page per site so backends that repair HTML differently show up as
+mismatches.
+
+Example:
+    python parser_benchmark.py --fixtures fixtures/ --backends lxml selector --output parsers.json
+"""
+import argparse
+import config
+from html import escape
+import json
+import os
+import parsers
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import utils
+
+# Markup of one headline for each site, filled in with its escaped title and link
+SYNTHETIC_HEADLINES = {
+    "floridaman": (
+        "<article class=\"post type-post\"><div class=\"entry-thumb\"><img src=\"{link}thumb.jpg\" alt=\"\"></div>"
+        "<h3 class=\"entry-title td-module-title\"><a href=\"{link}\" rel=\"bookmark\" title=\"{title}\">{title}</a></h3>"
+        "<div class=\"td-module-meta-info\"><span class=\"td-post-date\"><time datetime=\"2020-08-08\">August 8, 2020</time></span></div></article>\n"
+    ),
+    "cbs_miami_search": (
+        "<div class=\"gsc-webResult gsc-result\"><div class=\"gs-title\">"
+        "<a class=\"gs-title\" href=\"{link}\" target=\"_self\" dir=\"ltr\"><b>Florida Man</b> {title}</a></div>"
+        "<div class=\"gs-bidi-start-align gs-snippet\" dir=\"ltr\">{title} &hellip;</div></div>\n"
+    ),
+    "local10": (
+        "<div class=\"queryly_item\"><a href=\"{link}\"><div class=\"queryly_item_imagecontainer\"></div>"
+        "<div class=\"queryly_item_title\">\n  {title}\n</div><div class=\"queryly_item_description\">{title}<br/>More</div></a></div>\n"
+    )
+}
+
+# The same markup with tags left open inside the elements the extractors read
+MALFORMED_HEADLINES = {
+    "floridaman": (
+        "<article class=\"post type-post\"><h3 class=\"entry-title td-module-title\">"
+        "<a href=\"{link}\" rel=\"bookmark\">{title} <b>Exclusive</a></h3>"
+        "<div class=\"td-module-meta-info\"><span class=\"td-post-date\">August 8, 2020</span></div></article>\n"
+    ),
+    "cbs_miami_search": (
+        "<div class=\"gsc-webResult gsc-result\"><div class=\"gs-title\">"
+        "<a class=\"gs-title\" href=\"{link}\" target=\"_self\" dir=\"ltr\"><b>Florida Man {title}</a></div></div>\n"
+    ),
+    "local10": (
+        "<div class=\"queryly_item\"><a href=\"{link}\"><div class=\"queryly_item_title\">\n  <span>{title}\n</div>"
+        "<div class=\"queryly_item_description\">{title}<br/>More</div></a></div>\n"
+    )
+}
+
+def write_synthetic_fixtures(directory, pages, headlines_per_page=20):
+    """Writes pages synthetic pages for each site to directory, using the shipped headlines.
+
+    Pages are padded with navigation, scripts and styles like the real sites,
+    so their sizes and tag counts are realistic. Each site also gets a page
+    of MALFORMED_HEADLINES, written as `malformed.html`.
+
+    Parameters
+    ----------
+    directory: string
+        Directory to write a subdirectory of fixtures for each site into.
+    pages: int
+        Number of pages for each site.
+    headlines_per_page: int
+        Number of headlines on each listing page.
+    """
+    entries = utils.load_files(config.training_directory, sorted(f for f in os.listdir(config.training_directory) if f.endswith(".csv")))
+    rows = list(zip(entries["title"].tolist(), entries["link"].tolist()))
+    padding = (
+        "<head><meta charset=\"utf-8\"><title>Search</title><style>.nav a{color:#333}</style>"
+        "<script>window.dataLayer = window.dataLayer || []; if (a < b && c) {}</script></head>\n"
+        + "".join("<nav><ul>" + "".join("<li><a href=\"/section/{0}/{1}\">Section {1}</a>".format(i, j) for j in range(30)) + "</ul></nav>\n" for i in range(5))
+    )
+    for site in parsers.SITES:
+        os.makedirs(os.path.join(directory, site))
+    for page in range(pages):
+        page_rows = [rows[(page * headlines_per_page + i) % len(rows)] for i in range(headlines_per_page)]
+        for site, template in SYNTHETIC_HEADLINES.items():
+            body = "".join(template.format(title=escape(title), link=escape(str(link))) for title, link in page_rows)
+            _write_page(directory, site, page, "<!DOCTYPE html><html>" + padding + "<body><main>" + body + "</main></body></html>")
+        title, _ = page_rows[0]
+        article = "<body>" + padding + "<article><h1 class=\"title\">{0}</h1><p>{1}</p></article></body>".format(escape(title), "<p>Lorem ipsum dolor sit amet.</p>" * 40)
+        _write_page(directory, "cbs_miami_article", page, "<!DOCTYPE html><html>" + article + "</html>")
+    page_rows = rows[:headlines_per_page]
+    for site, template in MALFORMED_HEADLINES.items():
+        body = "".join(template.format(title=escape(title), link=escape(str(link))) for title, link in page_rows)
+        _write_page(directory, site, "malformed", "<!DOCTYPE html><html>" + padding + "<body><main>" + body + "</main></body></html>")
+    article = "<body>" + padding + "<article><h1 class=\"title\">{0} <em>Updated</h1><p>Lorem ipsum dolor sit amet.</p></article></body>".format(escape(page_rows[0][0]))
+    _write_page(directory, "cbs_miami_article", "malformed", "<!DOCTYPE html><html>" + article + "</html>")
+
+def _write_page(directory, site, page, html):
+    with open(os.path.join(directory, site, "{}.html".format(page)), "w", encoding="utf-8") as f:
+        f.write(html)
+
+def load_fixtures(directory):
+    """Returns a dictionary from each site with fixtures in directory to a list of (filename, page) pairs.
+
+    Parameters
+    ----------
+    directory: string
+        Directory with a subdirectory of .html fixtures for each site.
+    """
+    fixtures = {}
+    for site in parsers.SITES:
+        site_directory = os.path.join(directory, site)
+        if not os.path.isdir(site_directory):
+            continue
+        fixtures[site] = []
+        for filename in sorted(os.listdir(site_directory)):
+            if filename.endswith(".html"):
+                with open(os.path.join(site_directory, filename), encoding="utf-8") as f:
+                    fixtures[site].append((filename, f.read()))
+    return fixtures
+
+def run_benchmark(site, pages, backend, repeat):
+    """Extracts records from every page repeat times and returns the records and the best time.
+
+    Parameters
+    ----------
+    site: string
+        Name of the site, one of parsers.SITES.
+    pages: list of pairs
+        (filename, page) pairs to extract records from.
+    backend: string
+        Parser backend, one of parsers.BACKENDS.
+    repeat: int
+        Number of times to time the extraction; the fastest run is reported.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = [parsers.extract(site, page, backend, url=filename) for filename, page in pages]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return records, best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the HTML parser backends of the scrapers.")
+    parser.add_argument("--fixtures", help="Directory with a subdirectory of saved .html pages for each site.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic pages to write for each site instead.")
+    parser.add_argument("--backends", nargs="+", default=list(parsers.BACKENDS), choices=parsers.BACKENDS)
+    parser.add_argument("--repeat", type=int, default=3, help="Times each extraction is timed; the fastest is reported.")
+    parser.add_argument("--output", default="-", help="File to write the JSON report to, or `-` for stdout.")
+    args = parser.parse_args(argv)
+    if (args.fixtures is None) == (args.synthetic == 0):
+        parser.error("exactly one of --fixtures and --synthetic is required")
+
+    directory = args.fixtures
+    if args.synthetic:
+        directory = tempfile.mkdtemp(prefix="florida_man_fixtures_")
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": [], "mismatches": []}
+    try:
+        if args.synthetic:
+            write_synthetic_fixtures(directory, args.synthetic)
+        for site, pages in load_fixtures(directory).items():
+            reference = None
+            megabytes = sum(len(page.encode("utf-8")) for _, page in pages) / 1e6
+            for backend in args.backends:
+                print("Running {0} on {1} ({2} pages)...".format(backend, site, len(pages)), file=sys.stderr)
+                try:
+                    records, seconds = run_benchmark(site, pages, backend, args.repeat)
+                except Exception as e:
+                    report["results"].append({"site": site, "backend": backend, "error": repr(e)})
+                    continue
+                report["results"].append({
+                    "site": site,
+                    "backend": backend,
+                    "pages": len(pages),
+                    "megabytes": megabytes,
+                    "records": sum(map(len, records)),
+                    "seconds": seconds,
+                    "pages_per_second": len(pages) / seconds if seconds > 0 else None,
+                    "megabytes_per_second": megabytes / seconds if seconds > 0 else None
+                })
+                if reference is None:
+                    reference = (backend, records)
+                    continue
+                for (filename, _), expected, actual in zip(pages, reference[1], records):
+                    if expected != actual:
+                        report["mismatches"].append({"site": site, "fixture": filename, "backends": [reference[0], backend]})
+    finally:
+        if args.synthetic:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["mismatches"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+Extracts (title, link) records from the pages of each scraped site. Every
+site can be parsed with one of three backends that return identical records:
+BeautifulSoup with html5lib, BeautifulSoup with lxml, and a selector-only
+extractor that streams the page through the standard library's HTMLParser
+and only keeps the elements its selectors match instead of building a tree.
+
+Elements left open inside a matched element, like a `<b>` missing its end tag
+inside an `<a>`, are closed along with it, the way html5lib and lxml repair
+them.
+"""
+from bs4 import BeautifulSoup
+from html import escape
+from html.parser import HTMLParser
+
+BACKENDS = ("html5lib", "lxml", "selector")
+DEFAULT_BACKEND = "selector"
+
+# Elements that never have an end tag
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr"
+}
+
+class Selector:
+    """Matches elements by tag name, class and exact attribute values, like BeautifulSoup's find_all.
+
+    Parameters
+    ----------
+    tag: string
+        Tag name of the element.
+    class_name: string
+        A class the element must have, or None.
+    attrs: dictionary
+        Attribute values the element must have.
+    """
+    def __init__(self, tag, class_name=None, **attrs):
+        self.tag = tag
+        self.class_name = class_name
+        self.attrs = attrs
+
+    def matches(self, tag, attrs):
+        """Checks whether an element with tag and the dictionary attrs is matched."""
+        if tag != self.tag:
+            return False
+        if self.class_name is not None and self.class_name not in (attrs.get("class") or "").split():
+            return False
+        return all(attrs.get(name) == value for name, value in self.attrs.items())
+
+class Element:
+    """The attributes, inner HTML and text of an element matched by a Selector."""
+    __slots__ = ("attrs", "html", "text", "children", "depth")
+
+    def __init__(self, attrs, depth, inner_count=0):
+        self.attrs = attrs
+        self.html = []
+        self.text = []
+        self.children = [None] * inner_count
+        self.depth = depth
+
+    def decode_contents(self):
+        """Returns the inner HTML, serialized the way BeautifulSoup's decode_contents does."""
+        return "".join(self.html)
+
+    def get_text(self):
+        """Returns the text of the element and all its descendants."""
+        return "".join(self.text)
+
+class SelectorParser(HTMLParser):
+    """Streams a page and collects every element matched by outer and, inside each, the first match of each inner selector.
+
+    Parameters
+    ----------
+    outer: Selector
+        Selector for the elements to collect.
+    inner: list of Selectors
+        Selectors for the descendants to collect inside each outer element.
+    """
+    def __init__(self, outer, inner=()):
+        super().__init__(convert_charrefs=True)
+        self.outer = outer
+        self.inner = inner
+        self.elements = []
+        self.open_tags = []
+        self.active = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        is_void = tag in VOID_ELEMENTS
+        if self.active:
+            start_tag = "<{0}{1}{2}>".format(tag, _serialize_attrs(attrs), "/" if is_void else "")
+            for element in self.active:
+                element.html.append(start_tag)
+        if is_void:
+            return
+        self.open_tags.append(tag)
+        depth = len(self.open_tags)
+        started = []
+        for element in self.active:
+            for i, selector in enumerate(self.inner[:len(element.children)]):
+                if element.children[i] is None and selector.matches(tag, attrs):
+                    element.children[i] = Element(attrs, depth)
+                    started.append(element.children[i])
+        if self.outer.matches(tag, attrs):
+            element = Element(attrs, depth, len(self.inner))
+            self.elements.append(element)
+            started.append(element)
+        self.active.extend(started)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        depth = len(self.open_tags) - self.open_tags[::-1].index(tag)
+        closed = self.open_tags[depth - 1:]
+        del self.open_tags[depth - 1:]
+        for element in self.active:
+            if element.depth >= depth:
+                # Descendants left open are closed with the element, like html5lib and lxml close them
+                element.html.append("".join("</{}>".format(closed_tag) for closed_tag in reversed(closed[element.depth - depth + 1:])))
+                element.depth = None
+        self.active = [element for element in self.active if element.depth is not None]
+        if self.active:
+            end_tags = "".join("</{}>".format(closed_tag) for closed_tag in reversed(closed))
+            for element in self.active:
+                element.html.append(end_tags)
+
+    def handle_data(self, data):
+        if not self.active:
+            return
+        escaped = escape(data, quote=False)
+        for element in self.active:
+            element.html.append(escaped)
+            element.text.append(data)
+
+    def handle_comment(self, data):
+        for element in self.active:
+            element.html.append("<!--{}-->".format(data))
+
+def _serialize_attrs(attrs):
+    """Returns attrs serialized as they are inside a start tag."""
+    return "".join(
+        " {0}=\"{1}\"".format(name, escape(value or "", quote=False).replace("\"", "&quot;"))
+        for name, value in attrs.items()
+    )
+
+def select(page, outer, inner=()):
+    """Returns an Element for every element of page matched by outer, with the first match of each inner selector as children.
+
+    Parameters
+    ----------
+    page: string
+        HTML of the page.
+    outer: Selector
+        Selector for the elements to collect.
+    inner: list of Selectors
+        Selectors for the descendants to collect inside each outer element.
+    """
+    parser = SelectorParser(outer, inner)
+    parser.feed(page)
+    parser.close()
+    return parser.elements
+
+def _find_all(soup, selector):
+    """Returns every element of soup matched by selector."""
+    attrs = dict(selector.attrs)
+    if selector.class_name is not None:
+        attrs["class"] = selector.class_name
+    return soup.find_all(selector.tag, attrs)
+
+def _find(element, selector):
+    """Returns the first descendant of element matched by selector, or None."""
+    matches = _find_all(element, selector)
+    return matches[0] if matches else None
+
+# Selectors for each site
+FLORIDAMAN_HEADLINE = Selector("h3", "entry-title")
+CBS_MIAMI_RESULT = Selector("a", "gs-title", dir="ltr")
+CBS_MIAMI_TITLE = Selector("h1", "title")
+LOCAL10_ITEM = Selector("div", "queryly_item")
+LOCAL10_TITLE = Selector("div", "queryly_item_title")
+LINK = Selector("a")
+
+def _floridaman_records(elements, find):
+    records = []
+    for headline in elements:
+        link = find(headline, 0)
+        if link is not None:
+            records.append((link.decode_contents().strip(), link.attrs.get("href")))
+    return records
+
+def _cbs_miami_search_records(elements, find):
+    return [(result.get_text().strip(), result.attrs.get("href")) for result in elements]
+
+def _cbs_miami_article_records(elements, find, url):
+    return [(title.get_text().strip(), url) for title in elements[:1]]
+
+def _local10_records(elements, find):
+    records = []
+    for item in elements:
+        title, link = find(item, 0), find(item, 1)
+        if title is not None and link is not None:
+            records.append((title.decode_contents().strip(), link.attrs.get("href")))
+    return records
+
+# Site name: (outer selector, inner selectors, function turning matches into records)
+SITES = {
+    "floridaman": (FLORIDAMAN_HEADLINE, (LINK,), _floridaman_records),
+    "cbs_miami_search": (CBS_MIAMI_RESULT, (), _cbs_miami_search_records),
+    "cbs_miami_article": (CBS_MIAMI_TITLE, (), _cbs_miami_article_records),
+    "local10": (LOCAL10_ITEM, (LOCAL10_TITLE, LINK), _local10_records)
+}
+
+def extract(site, page, backend=DEFAULT_BACKEND, url=None):
+    """Returns the (title, link) records on page, a page of site, using backend.
+
+    Records are identical for every backend: titles of headline links keep
+    their inner HTML (as in `Ice Cream &amp; Liquor`), other titles are plain
+    text, and both are stripped. Article pages have no link of their own, so
+    their single record uses url instead.
+
+    Parameters
+    ----------
+    site: string
+        Name of the site and page type, one of SITES.
+    page: string
+        HTML of the page.
+    backend: string
+        Parser to use, one of BACKENDS.
+    url: string
+        URL of the page, used as the link of article records.
+    """
+    if site not in SITES:
+        raise ValueError("Unknown site `{}`.".format(site))
+    if backend not in BACKENDS:
+        raise ValueError("Unknown parser backend `{}`.".format(backend))
+    outer, inner, to_records = SITES[site]
+    if backend == "selector":
+        elements = select(page, outer, inner)
+        find = lambda element, i: element.children[i]
+    else:
+        elements = [_SoupElement(element) for element in _find_all(BeautifulSoup(page, backend), outer)]
+        find = lambda element, i: _SoupElement.wrap(_find(element.element, inner[i]))
+    if site == "cbs_miami_article":
+        return to_records(elements, find, url)
+    return to_records(elements, find)
+
+class _SoupElement:
+    """Gives a BeautifulSoup Tag the interface of Element."""
+    __slots__ = ("element", "attrs")
+
+    def __init__(self, element):
+        self.element = element
+        self.attrs = {name: " ".join(value) if isinstance(value, list) else value for name, value in element.attrs.items()}
+
+    @staticmethod
+    def wrap(element):
+        return None if element is None else _SoupElement(element)
+
+    def decode_contents(self):
+        return self.element.decode_contents()
+
+    def get_text(self):
+        return self.element.get_text()
@@ -0,0 +1,251 @@
+"""
+Keeps a buffer of pre-generated, validated and de-duplicated headlines for
+each value of n, so the shell can hand out headlines without waiting on
+rejection sampling. A background thread refills a buffer whenever it drops
+below its low-water mark, and all buffers are thrown away when the model or
+the title index changes.
+"""
+from collections import Counter, deque
+import instrumentation
+import ngrams_lm
+import numpy as np
+import threading
+import utils
+
+class HeadlineReservoir:
+    """Buffers of valid headlines for each n and backoff setting, refilled in the background.
+
+    Headlines are never handed out twice until the model changes. The model is
+    identified by the object itself and its version, which MultiOrderModel
+    bumps on every update, and the title index by the object and its size.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of headlines each buffer is filled up to.
+    low_water: int
+        Size below which a buffer is refilled.
+    batch_size: int
+        Number of candidate headlines generated at once.
+    consecutive_invalid_limit: int
+        Limit on consecutive invalid candidates before a buffer stops refilling.
+    seed: int
+        Seed for the headlines, or None for fresh randomness.
+    """
+    def __init__(self, capacity=100, low_water=25, batch_size=500, consecutive_invalid_limit=utils.CONSECUTIVE_INVALID_LIMIT, seed=None):
+        self.capacity = capacity
+        self.low_water = low_water
+        self.batch_size = batch_size
+        self.consecutive_invalid_limit = consecutive_invalid_limit
+        self.condition = threading.Condition()
+        self.model = None
+        self.title_index = None
+        self.source = None
+        self.generation = 0
+        self.buffers = {}
+        self.seen = {}
+        self.samplers = {}
+        # Each buffer draws from its own generator, derived from the seed, its key and
+        # how many times the model has changed since seeding
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.changes = 0
+        self.rngs = {}
+        # Generated headlines not yet validated
+        self.candidates = {}
+        # Rejection counts of each buffer, and why it stopped refilling if it has
+        self.rejections = {}
+        self.failures = {}
+        self.thread = None
+
+    def _use(self, model, title_index):
+        """Switches to model and title_index, emptying every buffer if either changed. Called with the condition held."""
+        source = (id(model), model.version, id(title_index), len(title_index))
+        if source != self.source:
+            if self.source is not None:
+                instrumentation.count("reservoir.invalidations")
+            self.model = model
+            self.title_index = title_index
+            self.source = source
+            self.generation += 1
+            self.changes += 1
+            self.buffers.clear()
+            self.seen.clear()
+            self.samplers.clear()
+            self.rngs.clear()
+            self.candidates.clear()
+            self.rejections.clear()
+            self.failures.clear()
+            self.condition.notify_all()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._refill_forever, name="headline-reservoir", daemon=True)
+            self.thread.start()
+
+    def _register(self, key):
+        """Starts keeping a buffer for key. Called with the condition held."""
+        if key not in self.buffers:
+            self.buffers[key] = deque()
+            self.seen[key] = set()
+            self.rngs[key] = np.random.default_rng(np.random.SeedSequence(
+                self.seed_sequence.entropy, spawn_key=(key[0], int(key[1]), self.changes)
+            ))
+            self.candidates[key] = deque()
+            self.rejections[key] = Counter()
+            self.condition.notify_all()
+
+    def reseed(self, seed):
+        """Empties every buffer and draws all later headlines from seed.
+
+        Parameters
+        ----------
+        seed: int
+            Seed for the headlines, or None for fresh randomness.
+        """
+        with self.condition:
+            self.seed_sequence = np.random.SeedSequence(seed)
+            self.changes = 0
+            # Forcing the next take or prime to start over
+            self.source = None
+            self.generation += 1
+            self.buffers.clear()
+            self.condition.notify_all()
+
+    def prime(self, model, title_index, n, backoff=False):
+        """Starts filling the buffer for n in the background, so later takes don't wait.
+
+        Parameters
+        ----------
+        model: MultiOrderModel
+            The trained n-grams language model for every n up to max_n.
+        title_index: TitleIndex
+            An index of all headline titles in the training data.
+        n: int
+            Value of n for language model.
+        backoff: bool
+            Whether headlines are sampled with backoff to shorter histories.
+        """
+        with self.condition:
+            self._use(model, title_index)
+            self._register((n, backoff))
+
+    def take(self, model, title_index, n, count=1, backoff=False):
+        """Returns count headlines for n from the buffer, waiting for refills if it runs out.
+
+        Returns fewer headlines if the model fails to produce valid ones; see
+        failure for why.
+
+        Parameters
+        ----------
+        model: MultiOrderModel
+            The trained n-grams language model for every n up to max_n.
+        title_index: TitleIndex
+            An index of all headline titles in the training data.
+        n: int
+            Value of n for language model.
+        count: int
+            Number of headlines to take.
+        backoff: bool
+            Whether headlines are sampled with backoff to shorter histories.
+        """
+        key = (n, backoff)
+        headlines = []
+        with self.condition:
+            self._use(model, title_index)
+            self._register(key)
+            buffer = self.buffers[key]
+            while len(headlines) < count:
+                if not buffer:
+                    if key in self.failures:
+                        break
+                    instrumentation.count("reservoir.waits")
+                    self.condition.notify_all()
+                    self.condition.wait()
+                    continue
+                headlines.append(buffer.popleft())
+            instrumentation.count("reservoir.served", len(headlines))
+            if len(buffer) < self.low_water:
+                self.condition.notify_all()
+        return headlines
+
+    def failure(self, n, backoff=False):
+        """Returns why the buffer for n stopped refilling, or None if it has not."""
+        with self.condition:
+            return self.failures.get((n, backoff))
+
+    def rejection_counts(self, n, backoff=False):
+        """Returns how many candidates for n were rejected for each reason since the model last changed."""
+        with self.condition:
+            return dict(self.rejections.get((n, backoff), {}))
+
+    def _next_job(self):
+        """Waits for a buffer below its low-water mark and returns its key and what to refill it from."""
+        with self.condition:
+            while True:
+                # An updated model is only refilled from after the next take or prime switches to it
+                if self.source is not None and self.model.version == self.source[1]:
+                    for key, buffer in self.buffers.items():
+                        if key not in self.failures and len(buffer) < self.low_water:
+                            return key, self.generation, self.model, self.source[1], self.title_index
+                self.condition.wait()
+
+    def _refill_forever(self):
+        while True:
+            key, generation, model, version, title_index = self._next_job()
+            try:
+                self._refill(key, generation, model, version, title_index)
+            except Exception as e:
+                with self.condition:
+                    if generation == self.generation:
+                        # Failures are shown inside a sentence
+                        self.failures[key] = str(e).rstrip(".")
+                    self.condition.notify_all()
+
+    def _refill(self, key, generation, model, version, title_index):
+        """Generates headlines for key until its buffer is full or the model changes.
+
+        Candidates left over once the buffer is full are kept for the next
+        refill, so the headlines handed out only depend on the seed, not on
+        when the refills happen.
+        """
+        n, backoff = key
+        consecutive_invalid_count = 0
+        while True:
+            with self.condition:
+                if generation != self.generation:
+                    return
+                candidates, rng = self.candidates[key], self.rngs[key]
+            if not candidates:
+                # Holding the model's lock, so it isn't updated halfway through a batch
+                with model.lock:
+                    if model.version != version or generation != self.generation:
+                        return
+                    sampler = self.samplers.get(key)
+                    if sampler is None:
+                        sampler = ngrams_lm.build_sampler(model, n, backoff)
+                        self.samplers[key] = sampler
+                    batch = sampler.generate_batch(self.batch_size, rng=rng)
+            with self.condition:
+                if generation != self.generation:
+                    return
+                buffer, seen, rejections = self.buffers[key], self.seen[key], self.rejections[key]
+                if not candidates:
+                    candidates.extend(batch)
+                while candidates and len(buffer) < self.capacity:
+                    headline = candidates.popleft()
+                    reason = utils.rejection_reason(headline, title_index)
+                    if reason is None and headline in seen:
+                        reason = "duplicate in batch"
+                    instrumentation.count("generate.attempts")
+                    if reason is None:
+                        consecutive_invalid_count = 0
+                        seen.add(headline)
+                        buffer.append(headline)
+                        instrumentation.count("generate.accepted")
+                    else:
+                        consecutive_invalid_count += 1
+                        rejections[reason] += 1
+                        instrumentation.count("generate.rejected." + reason)
+                if consecutive_invalid_count >= self.consecutive_invalid_limit:
+                    self.failures[key] = "no valid headline in {} attempts".format(consecutive_invalid_count)
+                self.condition.notify_all()
+                if len(buffer) >= self.capacity or key in self.failures:
+                    return
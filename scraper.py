@@ -2,9 +2,11 @@
 Scrapes various news sites for articles related to Florida man. 
 Stores headlines in csv files in ./training_data 
 """
-from bs4 import BeautifulSoup
-import pandas as pd
-import requests
+import argparse
+import fetcher
+import itertools
+import page_cache
+import parsers
 from selenium import webdriver
 from selenium.webdriver.common.by import By 
 from selenium.webdriver.support.ui import WebDriverWait
@@ -13,8 +15,82 @@ import utils
 
 data_directory = "training_data/"
 driver_path = "chromedriver_win32/chromedriver.exe"
+# Parser backend used to extract headlines, one of parsers.BACKENDS
+parser_backend = parsers.DEFAULT_BACKEND
 
-def scrape_floridaman_site(driver, filename):
+FLORIDAMAN_URL = "https://floridaman.com/"
+CBS_MIAMI_SEARCH_URL = "https://miami.cbslocal.com/search/?q=florida+man"
+LOCAL10_SEARCH_URL = "https://www.local10.com/search/?searchTerm=florida+man"
+
+def floridaman_page_urls(num_pages=17):
+    """Yields the URLs of the pages of https://floridaman.com/ in the order they are scraped.
+
+    Parameters
+    ----------
+    num_pages: int
+        Number of pages to scrape.
+    """
+    yield FLORIDAMAN_URL
+    for page in range(1, num_pages):
+        yield FLORIDAMAN_URL + "page/{}/".format(page)
+
+def search_page_urls(search_url):
+    """Yields the cache keys of the pages of search results at search_url, which are paged by clicking.
+
+    Parameters
+    ----------
+    search_url: string
+        URL of the first page of search results.
+    """
+    for page in itertools.count(1):
+        yield "{0}#page={1}".format(search_url, page)
+
+def browse_floridaman_site(driver):
+    """Yields (url, page) pairs for every page of https://floridaman.com/ loaded with driver."""
+    for url in floridaman_page_urls():
+        driver.get(url)
+        yield url, driver.page_source
+
+def browse_cbs_miami(driver):
+    """Yields (cache key, page) pairs for every page of CBS Miami search results loaded with driver."""
+    driver.get(CBS_MIAMI_SEARCH_URL)
+    # Wait until next page links are loaded
+    _ = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CLASS_NAME, "gsc-cursor-page")))
+    num_pages = int(driver.find_elements_by_class_name("gsc-cursor-page")[-1].text)
+    for page_count, key in zip(range(1, num_pages), search_page_urls(CBS_MIAMI_SEARCH_URL)):
+        yield key, driver.page_source
+        driver.find_elements_by_class_name("gsc-cursor-page")[page_count].click()
+
+def browse_local10(driver):
+    """Yields (cache key, page) pairs for every page of local10 search results loaded with driver."""
+    driver.get(LOCAL10_SEARCH_URL)
+    for key in search_page_urls(LOCAL10_SEARCH_URL):
+        next_page = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CLASS_NAME, "queryly_paging")))
+        yield key, driver.page_source
+        if next_page.text != "Next Page":
+            return
+        next_page.click()
+
+def open_pages(driver, cache, browse, urls):
+    """Returns an iterator of (url, page) pairs for a site, browsed live or replayed from cache.
+
+    Parameters
+    ----------
+    driver: Selenium webdriver
+        Webdriver for Selenium to use, or None to replay the pages from cache.
+    cache: PageCache
+        Cache that browsed pages are stored in, or None.
+    browse: function
+        The site's browse function, which takes driver and yields (url, page) pairs.
+    urls: iterable of strings
+        The site's page URLs in order, used to replay pages from cache.
+    """
+    if driver is None:
+        return cache.replay(urls)
+    pages = browse(driver)
+    return pages if cache is None else cache.record(pages)
+
+def scrape_floridaman_site(driver, filename, incremental=False, cache=None):
     """Scrapes https://floridaman.com/ for Florida man headlines. Saves headlines to filename.
 
     Parameters
@@ -22,68 +98,106 @@ def scrape_floridaman_site(driver, filename):
     filename: string
         The name of the file the articles are being written into.
     driver: Selenium webdriver 
-        Webdriver for Selenium to use.
+        Webdriver for Selenium to use, or None to replay the pages from cache.
+    incremental: bool
+        Whether to keep the headlines already in filename and stop at the first known article.
+    cache: PageCache
+        Cache that every fetched page is stored in, or None.
     """
-    driver.get("https://floridaman.com/")
     verify_article = lambda link: "https://floridaman.com" in link
-    num_pages = 17
-
-    entries = pd.DataFrame(columns=["title", "link"])
-    for page in range(1, num_pages + 1):
-        try:
-            soup = BeautifulSoup(driver.page_source, "html5lib")
-            headlines = soup.find_all("h3", {"class" : "entry-title"})
-            for headline in headlines:
-                article_title = headline.a.decode_contents().strip()
-                article_link = headline.a["href"]
+    checkpoint = utils.ScrapeCheckpoint(filename, incremental)
+    try:
+        for _, page in open_pages(driver, cache, browse_floridaman_site, floridaman_page_urls()):
+            reached_known = False
+            for article_title, article_link in parsers.extract("floridaman", page, parser_backend):
                 if verify_article(article_link):
-                    entry = pd.DataFrame({"title" : [article_title],
-                                          "link" : [article_link]})
-                    entries = entries.append(entry, ignore_index=True)
-            driver.get("https://floridaman.com/page/{}/".format(page))
-        except:
-            utils.handle_exception(None)
-            break
-    driver.quit()
-    utils.write_to_csv(entries, filename)
-
-def scrape_cbs_miami(driver, filename):
+                    reached_known = reached_known or checkpoint.is_known(article_link)
+                    checkpoint.add(article_title, article_link)
+            if reached_known:
+                break
+    except KeyboardInterrupt:
+        checkpoint.suspend()
+        raise
+    except Exception:
+        utils.handle_exception(None)
+        checkpoint.suspend()
+        return
+    finally:
+        if driver is not None:
+            driver.quit()
+    checkpoint.finish()
+
+def scrape_cbs_miami(driver, filename, concurrency=8, requests_per_second=10, incremental=False, cache=None):
     """Scrapes CBS Miami for Florida man headlines. Saves headlines to filename.
 
+    Links are collected from every page of search results first, and then the
+    articles are fetched concurrently to read their titles. Articles that were
+    already checkpointed by an interrupted scrape are not fetched again.
+
     Parameters
     ----------
     filename: string
         The name of the file the articles are being written into.
     driver: Selenium webdriver 
-        Webdriver for Selenium to use.
+        Webdriver for Selenium to use, or None to replay the pages and articles from cache.
+    concurrency: int
+        Number of articles fetched at once.
+    requests_per_second: float
+        Largest number of article requests started per second.
+    incremental: bool
+        Whether to keep the headlines already in filename and stop at the first known article.
+    cache: PageCache
+        Cache that every fetched page is stored in, or None.
     """
-    driver.get("https://miami.cbslocal.com/search/?q=florida+man")
-    entries = pd.DataFrame(columns=["title", "link"])
-
-    # Wait until next page links are loaded
-    _ = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CLASS_NAME, "gsc-cursor-page")))
-    soup = BeautifulSoup(driver.page_source, "html5lib")
-    num_pages = int(soup.find_all("div", {"class" : "gsc-cursor-page"})[-1].text)
+    checkpoint = utils.ScrapeCheckpoint(filename, incremental)
+    headline_links = []
     try:
-        for page_count in range(1, num_pages):
-            soup = BeautifulSoup(driver.page_source, "html5lib")
-            headlines = soup.find_all("a", {"class" : "gs-title", "dir" : "ltr"})
-            for headline in headlines:
-                headline_link = headline["href"]
-                link_soup = BeautifulSoup(requests.get(headline_link, allow_redirects=False).text, "html5lib")
-                headline_title = link_soup.find("h1", {"class" : "title"}).text.strip()
-                entry = pd.DataFrame({
-                    "title" : [headline_title],
-                    "link" : [headline_link]
-                })
-                entries = entries.append(entry, ignore_index=False)
-            driver.find_elements_by_class_name("gsc-cursor-page")[page_count].click()
-    except:
+        for _, page in open_pages(driver, cache, browse_cbs_miami, search_page_urls(CBS_MIAMI_SEARCH_URL)):
+            links = [link for _, link in parsers.extract("cbs_miami_search", page, parser_backend)]
+            headline_links.extend(link for link in links if not checkpoint.is_known(link) and not checkpoint.is_scraped(link))
+            if any(checkpoint.is_known(link) for link in links):
+                break
+        headline_links = list(dict.fromkeys(headline_links))
+        # Fetching in chunks so that every chunk is checkpointed before the next
+        for i in range(0, len(headline_links), checkpoint.checkpoint_every):
+            links = headline_links[i:i + checkpoint.checkpoint_every]
+            if driver is None:
+                pages = [cache.get(link) for link in links]
+            else:
+                pages = fetcher.fetch_all(links, concurrency=concurrency, requests_per_second=requests_per_second, cache=cache, allow_redirects=False)
+            for title, link in zip(extract_cbs_miami_titles(pages, links), links):
+                if title is not None:
+                    checkpoint.add(title, link)
+            checkpoint.checkpoint()
+    except KeyboardInterrupt:
+        checkpoint.suspend()
+        raise
+    except Exception:
         utils.handle_exception(None)
-    driver.quit()
-    utils.write_to_csv(entries, filename)
+        checkpoint.suspend()
+        return
+    finally:
+        if driver is not None:
+            driver.quit()
+    checkpoint.finish()
+
+def extract_cbs_miami_titles(pages, links):
+    """Returns the article title in each CBS Miami article page, or None if it has none.
 
-def scrape_local10(driver, filename):
+    Parameters
+    ----------
+    pages: list of strings
+        HTML of each article page, or None for pages that failed to load.
+    links: list of strings
+        Link to each article page.
+    """
+    titles = []
+    for page, link in zip(pages, links):
+        records = [] if page is None else parsers.extract("cbs_miami_article", page, parser_backend, url=link)
+        titles.append(records[0][0] if records else None)
+    return titles
+
+def scrape_local10(driver, filename, incremental=False, cache=None):
     """Scrapes local10 news for Florida man headlines. Saves headlines to filename.
 
     Parameters
@@ -91,42 +205,48 @@ def scrape_local10(driver, filename):
     filename: string
         The name of the file the articles are being written into.
     driver: Selenium webdriver 
-        Webdriver for Selenium to use.
+        Webdriver for Selenium to use, or None to replay the pages from cache.
+    incremental: bool
+        Whether to keep the headlines already in filename and stop at the first known article.
+    cache: PageCache
+        Cache that every fetched page is stored in, or None.
     """
-    driver.get("https://www.local10.com/search/?searchTerm=florida+man")
-    entries = pd.DataFrame(columns=["title", "link"])
+    checkpoint = utils.ScrapeCheckpoint(filename, incremental)
     verify_article = lambda title: "florida man" in title.lower()
     number_entries = 500
     
     try:
-        while len(entries.index) < number_entries:
-            next_page = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CLASS_NAME, "queryly_paging")))
-            soup = BeautifulSoup(driver.page_source, "html5lib")
-            headlines = soup.find_all("div", {"class" : "queryly_item"})
-            for headline in headlines: 
-                article_title = headline.find("div", {"class" : "queryly_item_title"}).decode_contents().strip()
-                article_link = headline.a["href"]
+        for _, page in open_pages(driver, cache, browse_local10, search_page_urls(LOCAL10_SEARCH_URL)):
+            reached_known = False
+            for article_title, article_link in parsers.extract("local10", page, parser_backend):
                 if verify_article(article_title):
-                    entry = pd.DataFrame({
-                        "title" : [article_title], 
-                        "link" : [article_link]
-                    })
-                    entries = entries.append(entry, ignore_index = True)  
-            if next_page.text == "Next Page":
-                next_page.click()
-            else:
+                    reached_known = reached_known or checkpoint.is_known(article_link)
+                    checkpoint.add(article_title, article_link)
+            if reached_known or len(checkpoint) >= number_entries:
                 break
-    except:
+    except KeyboardInterrupt:
+        checkpoint.suspend()
+        raise
+    except Exception:
         utils.handle_exception(None)
-    driver.quit()
-    utils.write_to_csv(entries, filename)
+        checkpoint.suspend()
+        return
+    finally:
+        if driver is not None:
+            driver.quit()
+    checkpoint.finish()
 
 if __name__ == "__main__":
-    driver = webdriver.Chrome(driver_path)
-    scrape_floridaman_site(driver, data_directory + "floridaman_site_headlines.csv")
-
-    driver = webdriver.Chrome(driver_path)
-    scrape_cbs_miami(driver, data_directory + "cbs_miami_headlines.csv")
+    parser = argparse.ArgumentParser(description="Scrapes Florida man headlines into ./training_data.")
+    parser.add_argument("--incremental", action="store_true", help="Only scrape articles newer than the saved headlines.")
+    parser.add_argument("--parser", default=parsers.DEFAULT_BACKEND, choices=parsers.BACKENDS, help="HTML parser backend.")
+    parser.add_argument("--replay", action="store_true", help="Re-extract headlines from the page cache, without a browser or network.")
+    args = parser.parse_args()
+    incremental = args.incremental
+    parser_backend = args.parser
+    cache = page_cache.PageCache()
+    new_driver = lambda: None if args.replay else webdriver.Chrome(driver_path)
 
-    driver = webdriver.Chrome(driver_path)
-    scrape_local10(driver, data_directory + "local10_headlines.csv")
+    scrape_floridaman_site(new_driver(), data_directory + "floridaman_site_headlines.csv", incremental=incremental, cache=cache)
+    scrape_cbs_miami(new_driver(), data_directory + "cbs_miami_headlines.csv", incremental=incremental, cache=cache)
+    scrape_local10(new_driver(), data_directory + "local10_headlines.csv", incremental=incremental, cache=cache)
@@ -0,0 +1,442 @@
+"""
+Serves generated headlines to other apps over HTTP on localhost. The model is
+loaded once, from its snapshot if possible, and shared with a pool of worker
+processes that do all generation and scoring.
+
+Endpoints take and return JSON:
+    GET  /health                                  {"status": "ok", ...}
+    POST /generate {"n": 2, "count": 5, "backoff": false}  {"headlines": [...]}
+    POST /validate {"headline": "..."}            {"valid": true, "reason": null}
+    POST /score    {"headline": "...", "n": 2}    {"words": 6, "log_probability": ...}
+/generate also accepts its settings as query parameters on a GET request.
+
+Generate requests arriving together for the same n are batched into a single
+job for the pool. When more than max_pending requests are waiting, new ones
+are turned away with 503 Service Unavailable instead of queueing without bound.
+
+Example:
+    python server.py --port 8080 --processes 4
+"""
+import argparse
+import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+import config
+import instrumentation
+import json
+import math
+import multiprocessing
+import ngrams_lm
+import numpy as np
+import os
+import sys
+import time
+from urllib.parse import parse_qsl, urlsplit
+import utils
+
+# Largest number of headlines a single request may ask for
+MAX_COUNT = 100
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 16
+
+# Model and title index of the current process, loaded by load_state
+state = None
+
+def load_state():
+    """Loads the entries, title index and model once per process and returns them.
+
+    Workers forked from the server inherit its state. Workers started any other
+    way load the model from the snapshot the server saved, which is memory-mapped.
+
+    Parameters
+    ----------
+    None
+    """
+    global state
+    if state is None:
+        model, _, title_index = config.load_training_data()
+        state = {"model": model, "title_index": title_index, "samplers": {}, "rng": np.random.default_rng()}
+    return state
+
+def _init_worker():
+    load_state()
+    # Forked workers start with the server's generator and would all draw the same headlines
+    state["rng"] = np.random.default_rng()
+
+def generate_headlines(n, count, backoff=False):
+    """Returns up to count distinct valid headlines and the rejection counts, generated in a worker.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    count: int
+        Number of headlines to generate.
+    backoff: bool
+        Whether to sample with backoff to shorter histories.
+    """
+    model, title_index, samplers = state["model"], state["title_index"], state["samplers"]
+    if (n, backoff) not in samplers:
+        samplers[(n, backoff)] = ngrams_lm.build_sampler(model, n, backoff)
+    sampler = samplers[(n, backoff)]
+    headlines = []
+    seen = set()
+    rejections = Counter()
+    consecutive_invalid_count = 0
+    while len(headlines) < count and consecutive_invalid_count < utils.CONSECUTIVE_INVALID_LIMIT:
+        batch_size = min(500, max(4 * (count - len(headlines)), 32))
+        for headline in sampler.generate_batch(batch_size, rng=state["rng"]):
+            reason = utils.rejection_reason(headline, title_index)
+            if reason is None and headline in seen:
+                reason = "duplicate in batch"
+            if reason is not None:
+                consecutive_invalid_count += 1
+                rejections[reason] += 1
+                continue
+            consecutive_invalid_count = 0
+            seen.add(headline)
+            headlines.append(headline)
+            if len(headlines) == count:
+                break
+    return headlines, dict(rejections)
+
+def score_headlines(n, headlines):
+    """Returns the scores of headlines under the model for n, computed in a worker.
+
+    Parameters
+    ----------
+    n: int
+        Value of n for language model.
+    headlines: list of strings
+        Cleaned headlines to score.
+    """
+    scores = state["model"].view(n).score_batch(headlines)
+    return [
+        {name: None if name == "perplexity" and words == 0 else values[i].item() for name, values in scores.items()}
+        for i, words in enumerate(scores["words"].tolist())
+    ]
+
+class RequestError(Exception):
+    """An error in a request, reported to the client with status."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class GenerationBatcher:
+    """Groups generate requests that arrive close together into one job for the pool.
+
+    Requests for the same n and backoff setting that arrive within max_delay
+    seconds of the first are generated together, and the headlines are split
+    between them in arrival order. If the job gives up before generating them
+    all, the requests left short fail with status 422. At most max_jobs jobs
+    run at once, and further batches wait for a free slot.
+
+    Parameters
+    ----------
+    executor: ProcessPoolExecutor
+        Pool the jobs run in.
+    max_jobs: int
+        Most jobs running at once.
+    max_batch: int
+        Most headlines generated by one job.
+    max_delay: float
+        Seconds a batch waits for more requests before it is started.
+    """
+    def __init__(self, executor, max_jobs, max_batch=500, max_delay=0.005):
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_jobs)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = {}
+
+    async def generate(self, n, count, backoff):
+        """Returns count headlines for n once the batch the request joined is generated.
+
+        Parameters
+        ----------
+        n: int
+            Value of n for language model.
+        count: int
+            Number of headlines to generate.
+        backoff: bool
+            Whether to sample with backoff to shorter histories.
+        """
+        key = (n, backoff)
+        future = asyncio.get_running_loop().create_future()
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = {"requests": [], "count": 0}
+            asyncio.get_running_loop().call_later(self.max_delay, self._start, key, batch)
+        batch["requests"].append((count, future))
+        batch["count"] += count
+        if batch["count"] >= self.max_batch:
+            self._start(key, batch)
+        return await future
+
+    def _start(self, key, batch):
+        """Closes batch to new requests and runs it once a job slot is free."""
+        if self.batches.get(key) is batch:
+            del self.batches[key]
+            asyncio.ensure_future(self._run(key, batch))
+
+    async def _run(self, key, batch):
+        n, backoff = key
+        requests = batch["requests"]
+        async with self.slots:
+            instrumentation.count("server.batches")
+            instrumentation.count("server.batched_requests", len(requests))
+            loop = asyncio.get_running_loop()
+            try:
+                headlines, _ = await loop.run_in_executor(self.executor, generate_headlines, n, batch["count"], backoff)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        start = 0
+        for count, future in requests:
+            share = headlines[start:start + count]
+            start += count
+            if future.done():
+                continue
+            if len(share) < count:
+                # The job gave up after utils.CONSECUTIVE_INVALID_LIMIT invalid candidates in a row
+                instrumentation.count("server.rejected.shortfall")
+                future.set_exception(RequestError(
+                    HTTPStatus.UNPROCESSABLE_ENTITY,
+                    "Generated only {0} of {1} headlines: no valid headline in {2} attempts.".format(len(share), count, utils.CONSECUTIVE_INVALID_LIMIT)
+                ))
+            else:
+                future.set_result(share)
+
+class HeadlineServer:
+    """Handles HTTP connections and routes requests to the endpoints.
+
+    Parameters
+    ----------
+    executor: ProcessPoolExecutor
+        Pool that generation and scoring run in.
+    processes: int
+        Number of processes in executor.
+    max_pending: int
+        Most requests waiting for the pool before new ones are turned away.
+    max_batch: int
+        Most headlines generated by one job.
+    max_delay: float
+        Seconds a generation batch waits for more requests before it is started.
+    """
+    def __init__(self, executor, processes, max_pending=256, max_batch=500, max_delay=0.005):
+        self.executor = executor
+        self.batcher = GenerationBatcher(executor, processes, max_batch, max_delay)
+        self.score_slots = asyncio.Semaphore(processes)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/generate"): self.generate,
+            ("POST", "/generate"): self.generate,
+            ("POST", "/validate"): self.validate,
+            ("POST", "/score"): self.score
+        }
+
+    async def handle_connection(self, reader, writer):
+        """Serves requests on one connection until the client closes it."""
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload = await self.dispatch(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_format_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except RequestError as e:
+            writer.write(_format_response(e.status, {"error": str(e)}, False))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """Returns the status and JSON payload of the response to a request."""
+        url = urlsplit(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            if any(path == url.path for _, path in self.routes):
+                return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Method not allowed."}
+            return HTTPStatus.NOT_FOUND, {"error": "Not found."}
+        try:
+            with instrumentation.timer("server" + url.path.replace("/", ".")):
+                params = dict(parse_qsl(url.query))
+                if body:
+                    params.update(_parse_json(body))
+                return HTTPStatus.OK, await handler(params)
+        except RequestError as e:
+            return e.status, {"error": str(e)}
+        except ValueError as e:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {"error": str(e)}
+        except Exception as e:
+            utils.handle_exception(e, "Failed to handle {0} {1}.".format(method, url.path))
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Internal server error."}
+
+    def _admit(self):
+        """Reserves a place for a request that waits for the pool, or turns it away if there are too many."""
+        if self.pending >= self.max_pending:
+            instrumentation.count("server.rejected.overloaded")
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is overloaded; retry later.")
+        self.pending += 1
+
+    async def health(self, params):
+        return {"status": "ok", "max_n": config.max_n, "pending": self.pending}
+
+    async def generate(self, params):
+        n = _int_param(params, "n", 2, 1, config.max_n)
+        count = _int_param(params, "count", 1, 1, MAX_COUNT)
+        backoff = _bool_param(params, "backoff")
+        self._admit()
+        try:
+            headlines = await self.batcher.generate(n, count, backoff)
+        finally:
+            self.pending -= 1
+        return {"n": n, "headlines": headlines}
+
+    async def validate(self, params):
+        headline = _headline_param(params)
+        reason = utils.rejection_reason(headline, load_state()["title_index"])
+        return {"headline": headline, "valid": reason is None, "reason": reason}
+
+    async def score(self, params):
+        n = _int_param(params, "n", 2, 1, config.max_n)
+        headline = _headline_param(params)
+        self._admit()
+        try:
+            async with self.score_slots:
+                scores = await asyncio.get_running_loop().run_in_executor(self.executor, score_headlines, n, [headline])
+        finally:
+            self.pending -= 1
+        score = scores[0]
+        # JSON has no infinity, so headlines the model cannot generate have null scores
+        for name in ("log_probability", "perplexity"):
+            if score[name] is not None and math.isinf(score[name]):
+                score[name] = None
+        return dict(score, headline=headline, n=n)
+
+def _int_param(params, name, default, low, high):
+    value = params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "`{}` must be an integer.".format(name))
+    if not low <= value <= high:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "`{0}` must be between {1} and {2}.".format(name, low, high))
+    return value
+
+def _bool_param(params, name):
+    value = params.get(name, False)
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+def _headline_param(params):
+    headline = params.get("headline")
+    if not isinstance(headline, str):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "`headline` must be a string.")
+    return headline.strip().lower()
+
+def _parse_json(body):
+    try:
+        params = json.loads(body)
+    except ValueError:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Request body must be JSON.")
+    if not isinstance(params, dict):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object.")
+    return params
+
+async def _read_request(reader):
+    """Reads one HTTP/1.1 request and returns its method, target, headers and body, or None at end of stream."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split()
+    except ValueError:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Content-Length must be a non-negative integer.")
+    if length > MAX_BODY:
+        raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body is too large.")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+def _format_response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode("utf-8")
+    head = [
+        "HTTP/1.1 {0} {1}".format(status.value, status.phrase),
+        "Content-Type: application/json",
+        "Content-Length: {}".format(len(body)),
+        "Connection: {}".format("keep-alive" if keep_alive else "close")
+    ]
+    if status == HTTPStatus.SERVICE_UNAVAILABLE:
+        head.append("Retry-After: 1")
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+async def serve(host, port, processes, max_pending, max_batch, max_delay):
+    """Loads the model, starts the worker pool and serves requests until cancelled.
+
+    Parameters
+    ----------
+    host: string
+        Address to listen on.
+    port: int
+        Port to listen on.
+    processes: int
+        Number of worker processes.
+    max_pending: int
+        Most requests waiting for the pool before new ones are turned away.
+    max_batch: int
+        Most headlines generated by one job.
+    max_delay: float
+        Seconds a generation batch waits for more requests before it is started.
+    """
+    load_state()
+    with ProcessPoolExecutor(processes, initializer=_init_worker) as executor:
+        # Starting every worker now, so the first requests don't wait for them
+        await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(executor, time.sleep, 0.01) for _ in range(processes)))
+        headline_server = HeadlineServer(executor, processes, max_pending, max_batch, max_delay)
+        server = await asyncio.start_server(headline_server.handle_connection, host, port)
+        print("Serving headlines on http://{0}:{1} with {2} worker processes.".format(host, port, processes), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves generated Florida man headlines over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Number of worker processes.")
+    parser.add_argument("--max-pending", type=int, default=256, help="Requests waiting for workers before new ones get 503.")
+    parser.add_argument("--max-batch", type=int, default=500, help="Most headlines generated in one job.")
+    parser.add_argument("--batch-delay", type=float, default=0.005, help="Seconds to wait for more requests to batch with.")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.processes, args.max_pending, args.max_batch, args.batch_delay))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -1,8 +1,9 @@
-from collections import Counter
 from collections import defaultdict
-import ngrams_lm
+import config
+import instrumentation
 import numpy as np
 import pandas as pd
+from reservoir import HeadlineReservoir
 import utils
 
 def init_shell():
@@ -14,13 +15,43 @@ def init_shell():
     """
     # Value of n for n-grams language model 
     global n
+    # Largest value of n the language model is trained for
+    global max_n
     # Directory that training_data is stored in 
     global training_directory
     # List of files the language model is currently using
     global used_files
+    # Index of the training titles, used to check headlines for novelty
+    global title_index
+    # How near-duplicate training titles are handled, one of utils.NEAR_DUPLICATE_POLICIES
+    global near_duplicate_policy
+    # Whether headlines are sampled with backoff to shorter histories
+    global backoff
+    # Pre-generated headlines for the current model, refilled in the background
+    global headline_reservoir
     n = 2
-    training_directory = "./training_data/"
-    used_files = ["cbs_miami_headlines.csv", "floridaman_site_headlines.csv", "local10_headlines.csv", "user_headlines.csv"]
+    max_n = config.max_n
+    training_directory = config.training_directory
+    used_files = list(config.used_files)
+    title_index = utils.TitleIndex()
+    near_duplicate_policy = config.near_duplicate_policy
+    backoff = False
+    headline_reservoir = HeadlineReservoir()
+
+def load_model():
+    """Loads the model and all entries from used_files and rebuilds the title index to match.
+
+    Returns the model and the entries, loaded by config.load_training_data, so
+    the model is only retrained if used_files or the .csv files changed since
+    its snapshot was saved.
+
+    Parameters
+    ----------
+    None
+    """
+    global title_index
+    model, entries, title_index = config.load_training_data(training_directory, used_files, max_n, near_duplicate_policy)
+    return model, entries
 
 def greeting(entries):
     """Prints out the greeting message.
@@ -45,21 +76,23 @@ def get_seed():
     try:
         seed = int(seed)
         np.random.seed(seed)
+        headline_reservoir.reseed(seed)
         print("Done! Random seed is set to {}.\n".format(seed))
     except:
         print("Continuing without seed.\n")
 
-def set_n(headline_aggregate, entries):
-    """Changes the value of n. Returns the newly trained headline_aggregate.
+def set_n(model, entries):
+    """Changes the value of n. Returns the newly trained model if n exceeds max_n.
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
     global n
+    global max_n
     user_n = input("Enter a new value for n (must be a positive integer): ")
     try:
         user_n = int(user_n)
@@ -67,11 +100,14 @@ def set_n(headline_aggregate, entries):
             raise
         n = user_n
         print("Done! n is now {}.\n".format(n))
-        return (ngrams_lm.generate_grams(n, entries), entries)
+        if n > max_n:
+            max_n = n
+            # Reloaded from disk, where added and cleared user headlines are saved too
+            return load_model()
     except:
         print("Invalid value for n; did not update n.\n")
 
-def print_headlines(headline_aggregate, entries):
+def print_headlines(model, entries):
     """Prints headlines based on user's prompt.
 
     Prompts user to see if headlines should be saved to a text file at the end.
@@ -80,13 +116,11 @@ def print_headlines(headline_aggregate, entries):
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
-    # Limit on how many attempts at headline construction are allowed
-    consecutive_invalid_limit = 2000
     headline_count = input("How many headlines would you like to generate? ")
     try:
         headline_count = int(headline_count)
@@ -96,22 +130,17 @@ def print_headlines(headline_aggregate, entries):
         print("Could not interpret input as positive integer.\n")
         return
     print()
-    successfully_generated_count = 0
-    consecutive_invalid_count = 0
-    headlines = set()
+    headlines = []
     while len(headlines) < headline_count:
-        headline = ngrams_lm.generate_headline(n, headline_aggregate)
-        if utils.validate_headline(headline, entries):
-            old_size = len(headlines)
-            headlines.add(headline)
-            if len(headlines) > old_size:
-                consecutive_invalid_count = 0
-                print("{0}. {1}".format(len(headlines), headline))
-        elif consecutive_invalid_count >= consecutive_invalid_limit:
-            print("\nFailed to construct headline after {} attempts. Try decreasing n or adding more training data.".format(consecutive_invalid_count))
+        # Taking at most a buffer's worth at a time, so headlines are printed as they come
+        wanted = min(headline_count - len(headlines), headline_reservoir.capacity)
+        taken = headline_reservoir.take(model, title_index, n, wanted, backoff)
+        for headline in taken:
+            headlines.append(headline)
+            print("{0}. {1}".format(len(headlines), headline))
+        if len(taken) < wanted:
+            print("\nFailed to construct headline: {0}. Rejected headlines by reason: {1}. Try decreasing n or adding more training data.".format(headline_reservoir.failure(n, backoff), headline_reservoir.rejection_counts(n, backoff)))
             break
-        else:
-            consecutive_invalid_count += 1
     save_check = input("\nDo you want to save these headlines to a text file? [y/n] ").lower().strip()
     if save_check == "yes" or save_check == "y":
         filename = ""
@@ -127,71 +156,83 @@ def print_headlines(headline_aggregate, entries):
         print("Finished writing headlines to {}".format(filename))
     print()
 
-def add_headline(headline_aggregate, entries):
+def add_headline(model, entries):
     """Allows user to add custom headlines in separate .csv file.
 
-    Returns updated headline_aggregate and entries. All user added headlines are
+    Returns updated model and entries. All user added headlines are
     saved inside user_headlines.csv.
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
     user_headlines = pd.read_csv(training_directory + "user_headlines.csv")
     print("All user-added `Florida Man` headlines will be saved to `training_data/user_headlines.csv`. There are currently {} entries in user_headlines.csv.\n".format(len(user_headlines.index)))
+    added_headlines = []
     user_headline = input("Please enter a valid headline (enter `quit` to stop): ").lower().strip()
     while user_headline != "quit":
-        if not utils.validate_headline(user_headline, entries):
+        if not utils.validate_headline(user_headline, title_index):
             print("Valid headlines must be between {0} and {1} words, contain the phrase `Florida Man`, and not already exist in the training dataset. Suggested headline was not added to the entries.\n".format(utils.MIN_WORDS, utils.MAX_WORDS))
         else:
             print("User suggested headline `{0}` successfully added.\n".format(user_headline))
+            title_index.add(user_headline)
+            added_headlines.append(user_headline)
             user_headline = pd.DataFrame({
                 "title" : [user_headline],
-                "link" : ["~"]
+                "link" : [utils.USER_HEADLINE_LINK]
             })
             user_headlines = user_headlines.append(user_headline, ignore_index=True, sort=True)
         user_headline = input("Please enter a valid headline (enter `quit` to stop). ").lower().strip()
     user_headlines.to_csv(training_directory + "user_headlines.csv", index=False)
-    entries = utils.load_files(training_directory, used_files)
-    headline_aggregate = ngrams_lm.generate_grams(n, entries)
+    if added_headlines and "user_headlines.csv" in used_files:
+        model.add_headlines(added_headlines)
+        entries = pd.concat([entries, pd.DataFrame({
+            "title" : added_headlines,
+            "link" : [utils.USER_HEADLINE_LINK] * len(added_headlines)
+        })], ignore_index=True)
     print("user_headlines.csv currently contains {0} entries.\n".format(len(user_headlines.index)))
-    return (headline_aggregate, entries)
+    return (model, entries)
 
-def clear_custom_headlines(headline_aggregate, entries):
+def clear_custom_headlines(model, entries):
     """Clears all headlines in user_headlines.csv
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
     response = input("Are you sure you want to clear all entries in user_headlines.csv? [y/n] ").lower().strip()
     if response == "yes" or response == "y":
+        user_titles = {headline.strip().lower() for headline in pd.read_csv(training_directory + "user_headlines.csv")["title"].dropna()}
         cleared = pd.DataFrame(columns=["title", "link"])
         cleared.to_csv(training_directory + "user_headlines.csv", index=True)
-        entries = utils.load_files(training_directory, used_files)
-        headline_aggregate = ngrams_lm.generate_grams(n, entries)
+        is_user_headline = entries["link"] == utils.USER_HEADLINE_LINK
+        model.remove_headlines(entries.loc[is_user_headline, "title"])
+        entries = entries.loc[~is_user_headline]
+        # Only user headlines leave the index, so near-duplicates dropped from entries are still rejected
+        for title in user_titles - set(entries["title"]):
+            title_index.discard(title)
         print("Cleared all headlines in user_headlines.csv.\n")
-        return (headline_aggregate, entries)
+        return (model, entries)
     else:
         print("Did not clear headlines from user_headlines.csv.\n")
 
-def inspect_data(headline_aggregate, entries):
+def inspect_data(model, entries):
     """Allows user to inspect each .csv file and drop/add .csv files as well.
 
-    Will return updated headline_aggregate and entries if any .csv files are
+    Will return updated model and entries if any .csv files are
     added or dropped. Additionally, this process mutates global variable
     filenames.
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
@@ -222,11 +263,10 @@ def inspect_data(headline_aggregate, entries):
                 return
             used_files.append(filename)
             used_files.sort()
-            entries = utils.load_files(training_directory, used_files)
-            headline_aggregate = ngrams_lm.generate_grams(n, entries)
+            model, entries = load_model()
             print("Successfully added `{}` to training dataset.".format(filename))
             data_summary(entries, used_files)
-            return (headline_aggregate, entries)
+            return (model, entries)
         except Exception as e:
             utils.handle_exception(e, "Failed to add `{}` to training dataset.".format(filename))
 
@@ -245,11 +285,10 @@ def inspect_data(headline_aggregate, entries):
             print("Cannot remove all data from training dataset.")
             return 
         used_files.remove(filename)
-        entries = utils.load_files(training_directory, used_files)
-        headline_aggregate = ngrams_lm.generate_grams(n, entries)
+        model, entries = load_model()
         print("Successfully removed `{}` from training data.".format(filename))
         data_summary(entries, used_files)
-        return (headline_aggregate, entries)
+        return (model, entries)
 
     def view_data():
         print("The training dataset currently consists of the following .csv files: {}".format(used_files))
@@ -288,28 +327,28 @@ def inspect_data(headline_aggregate, entries):
         out = fn()
         print()
         if out is not None:
-            headline_aggregate, entries = out
+            model, entries = out
             modified_dataset = True
         data_summary(entries, used_files)
         fn = utils.option_mux(inspect_prompt, options)
     print()
     if modified_dataset:
-        return (headline_aggregate, entries)
+        return (model, entries)
 
-def guessing_quiz(headline_aggregate, entries):
+def guessing_quiz(model, entries):
     """A quiz game where users guess if a headline was generated or genuine.
 
     Parameters
     ----------
-    headline_aggregate: dictionary
-        A dictionary of histories and corresponding frequencies for following words.
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
     entries: DataFrame
         A DataFrame containing all headline entries.
     """
     # Proportion of generated headlines
     generated_proportion = 0.5
 
-    real_headlines = entries.loc[entries["link"] != "~"]
+    real_headlines = entries.loc[entries["link"] != utils.USER_HEADLINE_LINK]
     num_correct = 0
     num_questions = 0
     presented_indices = set()
@@ -321,7 +360,11 @@ def guessing_quiz(headline_aggregate, entries):
         selected_ind = -1 if np.random.uniform() < 0.5 else np.random.randint(0, len(real_headlines))
         while headline is None or headline in presented_indices:
             if selected_ind == -1:
-                headline = ngrams_lm.generate_headline(n, headline_aggregate)
+                generated = headline_reservoir.take(model, title_index, n, 1, backoff)
+                if not generated:
+                    print("Failed to construct headline: {}. Try decreasing n or adding more training data.\n".format(headline_reservoir.failure(n, backoff)))
+                    return
+                headline = generated[0]
             else:
                 headline = real_headlines.iloc[selected_ind]["title"]
                 presented_indices.add(selected_ind)
@@ -350,10 +393,57 @@ def guessing_quiz(headline_aggregate, entries):
                     print("{0} This was a real `Florida Man` headline! Here's the actual news article: {1}\n".format(prompt, real_headlines.iloc[selected_ind]["link"]))
                     break
 
+def toggle_backoff(model, entries):
+    """Turns backoff sampling on or off.
+
+    With backoff, histories back off to shorter ones through lower-order
+    tables, so far fewer generated headlines copy the training data at higher n.
+
+    Parameters
+    ----------
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
+    entries: DataFrame
+        A DataFrame containing all headline entries.
+    """
+    global backoff
+    backoff = not backoff
+    print("Done! Backoff sampling is now {}.\n".format("on" if backoff else "off"))
+
+def show_stats(model, entries):
+    """Prints timers and counters collected by the instrumentation module, and the model's memory footprint.
+
+    Parameters
+    ----------
+    model: MultiOrderModel
+        The trained n-grams language model for every n up to max_n.
+    entries: DataFrame
+        A DataFrame containing all headline entries.
+    """
+    print(instrumentation.format_snapshot(instrumentation.snapshot()))
+    print("Model memory:")
+    print(instrumentation.format_memory_report(model.memory_report()))
+    stats_prompt = \
+"""Enter one of the following options:
+    Reset:  Clear all statistics
+    Toggle: {} instrumentation
+    Quit:   Exit to main selection
+>>> """.format("Disable" if instrumentation.enabled else "Enable")
+    options = {
+        "reset": instrumentation.reset,
+        "toggle": lambda: instrumentation.enable(not instrumentation.enabled),
+        "quit": None
+    }
+    fn = utils.option_mux(stats_prompt, options)
+    if fn is not None:
+        fn()
+        print("Done! Instrumentation is {}.".format("enabled" if instrumentation.enabled else "disabled"))
+    print()
+
 if __name__ == "__main__":
+    instrumentation.enable()
     init_shell()
-    entries = utils.load_files(training_directory, used_files)
-    headline_aggregate = ngrams_lm.generate_grams(n, entries)
+    model, entries = load_model()
     greeting(entries)
     get_seed()
     options = {
@@ -362,7 +452,9 @@ if __name__ == "__main__":
         "files": inspect_data,
         "setn": set_n,
         "generate": print_headlines,
+        "backoff": toggle_backoff,
         "quiz": guessing_quiz,
+        "stats": show_stats,
         "quit": None,
         "exit": None,
         "exit()": None,
@@ -373,14 +465,18 @@ if __name__ == "__main__":
     Add:      Add custom headline to training dataset
     Clear:    Clear all custom headlines 
     Files:    Add/remove files from training data, view dataset files
-    SetN:     Change the value of n (n is currently {})  
+    SetN:     Change the value of n (n is currently {0})  
     Generate: Generate a batch of headlines
+    Backoff:  Toggle backoff sampling (currently {1})
     Quiz:     Play guessing quiz
+    Stats:    Show timing and generation statistics
     Quit:     Exit
->>> """.format(n)
+>>> """.format(n, "on" if backoff else "off")
+        # Filling the buffer for the current settings while the user picks a command
+        headline_reservoir.prime(model, title_index, n, backoff)
         fn = utils.option_mux(commands_prompt, options)
         if fn is None:
             exit()
-        out = fn(headline_aggregate, entries)
+        out = fn(model, entries)
         if out is not None:
-            headline_aggregate, entries = out
+            model, entries = out
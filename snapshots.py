@@ -0,0 +1,217 @@
+"""
+Saves trained language models to disk so that the shell can skip retraining.
+Snapshots are stored in ./model_snapshots as raw .npy arrays, which are
+memory-mapped when loaded so that forked processes share their pages.
+"""
+import hashlib
+import instrumentation
+import json
+import ngrams_lm
+import numpy as np
+import os
+import shutil
+import utils
+
+snapshot_directory = "model_snapshots/"
+
+def tokenization_settings():
+    """Returns how titles are cleaned and split into words by the current tokenizer.
+
+    Changing any of these settings changes every snapshot key, so snapshots
+    are never reused with a different tokenizer.
+    """
+    return {
+        "clean": "strip,lower",
+        "split": ngrams_lm.word_tokenizer.settings(),
+        "pad": ngrams_lm.PAD,
+        "end": ngrams_lm.END
+    }
+
+# Arrays saved for every CompiledModel view, along with its history index
+VIEW_ARRAYS = ("histories", "offsets", "successors", "cumulative", "transitions", "counts")
+
+def snapshot_key(training_directory, filenames, max_n, near_duplicates="keep"):
+    """Returns a hash of the training files' contents, max_n, the near-duplicate policy and the tokenization settings.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    filenames: list of strings
+        A list of strings containing the names of .csv files for headline data.
+    max_n: int
+        Largest value of n the model is trained for.
+    near_duplicates: string
+        Policy the training entries' near-duplicates were handled with.
+    """
+    key = hashlib.sha256()
+    settings = {"max_n": max_n, "near_duplicates": near_duplicates, "tokenization": tokenization_settings()}
+    key.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for filename in sorted(filenames):
+        key.update(filename.encode("utf-8") + b"\0")
+        with open(training_directory + filename, "rb") as f:
+            key.update(hashlib.sha256(f.read()).digest())
+    return key.hexdigest()
+
+def save_snapshot(model, path, filenames=(), near_duplicates="keep"):
+    """Saves model and a compiled view for every n up to model.max_n to the directory path.
+
+    The snapshot is written to a temporary directory first and then renamed, so
+    an interrupted save never leaves a partial snapshot behind.
+
+    Parameters
+    ----------
+    model: MultiOrderModel
+        The trained n-grams language model.
+    path: string
+        Directory to save the snapshot in.
+    filenames: list of strings
+        Names of the .csv files the model was trained on, recorded in the snapshot.
+    near_duplicates: string
+        Policy the training entries' near-duplicates were handled with, recorded in the snapshot.
+    """
+    temporary_path = "{0}.tmp{1}".format(path.rstrip("/"), os.getpid())
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    with open(os.path.join(temporary_path, "vocab.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(model.vocab))
+    np.save(os.path.join(temporary_path, "grams.npy"), model.grams)
+    np.save(os.path.join(temporary_path, "counts.npy"), model.counts)
+    for n in range(1, model.max_n + 1):
+        view = model.view(n)
+        arrays = {
+            "histories": view.histories.histories,
+            "offsets": view.offsets,
+            "successors": view.successors,
+            "cumulative": view.cumulative,
+            "transitions": view.transitions,
+            "counts": view.counts
+        }
+        # The history index is saved too, so loading doesn't hash every history again
+        arrays["hashes"] = view.histories.sorted_hashes
+        if view.histories.order is not None:
+            arrays["order"] = view.histories.order
+        for name in arrays:
+            np.save(os.path.join(temporary_path, "view{0}_{1}.npy".format(n, name)), arrays[name])
+    with open(os.path.join(temporary_path, "meta.json"), "w") as f:
+        json.dump({"max_n": model.max_n, "filenames": sorted(filenames), "near_duplicates": near_duplicates}, f)
+    os.replace(temporary_path, path)
+
+@instrumentation.timed("snapshot")
+def load_snapshot(path):
+    """Loads a MultiOrderModel and its views from the snapshot in the directory path.
+
+    Arrays are memory-mapped read-only, so only the pages that are used get read
+    and processes forked after loading share them.
+
+    Parameters
+    ----------
+    path: string
+        Directory the snapshot was saved in.
+    """
+    load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+    # Snapshots saved without a history index get theirs rebuilt by hashing the histories
+    load_optional = lambda name: load(name) if os.path.exists(os.path.join(path, name)) else None
+    with open(os.path.join(path, "meta.json")) as f:
+        max_n = json.load(f)["max_n"]
+    with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+        vocab = f.read().split("\n")
+    model = ngrams_lm.MultiOrderModel(max_n, vocab, load("grams.npy"), load("counts.npy"))
+    for n in range(1, max_n + 1):
+        arrays = {name: load("view{0}_{1}.npy".format(n, name)) for name in VIEW_ARRAYS}
+        model.views[n] = ngrams_lm.CompiledModel(
+            n,
+            model.vocab,
+            ngrams_lm.HistoryIndex(
+                arrays["histories"],
+                load_optional("view{}_hashes.npy".format(n)),
+                load_optional("view{}_order.npy".format(n))
+            ),
+            arrays["offsets"],
+            arrays["successors"],
+            arrays["cumulative"],
+            arrays["transitions"],
+            arrays["counts"],
+            model.word_ids
+        )
+    return model
+
+def load_or_train(training_directory, filenames, max_n, entries, directory=snapshot_directory, near_duplicates="keep", corpus=None, corpus_rows=None):
+    """Returns the model for filenames from its snapshot, training and saving it if needed.
+
+    A snapshot is only reused if the training files, max_n and tokenization
+    settings are unchanged. Otherwise the model is retrained from entries, or
+    from the token ids of corpus_rows if they are given, and stale snapshots
+    of the same files are removed.
+
+    Raises a ValueError if corpus_rows doesn't have a row for every entry.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    filenames: list of strings
+        A list of strings containing the names of .csv files for headline data.
+    max_n: int
+        Largest value of n the model is trained for.
+    entries: pandas DataFrame
+        A pandas Dataframe containing the headlines in filenames.
+    directory: string
+        Directory that snapshots are stored in.
+    near_duplicates: string
+        Policy the near-duplicates in entries were handled with.
+    corpus: Corpus
+        The corpus entries were loaded from, if any.
+    corpus_rows: numpy array
+        Row of each entry in corpus. If given, the model is trained from their
+        token ids instead of re-tokenizing the titles.
+    """
+    if corpus is not None and corpus_rows is not None and len(corpus_rows) != len(entries.index):
+        raise ValueError("Got {0} corpus rows for {1} entries.".format(len(corpus_rows), len(entries.index)))
+    key = snapshot_key(training_directory, filenames, max_n, near_duplicates)
+    path = os.path.join(directory, key)
+    if os.path.isdir(path):
+        try:
+            return load_snapshot(path)
+        except Exception as e:
+            utils.handle_exception(e, "Failed to load model snapshot `{}`; retraining.".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+    if corpus is None or corpus_rows is None:
+        model = ngrams_lm.train_multi_order(max_n, entries)
+    else:
+        model = ngrams_lm.train_multi_order_ids(max_n, corpus.vocab, *corpus.token_ids(corpus_rows))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        save_snapshot(model, path, filenames, near_duplicates)
+        _remove_stale_snapshots(directory, key, filenames, max_n, near_duplicates)
+    except Exception as e:
+        utils.handle_exception(e, "Failed to save model snapshot `{}`.".format(path))
+    return model
+
+def _remove_stale_snapshots(directory, key, filenames, max_n, near_duplicates="keep"):
+    """Removes snapshots for the same files, max_n and near-duplicate policy that were saved under a different key.
+
+    Parameters
+    ----------
+    directory: string
+        Directory that snapshots are stored in.
+    key: string
+        Key of the current snapshot.
+    filenames: list of strings
+        A list of strings containing the names of .csv files for headline data.
+    max_n: int
+        Largest value of n the model is trained for.
+    near_duplicates: string
+        Policy the training entries' near-duplicates were handled with.
+    """
+    sources = sorted(filenames)
+    for name in os.listdir(directory):
+        meta_path = os.path.join(directory, name, "meta.json")
+        if name == key or not os.path.isfile(meta_path):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        # Snapshots that don't record their policy predate it in the key, so they are stale either way
+        same_policy = meta.get("near_duplicates", near_duplicates) == near_duplicates
+        if meta.get("filenames") == sources and meta.get("max_n") == max_n and same_policy:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
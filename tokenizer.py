@@ -0,0 +1,122 @@
+"""
+Splits cleaned titles into tokens for the language model and joins generated
+tokens back into headlines. Rules are regular expressions compiled once when
+a Tokenizer is made, and every token is interned, so repeated words share one
+string object no matter how many titles they appear in.
+"""
+import html
+import re
+import sys
+
+# Named rule sets. `whitespace` splits exactly like str.split. `words` also
+# unescapes HTML entities and splits punctuation and quotes off words, while
+# keeping words and numbers with apostrophes, hyphens, periods or commas inside
+# them together, such as `man’s`, `9.5-foot-long` and `$45,000`.
+RULES = {
+    "whitespace": {
+        "unescape": False,
+        "token": r"\S+"
+    },
+    "words": {
+        "unescape": True,
+        "token": r"\$?\w+(?:[-'’.,:*/]\w+)*%?|\.\d+|\.{2,}|[^\w\s]"
+    }
+}
+
+# Tokens written without a space before or after them by the `words` rules.
+# Straight quotes open and close alternately.
+NO_SPACE_BEFORE = frozenset(",.:;!?)]}%”’…")
+NO_SPACE_AFTER = frozenset("([{$“‘")
+STRAIGHT_QUOTES = frozenset("\"'")
+
+class Tokenizer:
+    """Splits text into interned tokens with one of the rule sets in RULES.
+
+    Parameters
+    ----------
+    rules: string
+        Name of the rule set, one of RULES.
+    """
+    def __init__(self, rules="whitespace"):
+        if rules not in RULES:
+            raise ValueError("Unknown tokenizer rules `{}`.".format(rules))
+        self.rules = rules
+        self.unescape = RULES[rules]["unescape"]
+        self.pattern = re.compile(RULES[rules]["token"])
+        self.findall = self.pattern.findall
+        # Whitespace rules split exactly like str.split, which is much faster than a regex
+        self.split = str.split if rules == "whitespace" else self.findall
+
+    def tokenize(self, text, intern=True):
+        """Returns the list of tokens in text.
+
+        Parameters
+        ----------
+        text: string
+            A cleaned title or headline.
+        intern: bool
+            Whether to intern the tokens. Tokens that are only looked up and
+            then dropped, as when scoring, are cheaper left uninterned.
+        """
+        if self.unescape and "&" in text:
+            text = html.unescape(text)
+        if not intern:
+            return self.split(text)
+        return list(map(sys.intern, self.split(text)))
+
+    def token_ids(self, text, word_ids, vocab):
+        """Returns the ids of the tokens in text, adding new tokens to word_ids and vocab.
+
+        Parameters
+        ----------
+        text: string
+            A cleaned title or headline.
+        word_ids: dictionary
+            Maps tokens to their ids.
+        vocab: list
+            A list of tokens, where each token's index is its id.
+        """
+        if self.unescape and "&" in text:
+            text = html.unescape(text)
+        tokens = self.split(text)
+        ids = list(map(word_ids.get, tokens))
+        if None in ids:
+            # Only new tokens need interning; known ones are dropped right after lookup
+            for i, token in enumerate(tokens):
+                if ids[i] is None:
+                    word_id = word_ids.get(token)
+                    if word_id is None:
+                        token = sys.intern(token)
+                        word_id = word_ids[token] = len(vocab)
+                        vocab.append(token)
+                    ids[i] = word_id
+        return ids
+
+    def detokenize(self, tokens):
+        """Joins tokens back into a headline.
+
+        Parameters
+        ----------
+        tokens: list of strings
+            Tokens of a headline.
+        """
+        if self.rules == "whitespace":
+            return " ".join(tokens)
+        parts = []
+        attach = True
+        open_quote = False
+        for token in tokens:
+            if token in STRAIGHT_QUOTES:
+                open_quote = not open_quote
+                attach_this = not open_quote
+            else:
+                attach_this = token in NO_SPACE_BEFORE or token.strip(".") == ""
+            if parts and not attach and not attach_this:
+                parts.append(" ")
+            parts.append(token)
+            attach = token in NO_SPACE_AFTER or (token in STRAIGHT_QUOTES and open_quote)
+        return "".join(parts)
+
+    def settings(self):
+        """Returns a dictionary describing the rules, e.g. to key saved models by."""
+        return {"rules": self.rules, "unescape": self.unescape, "token": self.pattern.pattern}
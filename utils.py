@@ -1,11 +1,21 @@
-from os import listdir 
+import csv
+import dedup
+from hashlib import blake2b
+import instrumentation
+from os import listdir, remove, replace
 from os.path import isfile, join
+import numpy as np
 import pandas as pd
 import traceback
 from pprint import pprint
 
 MIN_WORDS = 5
 MAX_WORDS = 20
+# Invalid headlines in a row after which generating gives up
+CONSECUTIVE_INVALID_LIMIT = 2000
+NEAR_DUPLICATE_POLICIES = ("keep", "first", "longest")
+# Link recorded for headlines added by users, which have no article
+USER_HEADLINE_LINK = "~"
 
 def get_files(training_directory, path):
     """Returns list of file names in directory specified by path. 
@@ -33,7 +43,8 @@ def handle_exception(exception, msg=None):
     else:
         print(exception)
 
-def load_files(training_directory, filenames):
+@instrumentation.timed("load")
+def load_files(training_directory, filenames, near_duplicates="keep"):
     """Takes a list of file names for .csv files and returns a DataFrame with all entries combined.
 
     Parameters
@@ -42,14 +53,199 @@ def load_files(training_directory, filenames):
         Directory with training data inside.
     filenames: list of strings
         A list of strings containing the names of .csv files for headline data.
+    near_duplicates: string
+        Policy for near-duplicate titles, one of NEAR_DUPLICATE_POLICIES. See drop_near_duplicates.
     """
     clean_headline = lambda headline: headline.strip().lower()
-    df = pd.DataFrame(columns=["title", "link"])
-    for filename in filenames:
-        df = df.append(pd.read_csv(training_directory + filename), ignore_index=True, sort=False)
+    frames = [pd.DataFrame(columns=["title", "link"])]
+    frames.extend(pd.read_csv(training_directory + filename) for filename in filenames)
+    df = pd.concat(frames, ignore_index=True, sort=False)
     df = df.drop_duplicates()
     df["title"] = [clean_headline(headline) for headline in df["title"]]
-    return df
+    return drop_near_duplicates(df, near_duplicates)
+
+def drop_near_duplicates(entries, policy="first"):
+    """Returns entries with only one entry left for each cluster of near-duplicate titles.
+
+    Near-duplicates, like the same story syndicated by several sources with
+    slightly different wording, are found with dedup.near_duplicate_clusters.
+    With policy `keep`, entries are returned unchanged. With `first`, the first
+    entry of each cluster in file order is kept, and with `longest`, the entry
+    with the longest title is.
+
+    Parameters
+    ----------
+    entries: pandas DataFrame
+        A DataFrame containing titles and links for all headlines.
+    policy: string
+        One of NEAR_DUPLICATE_POLICIES.
+    """
+    if policy not in NEAR_DUPLICATE_POLICIES:
+        raise ValueError("Unknown near-duplicate policy `{}`.".format(policy))
+    if policy == "keep" or len(entries.index) == 0:
+        return entries
+    return entries.iloc[near_duplicate_positions(entries["title"].tolist(), policy)]
+
+def near_duplicate_positions(titles, policy="first", clusters=None):
+    """Returns the sorted positions in titles that drop_near_duplicates keeps with policy.
+
+    Parameters
+    ----------
+    titles: list of strings
+        Cleaned headline titles in file order.
+    policy: string
+        One of NEAR_DUPLICATE_POLICIES.
+    clusters: numpy array
+        The dedup.near_duplicate_clusters of titles, if they are already known.
+    """
+    if policy not in NEAR_DUPLICATE_POLICIES:
+        raise ValueError("Unknown near-duplicate policy `{}`.".format(policy))
+    if policy == "keep" or len(titles) == 0:
+        return np.arange(len(titles))
+    if clusters is None:
+        clusters = dedup.near_duplicate_clusters(titles)
+    if policy == "first":
+        return np.flatnonzero(clusters == np.arange(len(clusters)))
+    lengths = np.array([len(title) for title in titles])
+    # Sorted by cluster, then longest title first; ties keep file order
+    order = np.lexsort((-lengths, clusters))
+    sorted_clusters = clusters[order]
+    return np.sort(order[np.concatenate(([True], sorted_clusters[1:] != sorted_clusters[:-1]))])
+
+def stream_titles(training_directory, filenames, chunk_size=10000, error_rate=1e-6):
+    """Yields cleaned titles from .csv files in lists of at most chunk_size titles.
+
+    Reads the files row by row without pandas. Entries with the same title and
+    link are only yielded once, like in load_files. They are found with a
+    dedup.BloomFilter sized for the number of lines in the files, which takes
+    about 3.6 MB per million rows at the default error rate instead of growing
+    with every distinct entry; in exchange, a unique entry is wrongly skipped
+    as a duplicate with probability at most error_rate.
+
+    Parameters
+    ----------
+    training_directory: string
+        Directory with training data inside.
+    filenames: list of strings
+        A list of strings containing the names of .csv files for headline data.
+    chunk_size: int
+        Largest number of titles yielded at once.
+    error_rate: float
+        Largest probability of skipping a unique entry as a duplicate.
+    """
+    seen = dedup.BloomFilter(sum(_count_lines(training_directory + filename) for filename in filenames), error_rate)
+    rows = []
+    for filename in filenames:
+        with open(training_directory + filename, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                title, link = row.get("title"), row.get("link")
+                if not title:
+                    continue
+                rows.append((title, link))
+                if len(rows) >= chunk_size:
+                    chunk = _new_titles(rows, seen)
+                    if chunk:
+                        yield chunk
+                    rows = []
+    chunk = _new_titles(rows, seen)
+    if chunk:
+        yield chunk
+
+def _new_titles(rows, seen):
+    """Returns the cleaned titles of the (title, link) rows not yet added to the Bloom filter seen."""
+    is_new = seen.add(["{0}\0{1}".format(title, link) for title, link in rows])
+    return [title.strip().lower() for (title, _), new in zip(rows, is_new) if new]
+
+def _count_lines(filename):
+    """Returns the number of lines in filename, an upper bound on its number of .csv rows."""
+    with open(filename, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b"")) + 1
+
+def title_fingerprint(title):
+    """Returns a 64-bit fingerprint of title as an int, used by compact TitleIndexes."""
+    return int.from_bytes(blake2b(title.encode("utf-8"), digest_size=8).digest(), "little")
+
+class TitleIndex:
+    """A set of training headline titles used to check generated headlines for novelty.
+
+    Membership checks are O(1). With compact set to True, only a 64-bit
+    fingerprint of each title is stored instead of the title itself, which
+    keeps the index small for large corpora; a fingerprint collision can only
+    cause a novel headline to be rejected, never a duplicate to be accepted.
+    The index can also start from a sorted array of fingerprints, like the one
+    saved with the training corpus, which is searched in O(log n) and never
+    copied, so titles added or discarded later are tracked in sets beside it.
+
+    Parameters
+    ----------
+    titles: iterable
+        Cleaned headline titles to index.
+    compact: bool
+        Whether to store fingerprints instead of titles.
+    fingerprints: numpy array
+        Sorted, unique title_fingerprint values of titles already indexed. Implies compact.
+    """
+    def __init__(self, titles=(), compact=False, fingerprints=None):
+        self.compact = compact or fingerprints is not None
+        self.fingerprints = np.empty(0, dtype=np.uint64) if fingerprints is None else fingerprints
+        self.keys = set()
+        self.discarded = set()
+        self.update(titles)
+
+    def _key(self, title):
+        if not self.compact:
+            return title
+        return title_fingerprint(title)
+
+    def _is_indexed(self, key):
+        """Returns whether key is one of the fingerprints the index started from."""
+        if len(self.fingerprints) == 0:
+            return False
+        key = np.uint64(key)
+        position = self.fingerprints.searchsorted(key)
+        return position < len(self.fingerprints) and self.fingerprints[position] == key
+
+    def add(self, title):
+        """Adds a single title to the index."""
+        key = self._key(title)
+        if self._is_indexed(key):
+            self.discarded.discard(key)
+        else:
+            self.keys.add(key)
+
+    def update(self, titles):
+        """Adds every title in titles to the index."""
+        if len(self.fingerprints) == 0:
+            self.keys.update(self._key(title) for title in titles)
+            return
+        for title in titles:
+            self.add(title)
+
+    def discard(self, title):
+        """Removes a single title from the index if it is in it."""
+        key = self._key(title)
+        self.keys.discard(key)
+        if self._is_indexed(key):
+            self.discarded.add(key)
+
+    def __contains__(self, title):
+        key = self._key(title)
+        return key in self.keys or (self._is_indexed(key) and key not in self.discarded)
+
+    def __len__(self):
+        return len(self.keys) + len(self.fingerprints) - len(self.discarded)
+
+def build_title_index(entries, compact=False):
+    """Builds a TitleIndex over the titles of entries.
+
+    Parameters
+    ----------
+    entries: DataFrame
+        A DataFrame containing all headline entries.
+    compact: bool
+        Whether to store fingerprints instead of titles.
+    """
+    return TitleIndex(entries["title"], compact=compact)
 
 def option_mux(message, options):
     """Prompts user with message, compares user input with options to decide which function to execute.
@@ -85,7 +281,7 @@ def print_soup(soup, log_file = None):
     else:
         pprint(soup, log_file)
 
-def validate_headline(headline, entries):
+def validate_headline(headline, title_index):
     """Checks that headline is valid.
     Checks that headline is not identical to any headline in the training data,
     that the headline is between 5 and 20 words, and that 'florida man' is in
@@ -94,13 +290,31 @@ def validate_headline(headline, entries):
     ----------
     headline: str
         Language model generated headlines
-    entries: DataFrame
-        A DataFrame containing all headline entries.
+    title_index: TitleIndex
+        An index of all headline titles in the training data.
     """
-    return headline not in list(entries["title"])\
-        and len(headline.split()) >= MIN_WORDS\
-        and len(headline.split()) <= MAX_WORDS\
-        and "florida man" in headline
+    return rejection_reason(headline, title_index) is None
+
+def rejection_reason(headline, title_index):
+    """Returns why validate_headline would reject headline, or None if it is valid.
+
+    Parameters
+    ----------
+    headline: str
+        Language model generated headlines
+    title_index: TitleIndex
+        An index of all headline titles in the training data.
+    """
+    length = len(headline.split())
+    if length < MIN_WORDS:
+        return "too short"
+    if length > MAX_WORDS:
+        return "too long"
+    if "florida man" not in headline:
+        return "missing phrase"
+    if headline in title_index:
+        return "duplicate of training data"
+    return None
 
 def write_to_text(content, filename):
     """Saves content to a .txt file specified by filename.
@@ -130,3 +344,115 @@ def write_to_csv(content, filename):
     content.to_csv(filename, index=False)
     print("Scraped {} sources.".format(len(content.index)))
     print("Saving currently scraped results in '{}'.".format(filename))
+
+class ScrapeCheckpoint:
+    """Collects scraped headlines for a .csv file, checkpointing them as they come in.
+
+    Rows are buffered in a list and appended to `<filename>.partial` every
+    checkpoint_every rows, so an interrupted scrape loses at most that many
+    rows. Rows already in the partial file are loaded on creation, letting a
+    rerun resume where the last one stopped instead of scraping them again.
+    finish merges the partial file into filename once the scrape is complete;
+    a scrape that fails or is interrupted calls suspend instead, which leaves
+    filename untouched and keeps the partial file for the next run.
+
+    In incremental mode, the links already saved in filename are loaded as
+    well. Scrapers can stop paging once they reach one of these known links,
+    and finish keeps the saved rows after the new ones.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the file the articles are being written into.
+    incremental: bool
+        Whether to keep the rows already in filename and only add new ones.
+    checkpoint_every: int
+        Number of new rows buffered before they are written to the partial file.
+    """
+    def __init__(self, filename, incremental=False, checkpoint_every=50):
+        self.filename = filename
+        self.partial_filename = filename + ".partial"
+        self.incremental = incremental
+        self.checkpoint_every = checkpoint_every
+        self.saved_rows = _read_rows(filename) if incremental else []
+        self.known_links = {link for _, link in self.saved_rows}
+        self.scraped_rows = _read_rows(self.partial_filename)
+        self.scraped_links = {link for _, link in self.scraped_rows}
+        self.pending = []
+        if self.scraped_rows:
+            print("Resuming with {0} headlines checkpointed in '{1}'.".format(len(self.scraped_rows), self.partial_filename))
+
+    def is_known(self, link):
+        """Checks whether link was saved to filename by an earlier scrape."""
+        return link in self.known_links
+
+    def is_scraped(self, link):
+        """Checks whether link was already added in this or an interrupted scrape."""
+        return link in self.scraped_links
+
+    def add(self, title, link):
+        """Adds a headline unless its link is known or already scraped. Returns whether it was added.
+
+        Parameters
+        ----------
+        title: string
+            Title of the article.
+        link: string
+            Link to the article.
+        """
+        if link in self.known_links or link in self.scraped_links:
+            return False
+        self.scraped_links.add(link)
+        self.pending.append((title, link))
+        if len(self.pending) >= self.checkpoint_every:
+            self.checkpoint()
+        return True
+
+    def __len__(self):
+        return len(self.scraped_rows) + len(self.pending)
+
+    def checkpoint(self):
+        """Appends buffered rows to the partial file."""
+        if not self.pending:
+            return
+        is_new = not isfile(self.partial_filename)
+        with open(self.partial_filename, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(["title", "link"])
+            writer.writerows(self.pending)
+        self.scraped_rows.extend(self.pending)
+        self.pending = []
+
+    def suspend(self):
+        """Appends buffered rows to the partial file and keeps it, so a rerun resumes from them."""
+        self.checkpoint()
+        print("Scrape did not finish; {0} headlines are kept in '{1}' for the next run.".format(len(self.scraped_rows), self.partial_filename))
+
+    def finish(self):
+        """Writes new rows, followed by any saved rows, to filename and removes the partial file."""
+        self.checkpoint()
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["title", "link"])
+            writer.writerows(self.scraped_rows)
+            writer.writerows(self.saved_rows)
+        replace(temporary_filename, self.filename)
+        if isfile(self.partial_filename):
+            remove(self.partial_filename)
+        print("Scraped {0} new sources; {1} in total.".format(len(self.scraped_rows), len(self.scraped_rows) + len(self.saved_rows)))
+        print("Saving currently scraped results in '{}'.".format(self.filename))
+
+def _read_rows(filename):
+    """Returns the (title, link) rows of a .csv file, or an empty list if it does not exist.
+
+    Parameters
+    ----------
+    filename: string
+        The name of the .csv file.
+    """
+    if not isfile(filename):
+        return []
+    with open(filename, newline="", encoding="utf-8") as f:
+        return [(row["title"], row["link"]) for row in csv.DictReader(f) if row.get("title")]